@@ -9,13 +9,33 @@ Features:
 """
 
 import os
+import sys
+import hmac
 import json
+import base64
+import hashlib
+import heapq
 import random
+import secrets
 import asyncio
 import sqlite3
 import time
 import logging
-from aiohttp import web, ClientSession
+import signal
+import tempfile
+import multiprocessing
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial, wraps
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+
+try:
+    import orjson  # optional, faster JSON on the webhook and Bot API paths
+except ImportError:
+    orjson = None
 
 # Configuration
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '8324596212:ACHznhDgRuW2OcTYKAvFoa0UrDiMnef4Qyh')
@@ -23,12 +43,127 @@ ADMIN_UID = os.environ.get('ADMIN_UID', '1130431721')
 WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', 'W2OcTYKAvFoa0Ur')
 PORT = int(os.environ.get('PORT', '8658'))
 DOMAIN = os.environ.get('DOMAIN', '')  # For webhook
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
 DB_PATH = os.environ.get('DB_PATH', 'bot_data.db')
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')  # 'sqlite' or 'memory'
+
+# Scale-out: WORKERS processes share PORT via SO_REUSEPORT. Each chat is
+# owned by one worker; updates that land elsewhere, or that worker 0 polled,
+# are relayed to the owner on 127.0.0.1:WORKER_BASE_PORT + index so
+# per-chat order holds.
+WORKERS = int(os.environ.get('WORKERS', '1'))
+WORKER_BASE_PORT = int(os.environ.get('WORKER_BASE_PORT', str(PORT + 1)))
+
+# Admin routing: guests are spread over ADMIN_UIDS by consistent hashing, or
+# with ADMIN_GROUP_ID (a forum supergroup) each guest gets a topic there
+ADMIN_UIDS = [uid.strip() for uid in os.environ.get('ADMIN_UIDS', ADMIN_UID).split(',') if uid.strip()]
+ADMIN_GROUP_ID = os.environ.get('ADMIN_GROUP_ID', '').strip()
+ADMIN_RING_REPLICAS = 512  # points per admin on the hash ring
 
 NOTIFY_INTERVAL = 24 * 3600  # 1 day (seconds)
-FRAUD_DB_URL = 'https://raw.githubusercontent.com/Squarelan/telegram-verify-bot/main/data/fraud.db'
-NOTIFICATION_URL = 'https://raw.githubusercontent.com/Squarelan/telegram-verify-bot/main/data/notification.txt'
-ENABLE_NOTIFICATION = False
+FRAUD_DB_URL = os.environ.get('FRAUD_DB_URL', 'https://raw.githubusercontent.com/Squarelan/telegram-verify-bot/main/data/fraud.db')
+FRAUD_CACHE_PATH = os.environ.get('FRAUD_CACHE_PATH', 'fraud_cache.txt')
+FRAUD_REFRESH_INTERVAL = int(os.environ.get('FRAUD_REFRESH_INTERVAL', '3600'))
+NOTIFICATION_URL = os.environ.get('NOTIFICATION_URL', 'https://raw.githubusercontent.com/Squarelan/telegram-verify-bot/main/data/notification.txt')
+ENABLE_NOTIFICATION = os.environ.get('ENABLE_NOTIFICATION', '0') == '1'
+
+# Background update processing (ASYNC_UPDATES=1 acks webhooks before handling)
+ASYNC_UPDATES = os.environ.get('ASYNC_UPDATES', '0') == '1'
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '8'))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '1000'))
+SHUTDOWN_DRAIN_TIMEOUT = 10  # seconds to finish queued updates on shutdown
+
+# Update source: 'webhook' or 'polling' (getUpdates long polling)
+UPDATE_MODE = os.environ.get('UPDATE_MODE', 'webhook')
+POLL_TIMEOUT = 30  # seconds Telegram holds a getUpdates request open
+POLL_LIMIT = 100
+POLL_RETRY_DELAY = 5
+
+# Redelivered updates are dropped by update_id; the high-water mark is saved
+# so updates handled before a restart are still recognised
+DEDUP_WINDOW = 10000  # recent update_ids remembered exactly
+DEDUP_SAVE_INTERVAL = 1  # seconds between saves of the high-water mark
+# Telegram picks a new random update_id after a week without updates, so
+# neither the saved mark nor the window may outlive that
+DEDUP_MARK_TTL = 6 * 86400
+
+# Outbound HTTP connection pool
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '100'))
+HTTP_POOL_PER_HOST = int(os.environ.get('HTTP_POOL_PER_HOST', '30'))
+HTTP_KEEPALIVE = 60  # seconds an idle connection is kept open
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '15'))
+HTTP_CONNECT_TIMEOUT = 5
+
+# Expired row sweeping
+SWEEP_INTERVAL = int(os.environ.get('SWEEP_INTERVAL', '600'))
+SWEEP_BATCH_SIZE = 500  # rows deleted per transaction
+SWEEP_MAX_BATCHES = 100  # per sweep, so one run stays bounded
+SWEEP_VACUUM_PAGES = 2000  # free pages returned to the OS per sweep
+
+# In-process cache for per-user state
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', '60'))  # seconds; local writes invalidate sooner
+
+# Write-behind buffering for message_map and last-message writes
+WRITE_BEHIND_INTERVAL = 0.05  # seconds between batched commits
+WRITE_BEHIND_MAX_ROWS = 200  # commit early once this many rows are buffered
+
+# Verification challenges are HMAC-signed into callback_data, not stored
+CHALLENGE_SECRET = os.environ.get('CHALLENGE_SECRET', '')
+CHALLENGE_TTL = 600  # seconds a challenge can be answered
+CHALLENGE_POOL_SIZE = 256  # pre-generated questions kept ready
+VERIFY_TTL = 259200  # 3 days a solved challenge keeps a chat verified
+
+# Flood protection: when unverified chats send more than RAID_THRESHOLD
+# messages per second, raid mode drops their repeats before any DB or API work
+RAID_THRESHOLD = float(os.environ.get('RAID_THRESHOLD', '20'))
+RAID_WINDOW = 10  # seconds the unverified message rate is averaged over
+RAID_COOLDOWN = 60  # seconds under half the threshold before raid mode ends
+RAID_CHALLENGE_RATE = float(os.environ.get('RAID_CHALLENGE_RATE', '5'))  # new challenges per second in a raid
+CHAT_REMINDER_LIMIT = 2  # "click the button" reminders per chat per window
+CHAT_REMINDER_WINDOW = 60
+
+# /broadcast fan-out; sends use the low-priority lane of the rate limiter
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '10'))  # sends in flight
+BROADCAST_PAGE_SIZE = 500  # recipients read per query
+BROADCAST_PROGRESS_INTERVAL = 10  # seconds between progress updates to the admin
+
+# Albums arrive as one update per item; they are collected by media_group_id
+# and sent on with one forwardMessages/copyMessages call
+MEDIA_GROUP_WINDOW = float(os.environ.get('MEDIA_GROUP_WINDOW', '0.5'))  # seconds after the first item
+
+# SQLite tuning: WAL journal, fsync only at checkpoints, 8 MB page cache
+SQLITE_PRAGMAS = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'cache_size=-8000',
+    'temp_store=MEMORY',
+    'busy_timeout=5000',  # wait for other writers instead of failing at once
+)
+SQLITE_LOCK_RETRIES = 5
+SQLITE_LOCK_RETRY_DELAY = 0.05  # seconds, grows linearly per attempt
+
+# Outbound Telegram API scheduling
+API_GLOBAL_RATE = float(os.environ.get('API_GLOBAL_RATE', '30'))  # messages per second, all chats
+API_CHAT_RATE = float(os.environ.get('API_CHAT_RATE', '1'))  # messages per second, per chat
+API_CHAT_BURST = int(os.environ.get('API_CHAT_BURST', '3'))
+API_MAX_RETRIES = 3
+API_RETRY_BASE = 0.5  # seconds, doubled per attempt and jittered
+MAX_CHAT_BUCKETS = 10000
+
+# Priority lanes: a lane may only spend global tokens above its reserve,
+# so admin replies still get through while prompts queue up
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+LANE_RESERVE = (0.0, 0.2, 0.4)  # fraction of the global bucket held back
+
+# /metrics histogram bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOOKUP_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 1e-3)
+
+# Fraction of webhook updates logged at INFO (0 turns update logging off)
+LOG_UPDATE_SAMPLE = float(os.environ.get('LOG_UPDATE_SAMPLE', '1'))
 
 # Logging
 logging.basicConfig(
@@ -37,33 +172,414 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Wire JSON: orjson when installed, otherwise the stdlib with the same compact output
+if orjson is not None:
+    json_loads = orjson.loads
+    
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    json_loads = json.loads
+    json_dumps = partial(json.dumps, ensure_ascii=False, separators=(',', ':'))
+
+
+def log_update(update):
+    """Log a sample of incoming updates; nothing is serialized unless it is logged"""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if LOG_UPDATE_SAMPLE < 1 and random.random() >= LOG_UPDATE_SAMPLE:
+        return
+    logger.info(f'Received update: {json_dumps(update)[:200]}')
+
+CHALLENGE_KEY = hashlib.sha256((CHALLENGE_SECRET or f'challenge:{BOT_TOKEN}').encode()).digest()
+CHALLENGE_MAC = hmac.new(CHALLENGE_KEY, digestmod=hashlib.sha256)  # pre-keyed, copied per signature
+
+
+# Metrics
+class Metrics:
+    """Counters, gauges and histograms served as Prometheus text.
+
+    Everything is recorded on the event loop thread, so an event is a plain
+    dict update with no lock. Labels are passed pre-formatted, e.g.
+    'method="sendMessage"'; gauges move with inc(name, value=-1).
+    """
+    
+    def __init__(self):
+        self._meta = {}
+        self._values = {}
+    
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+    
+    def gauge(self, name, help_text):
+        self._meta[name] = ('gauge', help_text, None)
+    
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, buckets)
+    
+    def inc(self, name, labels='', value=1):
+        key = (name, labels)
+        self._values[key] = self._values.get(key, 0) + value
+    
+    def observe(self, name, seconds, labels=''):
+        buckets = self._meta[name][2]
+        values = self._values.get((name, labels))
+        if values is None:
+            # One count per bucket, one for +Inf, then the running sum
+            values = self._values[(name, labels)] = [0] * (len(buckets) + 2)
+        values[bisect_left(buckets, seconds)] += 1
+        values[-1] += seconds
+    
+    def timer(self, name, labels='', in_flight=None):
+        """Observe the duration of a block, optionally tracking it in a gauge"""
+        return Timer(self, name, labels, in_flight)
+    
+    def timed(self, name, label=None):
+        """Decorator timing an async function, labelled with its name if `label` is set"""
+        def decorator(func):
+            labels = f'{label}="{func.__name__}"' if label else ''
+            
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, labels)
+            return wrapper
+        return decorator
+    
+    def render(self):
+        series = {}
+        for (name, labels), value in list(self._values.items()):
+            series.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(series.get(name, ()), key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                count = 0
+                for bound, bucket_count in zip((*buckets, '+Inf'), value):
+                    count += bucket_count
+                    le = f'le="{bound}"'
+                    lines.append(f'{name}_bucket{format_labels(labels, le)} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class Timer:
+    """Context manager behind Metrics.timer()"""
+    
+    __slots__ = ('metrics', 'name', 'labels', 'in_flight', 'start')
+    
+    def __init__(self, metrics, name, labels, in_flight):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.in_flight = in_flight
+    
+    def __enter__(self):
+        if self.in_flight:
+            self.metrics.inc(self.in_flight)
+        self.start = time.perf_counter()
+    
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.labels)
+        if self.in_flight:
+            self.metrics.inc(self.in_flight, value=-1)
+
+
+def format_labels(*labels):
+    labels = ','.join(label for label in labels if label)
+    return f'{{{labels}}}' if labels else ''
+
+
+metrics = Metrics()
+metrics.counter('bot_updates_total', 'Updates processed, by type')
+metrics.histogram('bot_handler_seconds', 'Time spent in update handlers')
+metrics.histogram('bot_api_request_seconds', 'Bot API call latency per attempt, by method')
+metrics.counter('bot_api_errors_total', 'Failed Bot API attempts, by method')
+metrics.counter('bot_api_rate_limited_total', 'Bot API attempts answered with 429, by method')
+metrics.gauge('bot_api_requests_in_flight', 'Bot API calls waiting for an answer')
+metrics.histogram('bot_db_seconds', 'Database operation latency, by operation')
+metrics.histogram('bot_fraud_check_seconds', 'Fraud list lookup time', LOOKUP_BUCKETS)
+metrics.histogram('bot_http_request_seconds', 'Time to answer HTTP requests, by route')
+metrics.gauge('bot_http_requests_in_flight', 'HTTP requests being handled')
+metrics.gauge('bot_raid_mode', '1 while raid mode is on')
+metrics.counter('bot_flood_dropped_total', 'Unverified messages dropped without a reply, by reason')
+
+
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire.
+
+    `version` moves on every invalidation; a reader that started before a
+    write passes the version it saw to put(), so a stale row it fetched is
+    never cached.
+    """
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        value, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._entries[key]
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def put(self, key, value, version, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if version != self.version:
+            return
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, key):
+        self.version += 1
+        self._entries.pop(key, None)
+    
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+def user_state(row):
+    """Decode a users row (or None) into the flags the handlers use"""
+    verified_until, is_blocked, last_message_at, topic_id = row or (None, 0, None, None)
+    return {
+        'verified': bool(verified_until and verified_until > time.time()),
+        'blocked': bool(is_blocked),
+        'last_message_at': last_message_at,
+        'topic_id': topic_id
+    }
+
+
+def user_cache_ttl(row):
+    """Cache a verified user no longer than their verification lasts"""
+    verified_until = row[0] if row else None
+    if verified_until and verified_until > time.time():
+        return verified_until - time.time()
+    return None
+
+
+def retry_on_locked(func):
+    """Retry a SQLite write that lost a lock race with another writer"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(SQLITE_LOCK_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == SQLITE_LOCK_RETRIES - 1:
+                    raise
+                time.sleep(SQLITE_LOCK_RETRY_DELAY * (attempt + 1))
+    return wrapper
+
+
+def table_columns(conn, table):
+    """Column names of a table, empty if it does not exist yet"""
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def open_connection(db_path):
+    """Open a SQLite connection tuned for many small transactions"""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(f'PRAGMA {pragma}')
+    return conn
+
+
+class Storage(ABC):
+    """Interface AsyncDatabase expects from a storage backend.
+
+    Methods are synchronous and only ever called from the storage thread.
+    A backend missing one fails when it is created, not mid-request.
+    Database (SQLite) is the default; MemoryStorage is a process-local
+    stand-in, and a networked KV store plugs in by implementing the same
+    methods.
+    """
+    
+    migrated = {}
+    
+    @abstractmethod
+    def get(self, key):
+        """Value stored under key, or None if missing or expired"""
+    
+    @abstractmethod
+    def put(self, key, value, ttl=None):
+        """Store a JSON-serializable value, expiring after ttl seconds if set"""
+    
+    @abstractmethod
+    def delete(self, key):
+        """Remove key if present"""
+    
+    @abstractmethod
+    def delete_expired(self, limit):
+        """Delete up to `limit` expired rows per table; returns the number deleted"""
+    
+    def incremental_vacuum(self, pages):
+        pass
+    
+    @abstractmethod
+    def get_user_row(self, chat_id):
+        """(verified_until, is_blocked, last_message_at, topic_id) or None"""
+    
+    @abstractmethod
+    def set_verified(self, chat_id, ttl):
+        """Mark a chat verified for ttl seconds"""
+    
+    @abstractmethod
+    def set_blocked(self, chat_id, blocked):
+        """Block or unblock one chat"""
+    
+    @abstractmethod
+    def set_topic(self, chat_id, topic_id):
+        """Remember a guest's forum topic in ADMIN_GROUP_ID"""
+    
+    @abstractmethod
+    def set_blocked_many(self, chat_ids, blocked):
+        """Block or unblock every chat in one go"""
+    
+    @abstractmethod
+    def verified_between(self, start, end):
+        """Chats whose current verification was granted between start and end"""
+    
+    @abstractmethod
+    def verified_chats(self, after, limit):
+        """Up to `limit` verified, unblocked chat ids above `after`, ascending"""
+    
+    @abstractmethod
+    def count_verified(self):
+        """Number of chats currently verified"""
+    
+    @abstractmethod
+    def get_message_map(self, admin_chat_id, message_id):
+        """Guest chat id a forwarded admin-chat message belongs to, or None"""
+    
+    @abstractmethod
+    def write_batch(self, message_map_rows, last_message_rows):
+        """Store buffered message_map and last-message rows together"""
+    
+    def close(self):
+        pass
+
+
+class Database(Storage):
+    """SQLite storage: kv_store with TTLs plus the typed users and
+    message_map tables.
 
-class Database:
-    """SQLite key-value store with TTL support"""
+    Keeps a single long-lived WAL connection. Not thread-safe on its own;
+    the event loop reaches it through AsyncDatabase.
+    """
     
     def __init__(self, db_path):
         self.db_path = db_path
+        self._conn_obj = None
         self._init_db()
     
+    def _conn(self):
+        if self._conn_obj is None:
+            self._conn_obj = open_connection(self.db_path)
+        return self._conn_obj
+    
+    def close(self):
+        if self._conn_obj is not None:
+            self._conn_obj.close()
+            self._conn_obj = None
+    
     def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS kv_store (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                expires_at INTEGER
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        conn = self._conn()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # Switching an existing file to incremental auto-vacuum needs a VACUUM
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+        with conn:
+            # IMMEDIATE so workers starting together migrate the schema once
+            conn.execute('BEGIN IMMEDIATE')
+            user_columns = table_columns(conn, 'users')
+            if user_columns and 'topic_id' not in user_columns:
+                conn.execute('ALTER TABLE users ADD COLUMN topic_id INTEGER')
+            map_columns = table_columns(conn, 'message_map')
+            legacy_map = map_columns and 'admin_chat_id' not in map_columns
+            if legacy_map:
+                # Message ids are only unique within a chat, so the map is now
+                # keyed by (admin chat, message id)
+                conn.execute('DROP INDEX IF EXISTS message_map_expires_at')
+                conn.execute('ALTER TABLE message_map RENAME TO message_map_v1')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS kv_store (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    expires_at INTEGER
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS kv_store_expires_at
+                ON kv_store (expires_at) WHERE expires_at IS NOT NULL
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    chat_id INTEGER PRIMARY KEY,
+                    verified_until INTEGER,
+                    is_blocked INTEGER NOT NULL DEFAULT 0,
+                    pending_answer TEXT,  -- unused since challenges became stateless
+                    last_message_at REAL,
+                    topic_id INTEGER  -- forum topic in ADMIN_GROUP_ID
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS message_map (
+                    admin_chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    expires_at INTEGER,
+                    PRIMARY KEY (admin_chat_id, message_id)
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS message_map_expires_at
+                ON message_map (expires_at) WHERE expires_at IS NOT NULL
+            ''')
+            if legacy_map:
+                # Everything forwarded before multi-admin routing went to ADMIN_UID
+                conn.execute(
+                    'INSERT OR REPLACE INTO message_map (admin_chat_id, message_id, chat_id, expires_at) '
+                    'SELECT ?, message_id, chat_id, expires_at FROM message_map_v1', (int(ADMIN_UID),)
+                )
+                conn.execute('DROP TABLE message_map_v1')
+        self.migrated = self.migrate_kv_store()
     
     def get(self, key):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT value, expires_at FROM kv_store WHERE key = ?', (key,))
-        row = c.fetchone()
-        conn.close()
+        row = self._conn().execute(
+            'SELECT value, expires_at FROM kv_store WHERE key = ?', (key,)
+        ).fetchone()
         
         if row:
             value, expires_at = row
@@ -76,64 +592,666 @@ class Database:
                 return value
         return None
     
+    @retry_on_locked
     def put(self, key, value, ttl=None):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
         expires_at = int(time.time() + ttl) if ttl else None
         value_str = json.dumps(value) if not isinstance(value, str) else value
-        c.execute(
-            'INSERT OR REPLACE INTO kv_store (key, value, expires_at) VALUES (?, ?, ?)',
-            (key, value_str, expires_at)
-        )
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO kv_store (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value_str, expires_at)
+            )
+    
+    @retry_on_locked
+    def delete(self, key):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM kv_store WHERE key = ?', (key,))
+    
+    @retry_on_locked
+    def delete_expired(self, limit):
+        """Delete up to `limit` expired rows per table; returns the number deleted"""
+        now = int(time.time())
+        deleted = 0
+        with self._conn() as conn:
+            for table in ('kv_store', 'message_map'):
+                deleted += conn.execute(f'''
+                    DELETE FROM {table} WHERE rowid IN (
+                        SELECT rowid FROM {table} WHERE expires_at < ? LIMIT ?
+                    )
+                ''', (now, limit)).rowcount
+            # Users whose verification lapsed, who are not blocked and own no topic
+            deleted += conn.execute('''
+                DELETE FROM users WHERE chat_id IN (
+                    SELECT chat_id FROM users
+                    WHERE COALESCE(verified_until, 0) < ? AND is_blocked = 0
+                    AND topic_id IS NULL LIMIT ?
+                )
+            ''', (now, limit)).rowcount
+        return deleted
+    
+    # Per-user state
+    USER_FIELDS = ('verified_until', 'is_blocked', 'last_message_at', 'topic_id')
+    
+    def get_user_row(self, chat_id):
+        """All state for one chat in a single primary-key lookup"""
+        return self._conn().execute(
+            'SELECT verified_until, is_blocked, last_message_at, topic_id '
+            'FROM users WHERE chat_id = ?', (int(chat_id),)
+        ).fetchone()
+    
+    @retry_on_locked
+    def _set_user(self, chat_id, **fields):
+        columns = [name for name in fields if name in self.USER_FIELDS]
+        assignments = ', '.join(f'{name} = excluded.{name}' for name in columns)
+        with self._conn() as conn:
+            conn.execute(
+                f'INSERT INTO users (chat_id, {", ".join(columns)}) '
+                f'VALUES (?, {", ".join("?" * len(columns))}) '
+                f'ON CONFLICT (chat_id) DO UPDATE SET {assignments}',
+                (int(chat_id), *(fields[name] for name in columns))
+            )
+    
+    def set_verified(self, chat_id, ttl):
+        """Mark a chat verified for ttl seconds"""
+        self._set_user(chat_id, verified_until=int(time.time() + ttl))
+    
+    def set_blocked(self, chat_id, blocked):
+        self._set_user(chat_id, is_blocked=int(bool(blocked)))
+    
+    def set_topic(self, chat_id, topic_id):
+        self._set_user(chat_id, topic_id=int(topic_id))
+    
+    # Bulk operations
+    @retry_on_locked
+    def set_blocked_many(self, chat_ids, blocked):
+        """Block or unblock every chat in one transaction"""
+        with self._conn() as conn:
+            conn.executemany(
+                'INSERT INTO users (chat_id, is_blocked) VALUES (?, ?) '
+                'ON CONFLICT (chat_id) DO UPDATE SET is_blocked = excluded.is_blocked',
+                [(int(chat_id), int(bool(blocked))) for chat_id in chat_ids]
+            )
+    
+    def verified_between(self, start, end):
+        rows = self._conn().execute(
+            'SELECT chat_id FROM users WHERE verified_until BETWEEN ? AND ?',
+            (int(start + VERIFY_TTL), int(end + VERIFY_TTL))
+        ).fetchall()
+        return [str(row[0]) for row in rows]
+    
+    def verified_chats(self, after, limit):
+        # Keyset paging on the primary key; no scan restarts from the top
+        rows = self._conn().execute(
+            'SELECT chat_id FROM users WHERE chat_id > ? AND verified_until > ? AND is_blocked = 0 '
+            'ORDER BY chat_id LIMIT ?', (int(after), int(time.time()), limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+    
+    def count_verified(self):
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM users WHERE verified_until > ? AND is_blocked = 0', (int(time.time()),)
+        ).fetchone()[0]
+    
+    # (admin chat, forwarded message) -> guest chat
+    def get_message_map(self, admin_chat_id, message_id):
+        row = self._conn().execute(
+            'SELECT chat_id, expires_at FROM message_map WHERE admin_chat_id = ? AND message_id = ?',
+            (int(admin_chat_id), int(message_id))
+        ).fetchone()
+        if not row or (row[1] and time.time() > row[1]):
+            return None
+        return str(row[0])
+    
+    @retry_on_locked
+    def write_batch(self, message_map_rows, last_message_rows):
+        """Commit buffered message_map and last-message writes in one transaction"""
+        with self._conn() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO message_map (admin_chat_id, message_id, chat_id, expires_at) '
+                'VALUES (?, ?, ?, ?)',
+                message_map_rows
+            )
+            conn.executemany(
+                'INSERT INTO users (chat_id, last_message_at) VALUES (?, ?) '
+                'ON CONFLICT (chat_id) DO UPDATE SET last_message_at = excluded.last_message_at',
+                last_message_rows
+            )
+    
+    def migrate_kv_store(self):
+        """Move legacy prefixed kv_store keys into users/message_map.
+
+        Safe to run repeatedly; returns the number of rows migrated per kind.
+        """
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT key, value, expires_at FROM kv_store WHERE key GLOB 'verified-*' "
+            "OR key GLOB 'verify-*' OR key GLOB 'isblocked-*' OR key GLOB 'lastmsg-*' "
+            "OR key GLOB 'msg-map-*'"
+        ).fetchall()
+        counts = {'verified': 0, 'verify': 0, 'isblocked': 0, 'lastmsg': 0, 'msg-map': 0}
+        if not rows:
+            return counts
+        
+        now = time.time()
+        with conn:
+            for key, value, expires_at in rows:
+                conn.execute('DELETE FROM kv_store WHERE key = ?', (key,))
+                kind = next(kind for kind in counts if key.startswith(f'{kind}-'))
+                ident = key[len(kind) + 1:]
+                if (expires_at and now > expires_at) or not ident.lstrip('-').isdigit():
+                    continue
+                try:
+                    value = json.loads(value)
+                except (TypeError, ValueError):
+                    pass
+                if kind == 'msg-map':
+                    conn.execute(
+                        'INSERT OR REPLACE INTO message_map (admin_chat_id, message_id, chat_id, expires_at) '
+                        'VALUES (?, ?, ?, ?)',
+                        (int(ADMIN_UID), int(ident), int(value), expires_at)
+                    )
+                else:
+                    if kind == 'verify' or (kind == 'verified' and not value):
+                        # Pending answers are not kept; challenges are stateless now
+                        continue
+                    column, column_value = {
+                        'verified': ('verified_until', expires_at or int(now + VERIFY_TTL)),
+                        'isblocked': ('is_blocked', int(bool(value))),
+                        'lastmsg': ('last_message_at', value)
+                    }[kind]
+                    conn.execute(
+                        f'INSERT INTO users (chat_id, {column}) VALUES (?, ?) '
+                        f'ON CONFLICT (chat_id) DO UPDATE SET {column} = excluded.{column}',
+                        (int(ident), column_value)
+                    )
+                counts[kind] += 1
+        logger.info(f'Migrated kv_store rows: {counts}')
+        return counts
+    
+    def incremental_vacuum(self, pages):
+        # executescript steps the pragma to completion; execute frees one page
+        self._conn().executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+
+
+class MemoryStorage(Storage):
+    """Storage kept in plain dicts; for tests and single-process trials"""
+    
+    def __init__(self):
+        self.kv = {}
+        self.users = {}
+        self.message_map = {}
+    
+    def get(self, key):
+        value, expires_at = self.kv.get(key, (None, None))
+        if expires_at and time.time() > expires_at:
+            del self.kv[key]
+            return None
+        return value
+    
+    def put(self, key, value, ttl=None):
+        self.kv[key] = (value, int(time.time() + ttl) if ttl else None)
     
     def delete(self, key):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('DELETE FROM kv_store WHERE key = ?', (key,))
-        conn.commit()
-        conn.close()
+        self.kv.pop(key, None)
+    
+    def delete_expired(self, limit):
+        now = time.time()
+        deleted = 0
+        for table in (self.kv, self.message_map):
+            expired = [key for key, (_, expires_at) in table.items() if expires_at and expires_at < now]
+            for key in expired[:limit]:
+                del table[key]
+            deleted += min(len(expired), limit)
+        lapsed = [chat_id for chat_id, (verified_until, is_blocked, _, topic_id) in self.users.items()
+                  if (verified_until or 0) < now and not is_blocked and topic_id is None]
+        for chat_id in lapsed[:limit]:
+            del self.users[chat_id]
+        return deleted + min(len(lapsed), limit)
+    
+    def get_user_row(self, chat_id):
+        return self.users.get(int(chat_id))
+    
+    def _update_user(self, chat_id, index, value):
+        row = list(self.users.get(int(chat_id), (None, 0, None, None)))
+        row[index] = value
+        self.users[int(chat_id)] = tuple(row)
+    
+    def set_verified(self, chat_id, ttl):
+        self._update_user(chat_id, 0, int(time.time() + ttl))
+    
+    def set_blocked(self, chat_id, blocked):
+        self._update_user(chat_id, 1, int(bool(blocked)))
+    
+    def set_topic(self, chat_id, topic_id):
+        self._update_user(chat_id, 3, int(topic_id))
+    
+    def set_blocked_many(self, chat_ids, blocked):
+        for chat_id in chat_ids:
+            self.set_blocked(chat_id, blocked)
+    
+    def verified_between(self, start, end):
+        return [str(chat_id) for chat_id, (verified_until, *_) in self.users.items()
+                if verified_until and start + VERIFY_TTL <= verified_until <= end + VERIFY_TTL]
+    
+    def verified_chats(self, after, limit):
+        now = time.time()
+        return sorted(chat_id for chat_id, (verified_until, is_blocked, *_) in self.users.items()
+                      if chat_id > after and (verified_until or 0) > now and not is_blocked)[:limit]
+    
+    def count_verified(self):
+        return len(self.verified_chats(float('-inf'), None))
+    
+    def get_message_map(self, admin_chat_id, message_id):
+        chat_id, expires_at = self.message_map.get((int(admin_chat_id), int(message_id)), (None, None))
+        if chat_id is None or (expires_at and time.time() > expires_at):
+            return None
+        return str(chat_id)
+    
+    def write_batch(self, message_map_rows, last_message_rows):
+        for admin_chat_id, message_id, chat_id, expires_at in message_map_rows:
+            self.message_map[(int(admin_chat_id), int(message_id))] = (int(chat_id), expires_at)
+        for chat_id, timestamp in last_message_rows:
+            self._update_user(chat_id, 2, timestamp)
+
+
+def open_storage(backend, db_path):
+    if backend == 'memory':
+        return MemoryStorage()
+    return Database(db_path)
+
+
+class AsyncDatabase:
+    """Awaitable facade over a Storage backend.
+
+    Every operation runs on one dedicated storage thread, so the event loop
+    never waits on SQLite and the connection is only ever used serially.
+    message_map and last-message writes are buffered and committed in
+    batches; reads consult the buffer first so they never miss a row.
+    """
+    
+    def __init__(self, database):
+        self.database = database
+        self.user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.flushes = 0
+        self.rows_flushed = 0
+        self._executor = None
+        self._pending_map = {}
+        self._pending_last = {}
+        self._flushing_map = {}
+        self._flushing_last = {}
+        self._flush_task = None
+        self._flush_lock = None
+        self._flush_now = None
+    
+    async def _run(self, func, *args, **kwargs):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+        loop = asyncio.get_running_loop()
+        with metrics.timer('bot_db_seconds', f'op="{func.__name__}"'):
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+    
+    async def get(self, key):
+        return await self._run(self.database.get, key)
+    
+    async def put(self, key, value, ttl=None):
+        return await self._run(self.database.put, key, value, ttl=ttl)
+    
+    async def delete(self, key):
+        return await self._run(self.database.delete, key)
+    
+    async def delete_expired(self, limit):
+        return await self._run(self.database.delete_expired, limit)
+    
+    async def incremental_vacuum(self, pages):
+        return await self._run(self.database.incremental_vacuum, pages)
+    
+    async def get_user(self, chat_id):
+        """Per-user flags, served from user_cache without a thread hop on a hit"""
+        key = int(chat_id)
+        row = self.user_cache.get(key)
+        if row is MISSING:
+            version = self.user_cache.version
+            row = await self._run(self.database.get_user_row, key)
+            self.user_cache.put(key, row, version, user_cache_ttl(row))
+        state = user_state(row)
+        last_message_at = self._pending_last.get(key) or self._flushing_last.get(key)
+        if last_message_at:
+            state['last_message_at'] = last_message_at
+        return state
+    
+    async def _set_user(self, func, chat_id, *args, **kwargs):
+        try:
+            return await self._run(func, chat_id, *args, **kwargs)
+        finally:
+            self.user_cache.invalidate(int(chat_id))
+    
+    async def set_verified(self, chat_id, ttl):
+        return await self._set_user(self.database.set_verified, chat_id, ttl)
+    
+    async def set_blocked(self, chat_id, blocked):
+        return await self._set_user(self.database.set_blocked, chat_id, blocked)
+    
+    async def set_topic(self, chat_id, topic_id):
+        return await self._set_user(self.database.set_topic, chat_id, topic_id)
+    
+    async def set_blocked_many(self, chat_ids, blocked):
+        try:
+            return await self._run(self.database.set_blocked_many, chat_ids, blocked)
+        finally:
+            for chat_id in chat_ids:
+                self.user_cache.invalidate(int(chat_id))
+    
+    async def verified_between(self, start, end):
+        return await self._run(self.database.verified_between, start, end)
+    
+    async def verified_chats(self, after, limit):
+        return await self._run(self.database.verified_chats, after, limit)
+    
+    async def count_verified(self):
+        return await self._run(self.database.count_verified)
+    
+    async def set_last_message(self, chat_id, timestamp):
+        self._pending_last[int(chat_id)] = timestamp
+        self._buffered()
+    
+    async def get_message_map(self, admin_chat_id, message_id):
+        key = (int(admin_chat_id), int(message_id))
+        entry = self._pending_map.get(key) or self._flushing_map.get(key)
+        if entry is not None:
+            return str(entry[0])
+        return await self._run(self.database.get_message_map, *key)
+    
+    async def put_message_map(self, admin_chat_id, message_id, chat_id, ttl=None):
+        await self.put_message_maps(admin_chat_id, [message_id], chat_id, ttl)
+    
+    async def put_message_maps(self, admin_chat_id, message_ids, chat_id, ttl=None):
+        """Buffer several ids together; they are committed in the same transaction"""
+        expires_at = int(time.time() + ttl) if ttl else None
+        for message_id in message_ids:
+            self._pending_map[(int(admin_chat_id), int(message_id))] = (int(chat_id), expires_at)
+        self._buffered()
+    
+    # Write-behind buffer
+    def _buffered(self):
+        if self._flush_task is None:
+            if self._flush_lock is None:
+                self._flush_lock = asyncio.Lock()
+                self._flush_now = asyncio.Event()
+            self._flush_task = asyncio.create_task(self._flush_later())
+        elif len(self._pending_map) + len(self._pending_last) >= WRITE_BEHIND_MAX_ROWS:
+            self._flush_now.set()
+    
+    async def _flush_later(self):
+        try:
+            await asyncio.wait_for(self._flush_now.wait(), WRITE_BEHIND_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        self._flush_now.clear()
+        self._flush_task = None
+        await self.flush()
+    
+    async def flush(self):
+        """Commit everything buffered so far in a single transaction"""
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            if not self._pending_map and not self._pending_last:
+                return
+            self._flushing_map, self._pending_map = self._pending_map, {}
+            self._flushing_last, self._pending_last = self._pending_last, {}
+            map_rows = [(*key, chat_id, expires_at)
+                        for key, (chat_id, expires_at) in self._flushing_map.items()]
+            last_rows = list(self._flushing_last.items())
+            try:
+                await self._run(self.database.write_batch, map_rows, last_rows)
+                self.flushes += 1
+                self.rows_flushed += len(map_rows) + len(last_rows)
+            except sqlite3.Error as e:
+                logger.error(f'Write-behind flush failed, will retry: {e}')
+                self._pending_map = {**self._flushing_map, **self._pending_map}
+                self._pending_last = {**self._flushing_last, **self._pending_last}
+            finally:
+                for chat_id in self._flushing_last:
+                    self.user_cache.invalidate(chat_id)
+                self._flushing_map = {}
+                self._flushing_last = {}
+    
+    def write_behind_stats(self):
+        return {
+            'pending': len(self._pending_map) + len(self._pending_last),
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed
+        }
+    
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        if self._executor is not None:
+            await self._run(self.database.close)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+db = AsyncDatabase(open_storage(STORAGE_BACKEND, DB_PATH))
+
+
+class ExpirySweeper:
+    """Deletes expired rows in bounded batches and reclaims pages.
+
+    Each batch is its own storage call, so regular reads and writes are
+    interleaved with a long sweep instead of waiting behind it.
+    """
+    
+    def __init__(self, database):
+        self.database = database
+        self.runs = 0
+        self.rows_reclaimed = 0
+        self.last_reclaimed = 0
+        self.last_run = 0
+    
+    async def sweep(self):
+        reclaimed = 0
+        for _ in range(SWEEP_MAX_BATCHES):
+            deleted = await self.database.delete_expired(SWEEP_BATCH_SIZE)
+            reclaimed += deleted
+            if deleted < SWEEP_BATCH_SIZE:
+                break
+        if reclaimed:
+            await self.database.incremental_vacuum(SWEEP_VACUUM_PAGES)
+        self.runs += 1
+        self.rows_reclaimed += reclaimed
+        self.last_reclaimed = reclaimed
+        self.last_run = time.time()
+        return reclaimed
+    
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'rows_reclaimed': self.rows_reclaimed,
+            'last_reclaimed': self.last_reclaimed,
+            'last_run': self.last_run
+        }
+
+
+sweeper = ExpirySweeper(db)
+
+
+# Outbound rate limiting
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+    
+    def try_acquire(self, reserve=0):
+        """Take a token if more than `reserve` remain, else return seconds to wait"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= reserve + 1:
+            self.tokens -= 1
+            return 0
+        return (reserve + 1 - self.tokens) / self.rate
+    
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """Global and per-chat token buckets for outbound messages"""
+    
+    def __init__(self, global_rate, chat_rate, chat_burst):
+        # Below one token of capacity a bucket can never hand one out
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = max(chat_burst, 1)
+        self.chat_buckets = OrderedDict()
+    
+    def _chat_bucket(self, chat_id):
+        chat_id = str(chat_id)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self.chat_buckets) > MAX_CHAT_BUCKETS:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+    
+    async def acquire(self, chat_id, priority=PRIORITY_NORMAL):
+        bucket = self._chat_bucket(chat_id)
+        while True:
+            wait = bucket.try_acquire()
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+        reserve = self.lane_reserve(priority)
+        while True:
+            wait = self.global_bucket.try_acquire(reserve)
+            if not wait:
+                break
+            await asyncio.sleep(wait)
+    
+    def lane_reserve(self, priority):
+        """Tokens a lane must leave in the global bucket.
+
+        Capped at capacity - 1, so at low rates every lane can still reach
+        a token; the lower lanes then wait for a full bucket.
+        """
+        capacity = self.global_bucket.capacity
+        return min(capacity * LANE_RESERVE[priority], capacity - 1)
+    
+    def block(self, chat_id, seconds):
+        """Honor a 429 retry_after for one chat, or globally without one"""
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+        bucket.block(seconds)
+
 
+# The global budget is split between worker processes
+rate_limiter = RateLimiter(API_GLOBAL_RATE / WORKERS, API_CHAT_RATE, API_CHAT_BURST)
 
-db = Database(DB_PATH)
+
+def retry_delay(attempt):
+    return API_RETRY_BASE * 2 ** attempt * random.uniform(0.5, 1.5)
 
 
 # Telegram API functions
-async def api_request(session, method, data=None):
-    url = f'https://api.telegram.org/bot{BOT_TOKEN}/{method}'
-    try:
-        async with session.post(url, json=data) as resp:
-            result = await resp.json()
-            if not result.get('ok'):
-                logger.error(f'API error: {result}')
-            return result
-    except Exception as e:
-        logger.error(f'API request failed: {e}')
-        return {'ok': False, 'error': str(e)}
+async def api_request(session, method, data=None, timeout=None, priority=PRIORITY_NORMAL):
+    """Call a Bot API method under the rate limiter.
+
+    429s wait for retry_after, 5xx and network errors are retried with
+    jittered backoff; other errors are returned immediately.
+    """
+    url = f'{TELEGRAM_API_URL}/bot{BOT_TOKEN}/{method}'
+    kwargs = {'timeout': ClientTimeout(total=timeout)} if timeout else {}
+    chat_id = data.get('chat_id') if data else None
+    labels = f'method="{method}"'
+    for attempt in range(API_MAX_RETRIES + 1):
+        if chat_id is not None:
+            await rate_limiter.acquire(chat_id, priority)
+        try:
+            with metrics.timer('bot_api_request_seconds', labels, 'bot_api_requests_in_flight'):
+                async with session.post(url, json=data, **kwargs) as resp:
+                    result = await resp.json(loads=json_loads)
+        except Exception as e:
+            logger.error(f'API request failed: {e}')
+            metrics.inc('bot_api_errors_total', labels)
+            result = {'ok': False, 'error': str(e)}
+            delay = retry_delay(attempt)
+        else:
+            if result.get('ok'):
+                return result
+            logger.error(f'API error: {result}')
+            metrics.inc('bot_api_errors_total', labels)
+            error_code = result.get('error_code', 0)
+            if error_code == 429:
+                metrics.inc('bot_api_rate_limited_total', labels)
+                delay = result.get('parameters', {}).get('retry_after', 1)
+                rate_limiter.block(chat_id, delay)
+            elif error_code >= 500:
+                delay = retry_delay(attempt)
+            else:
+                return result
+        if attempt < API_MAX_RETRIES:
+            await asyncio.sleep(delay)
+    return result
 
 
-async def send_message(session, chat_id, text, reply_markup=None):
+async def send_message(session, chat_id, text, reply_markup=None, priority=PRIORITY_NORMAL, thread_id=None):
     data = {'chat_id': chat_id, 'text': text}
     if reply_markup:
         data['reply_markup'] = reply_markup
-    return await api_request(session, 'sendMessage', data)
+    if thread_id:
+        data['message_thread_id'] = thread_id
+    return await api_request(session, 'sendMessage', data, priority=priority)
 
 
-async def copy_message(session, chat_id, from_chat_id, message_id):
+async def copy_message(session, chat_id, from_chat_id, message_id, priority=PRIORITY_HIGH):
     return await api_request(session, 'copyMessage', {
         'chat_id': chat_id,
         'from_chat_id': from_chat_id,
         'message_id': message_id
-    })
+    }, priority=priority)
 
 
-async def forward_message(session, chat_id, from_chat_id, message_id):
-    return await api_request(session, 'forwardMessage', {
+async def forward_message(session, chat_id, from_chat_id, message_id, thread_id=None):
+    data = {
         'chat_id': chat_id,
         'from_chat_id': from_chat_id,
         'message_id': message_id
-    })
+    }
+    if thread_id:
+        data['message_thread_id'] = thread_id
+    return await api_request(session, 'forwardMessage', data)
+
+
+async def forward_messages(session, chat_id, from_chat_id, message_ids, thread_id=None):
+    """Forward an album in one call; message_ids must be ascending"""
+    data = {
+        'chat_id': chat_id,
+        'from_chat_id': from_chat_id,
+        'message_ids': message_ids
+    }
+    if thread_id:
+        data['message_thread_id'] = thread_id
+    return await api_request(session, 'forwardMessages', data)
+
+
+async def copy_messages(session, chat_id, from_chat_id, message_ids, priority=PRIORITY_HIGH):
+    """Copy an album in one call; message_ids must be ascending"""
+    return await api_request(session, 'copyMessages', {
+        'chat_id': chat_id,
+        'from_chat_id': from_chat_id,
+        'message_ids': message_ids
+    }, priority=priority)
 
 
 async def edit_message_text(session, chat_id, message_id, text):
@@ -153,26 +1271,29 @@ async def answer_callback_query(session, callback_query_id, text, show_alert=Fal
 
 
 # Math verification
+challenge_rng = secrets.SystemRandom()
+
+
 def generate_math_problem():
     """Generate math problem with answer <= 100"""
     operators = ['+', '-', '*', '/']
-    operator = random.choice(operators)
+    operator = challenge_rng.choice(operators)
     
     if operator == '+':
-        a = random.randint(1, 50)
-        b = random.randint(1, 50)
+        a = challenge_rng.randint(1, 50)
+        b = challenge_rng.randint(1, 50)
         answer = a + b
     elif operator == '-':
-        a = random.randint(1, 100)
-        b = random.randint(0, a)
+        a = challenge_rng.randint(1, 100)
+        b = challenge_rng.randint(0, a)
         answer = a - b
     elif operator == '*':
-        a = random.randint(1, 10)
-        b = random.randint(1, 10)
+        a = challenge_rng.randint(1, 10)
+        b = challenge_rng.randint(1, 10)
         answer = a * b
     else:  # division
-        b = random.randint(1, 9)
-        answer = random.randint(1, 10)
+        b = challenge_rng.randint(1, 9)
+        answer = challenge_rng.randint(1, 10)
         a = answer * b
     
     if answer > 100:
@@ -186,26 +1307,459 @@ def generate_options(correct_answer):
     """Generate 4 options including the correct answer"""
     options = [correct_answer]
     while len(options) < 4:
-        wrong = correct_answer + random.randint(-10, 10)
+        wrong = correct_answer + challenge_rng.randint(-10, 10)
         if wrong != correct_answer and wrong not in options and wrong > 0:
             options.append(wrong)
-    random.shuffle(options)
+    challenge_rng.shuffle(options)
     return options
 
 
+class ChallengePool:
+    """Pre-generated verification questions, ready to send.
+
+    Each entry holds the message text, the answer, the options and the
+    inline keyboard already serialized to JSON with %s slots for the
+    per-chat signed callback_data, so the hot path only fills in four
+    tokens. When it runs low it is topped up from a loop callback, after
+    the handler that drained it has yielded.
+    """
+    
+    def __init__(self, size):
+        self.size = size
+        self._entries = deque()
+        self._refilling = False
+        self.refill()
+    
+    @staticmethod
+    def _build():
+        problem = generate_math_problem()
+        answer = int(problem['answer'])
+        options = generate_options(answer)
+        buttons = [{'text': str(option), 'callback_data': '%s'} for option in options]
+        markup_template = json.dumps({'inline_keyboard': [buttons[:2], buttons[2:]]})
+        text = f'Please answer the following question to verify you are not a bot:\n\n{problem["question"]} = ?'
+        return text, answer, options, markup_template
+    
+    def refill(self):
+        while len(self._entries) < self.size:
+            self._entries.append(self._build())
+        self._refilling = False
+    
+    def _schedule_refill(self):
+        if not self._refilling:
+            self._refilling = True
+            asyncio.get_running_loop().call_soon(self.refill)
+    
+    def take(self):
+        """Return (text, answer, options, markup_template)"""
+        if len(self._entries) < self.size // 4:
+            self._schedule_refill()
+        try:
+            return self._entries.popleft()
+        except IndexError:
+            return self._build()
+
+
+challenge_pool = ChallengePool(CHALLENGE_POOL_SIZE)
+
+
 # Fraud detection
-async def is_fraud(session, user_id):
+class FraudList:
+    """Set of fraudulent user IDs kept in memory and refreshed in the background.
+
+    The list is persisted to cache_path so a restart can serve lookups
+    before the network is reachable; refreshes use ETag/If-Modified-Since
+    so an unchanged list costs a 304.
+    """
+    
+    def __init__(self, url, cache_path):
+        self.url = url
+        self.cache_path = cache_path
+        self.ids = frozenset()
+        self.etag = None
+        self.last_modified = None
+        self.updated_at = 0
+        self._load_cache()
+    
+    def __contains__(self, user_id):
+        return str(user_id) in self.ids
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    @staticmethod
+    def _parse(text):
+        return frozenset(line.strip() for line in text.split('\n') if line.strip())
+    
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                self.ids = self._parse(f.read())
+            with open(self.cache_path + '.meta', encoding='utf-8') as f:
+                meta = json.load(f)
+            self.etag = meta.get('etag')
+            self.last_modified = meta.get('last_modified')
+            self.updated_at = meta.get('updated_at', 0)
+        except (OSError, ValueError):
+            pass
+    
+    def _store_cache(self, text):
+        meta = {
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'updated_at': self.updated_at
+        }
+        try:
+            for path, content in ((self.cache_path, text), (self.cache_path + '.meta', json.dumps(meta))):
+                # A temp file of our own: every worker refreshes at startup
+                fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        f.write(content)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+        except OSError as e:
+            logger.error(f'Failed to persist fraud list: {e}')
+    
+    def _request_headers(self):
+        headers = {'User-Agent': 'TelegramBot/1.0'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+    
+    def _apply(self, status, headers, text):
+        """Swap in a freshly downloaded list; returns True if it changed"""
+        self.updated_at = time.time()
+        if status == 304:
+            return False
+        self.ids = self._parse(text)
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+        self._store_cache(text)
+        logger.info(f'Fraud list updated: {len(self.ids)} entries')
+        return True
+    
+    async def refresh(self, session):
+        try:
+            async with session.get(self.url, headers=self._request_headers()) as resp:
+                if resp.status not in (200, 304):
+                    logger.error(f'Fraud list refresh failed: HTTP {resp.status}')
+                    return False
+                text = await resp.text() if resp.status == 200 else None
+                return self._apply(resp.status, resp.headers, text)
+        except Exception as e:
+            logger.error(f'Fraud list refresh failed: {e}')
+            return False
+
+
+fraud_list = FraudList(FRAUD_DB_URL, FRAUD_CACHE_PATH)
+
+
+def is_fraud(user_id):
     """Check if user is in fraud database"""
+    start = time.perf_counter()
+    found = user_id in fraud_list
+    metrics.observe('bot_fraud_check_seconds', time.perf_counter() - start)
+    return found
+
+
+# Signed verification challenges
+def challenge_signature(chat_id, option, expires, correct):
+    mac = CHALLENGE_MAC.copy()
+    mac.update(f'{chat_id}:{option}:{expires}:{int(correct)}'.encode())
+    return base64.urlsafe_b64encode(mac.digest()[:12]).decode()
+
+
+def challenge_callback_data(chat_id, option, answer, expires):
+    """Signed, expiring button payload (~36 bytes; Telegram allows 64).
+
+    Whether the option is correct is only part of the signed message, so the
+    payload does not reveal the answer.
+    """
+    signature = challenge_signature(chat_id, option, expires, option == answer)
+    return f'verify_{option}_{expires:x}_{signature}'
+
+
+def check_challenge(chat_id, data):
+    """True/False for a right/wrong answer, None if forged or expired"""
+    parts = data.split('_', 3)
+    if len(parts) != 4:
+        return None
+    _, option, expires, signature = parts
     try:
-        async with session.get(FRAUD_DB_URL) as resp:
-            text = await resp.text()
-            fraud_list = [line.strip() for line in text.split('\n') if line.strip()]
-            return str(user_id) in fraud_list
-    except:
-        return False
+        expires = int(expires, 16)
+    except ValueError:
+        return None
+    if time.time() > expires:
+        return None
+    for correct in (True, False):
+        if hmac.compare_digest(signature, challenge_signature(chat_id, option, expires, correct)):
+            return correct
+    return None
+
+
+# Chats that were sent a challenge recently get a reminder instead of a new one
+recent_challenges = TTLCache(USER_CACHE_SIZE, CHALLENGE_TTL)
+
+
+class FloodGuard:
+    """Sliding-window counters for messages from unverified chats.
+
+    The global rate is counted in one-second slots over RAID_WINDOW. Raid
+    mode starts when it reaches `threshold` per second and ends once it has
+    stayed under half that for RAID_COOLDOWN seconds. Per-chat windows keep
+    the times of each chat's last reminders, bounded like the rate limiter's
+    buckets.
+    """
+    
+    def __init__(self, threshold, challenge_rate):
+        self.threshold = threshold
+        self.raid = False
+        self.raids = 0
+        self.dropped = {'raid': 0, 'challenge': 0, 'reminder': 0}
+        self._slots = [0] * RAID_WINDOW
+        self._slot_seconds = [0] * RAID_WINDOW
+        self._busy_at = 0
+        self._reminders = OrderedDict()
+        self._challenges = TokenBucket(challenge_rate, max(challenge_rate, 1))
+    
+    def rate(self, now=None):
+        """Unverified messages per second over the last RAID_WINDOW seconds"""
+        second = int(time.monotonic() if now is None else now)
+        total = sum(count for count, at in zip(self._slots, self._slot_seconds) if second - at < RAID_WINDOW)
+        return total / RAID_WINDOW
+    
+    def record(self):
+        """Count one unverified message; returns whether raid mode is on"""
+        now = time.monotonic()
+        second = int(now)
+        slot = second % RAID_WINDOW
+        if self._slot_seconds[slot] != second:
+            self._slot_seconds[slot] = second
+            self._slots[slot] = 0
+        self._slots[slot] += 1
+        
+        rate = self.rate(now)
+        if rate >= self.threshold / 2:
+            self._busy_at = now
+            if rate >= self.threshold and not self.raid:
+                self.raid = True
+                self.raids += 1
+                metrics.inc('bot_raid_mode')
+                logger.warning(f'Raid mode on: {rate:.0f} unverified messages/s')
+        elif self.raid and now - self._busy_at >= RAID_COOLDOWN:
+            self.raid = False
+            metrics.inc('bot_raid_mode', value=-1)
+            logger.warning(f'Raid mode off after dropping {self.dropped}')
+        return self.raid
+    
+    def allow_challenge(self):
+        """New challenges are rationed while a raid is on"""
+        return not self.raid or self._challenges.try_acquire() == 0
+    
+    def allow_reminder(self, chat_id):
+        """At most CHAT_REMINDER_LIMIT reminders per chat per CHAT_REMINDER_WINDOW"""
+        now = time.monotonic()
+        sent = self._reminders.get(chat_id)
+        if sent is None:
+            sent = self._reminders[chat_id] = deque(maxlen=CHAT_REMINDER_LIMIT)
+            if len(self._reminders) > MAX_CHAT_BUCKETS:
+                self._reminders.popitem(last=False)
+        else:
+            self._reminders.move_to_end(chat_id)
+        if len(sent) == CHAT_REMINDER_LIMIT and now - sent[0] < CHAT_REMINDER_WINDOW:
+            return False
+        sent.append(now)
+        return True
+    
+    def drop(self, reason):
+        self.dropped[reason] += 1
+        metrics.inc('bot_flood_dropped_total', f'reason="{reason}"')
+    
+    def stats(self):
+        return {
+            'raid': self.raid,
+            'unverified_per_second': round(self.rate(), 1),
+            'raids': self.raids,
+            'dropped': dict(self.dropped)
+        }
+
+
+# Each worker only sees the chats it owns
+flood_guard = FloodGuard(RAID_THRESHOLD / WORKERS, RAID_CHALLENGE_RATE / WORKERS)
+
+
+# Admin routing
+def ring_hash(key):
+    """Stable 64-bit hash; hash() is salted per process"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hashing of guest chats onto admin chats.
+
+    Each admin owns `replicas` points on the ring, so adding or removing one
+    only moves the guests whose points it takes over or gives up.
+    """
+    
+    def __init__(self, nodes, replicas=ADMIN_RING_REPLICAS):
+        points = sorted((ring_hash(f'{node}#{i}'), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+    
+    def get(self, key):
+        index = bisect_left(self._hashes, ring_hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+admin_ring = HashRing(ADMIN_UIDS)
+ADMIN_CHATS = frozenset([*ADMIN_UIDS, ADMIN_GROUP_ID] if ADMIN_GROUP_ID else ADMIN_UIDS)
+
+
+def admin_chat_for(chat_id):
+    """Admin chat a guest's messages are forwarded to"""
+    return ADMIN_GROUP_ID or admin_ring.get(chat_id)
+
+
+class KeyedLock:
+    """One asyncio.Lock per key, dropped once nobody holds or awaits it"""
+    
+    def __init__(self):
+        self._locks = {}  # key -> [lock, holders and waiters]
+    
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+    
+    def __len__(self):
+        return len(self._locks)
+
+
+topic_locks = KeyedLock()
+
+
+async def admin_topic_for(session, chat_id, message, user):
+    """Guest's forum topic in ADMIN_GROUP_ID, created on first contact"""
+    if user['topic_id']:
+        return user['topic_id']
+    # A guest's first messages arrive together; only one of them creates the topic
+    async with topic_locks.hold(int(chat_id)):
+        user = await db.get_user(chat_id)
+        if user['topic_id']:
+            return user['topic_id']
+        sender = message.get('from', {})
+        name = ' '.join(filter(None, (sender.get('first_name'), sender.get('last_name'))))
+        result = await api_request(session, 'createForumTopic', {
+            'chat_id': ADMIN_GROUP_ID,
+            'name': f'{name[:100]} ({chat_id})'.lstrip()
+        })
+        if not result.get('ok'):
+            return None  # forward into the General topic instead
+        topic_id = result['result']['message_thread_id']
+        await db.set_topic(chat_id, topic_id)
+        # Messages in a topic reply to its creation message, so they map to the guest
+        await db.put_message_map(ADMIN_GROUP_ID, topic_id, chat_id)
+        return topic_id
+
+
+async def resolve_guest(message):
+    """Guest an admin message is about: the forward it replies to, else its topic"""
+    admin_chat_id = message.get('chat', {}).get('id')
+    reply_to = message.get('reply_to_message')
+    guest_chat_id = None
+    if reply_to:
+        guest_chat_id = await db.get_message_map(admin_chat_id, reply_to.get('message_id'))
+    if guest_chat_id is None and message.get('is_topic_message'):
+        guest_chat_id = await db.get_message_map(admin_chat_id, message.get('message_thread_id'))
+    return guest_chat_id
+
+
+async def reply_admin(session, message, text):
+    """Answer an admin in the chat, and forum topic, the command came from"""
+    thread_id = message.get('message_thread_id') if message.get('is_topic_message') else None
+    return await send_message(session, message.get('chat', {}).get('id'), text, thread_id=thread_id)
+
+
+class MediaGroupBuffer:
+    """Collects the items of an album so they are sent on with one API call.
+
+    Telegram delivers every album item as its own update carrying the same
+    media_group_id. The first item opens a group and schedules its flush
+    `window` seconds later; items arriving before then join it, and the
+    callback gets the whole group in message_id order. Handlers return as
+    soon as an item is buffered.
+    """
+    
+    def __init__(self, window):
+        self.window = window
+        self.groups = {}
+        self.batches = 0
+        self.messages = 0
+        self._tasks = set()
+    
+    def add(self, message, callback):
+        key = (message['chat']['id'], message['media_group_id'])
+        group = self.groups.get(key)
+        if group is not None:
+            group.append(message)
+            return
+        self.groups[key] = [message]
+        task = asyncio.create_task(self._flush_later(key, callback))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _flush_later(self, key, callback):
+        await asyncio.sleep(self.window)
+        messages = sorted(self.groups.pop(key), key=lambda m: m['message_id'])
+        self.batches += 1
+        self.messages += len(messages)
+        try:
+            await callback(messages)
+        except Exception as e:
+            logger.error(f'Error sending media group {key[1]}: {e}')
+    
+    async def drain(self):
+        """Wait for open groups to be sent; each is at most `window` away"""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+    
+    def stats(self):
+        return {'open': len(self.groups), 'batches': self.batches, 'messages': self.messages}
+
+
+media_groups = MediaGroupBuffer(MEDIA_GROUP_WINDOW)
+
+
+async def reply_to_guest(session, messages):
+    """Copy an admin reply, one message or an album, to the guest it answers"""
+    message = messages[0]
+    admin_chat_id = message['chat']['id']
+    for item in messages:
+        guest_chat_id = await resolve_guest(item)
+        if guest_chat_id:
+            break
+    else:
+        if str(admin_chat_id) == ADMIN_GROUP_ID and not message.get('is_topic_message'):
+            return  # an album shared in the General topic
+        return await reply_admin(session, message, 'Cannot find corresponding user')
+    if len(messages) == 1:
+        return await copy_message(session, guest_chat_id, admin_chat_id, message['message_id'])
+    return await copy_messages(session, guest_chat_id, admin_chat_id, [item['message_id'] for item in messages])
 
 
 # Message handlers
+@metrics.timed('bot_handler_seconds', 'handler')
 async def handle_message(session, message):
     chat_id = str(message.get('chat', {}).get('id', ''))
     text = message.get('text', '')
@@ -219,13 +1773,26 @@ async def handle_message(session, message):
         )
     
     # Admin commands
-    if chat_id == ADMIN_UID:
-        reply_to = message.get('reply_to_message')
-        if not reply_to:
-            return await send_message(
-                session, ADMIN_UID,
+    if chat_id in ADMIN_CHATS:
+        command, *args = text.split(None, 1) or ['']
+        if command in ('/block', '/unblock') and args:
+            return await handle_bulk_block(session, message, command, args[0].replace(',', ' ').split())
+        if command == '/broadcast':
+            return await handle_broadcast(session, message, args[0].strip() if args else '')
+        
+        # Album items may not all carry the reply, so they are resolved as a group
+        if message.get('media_group_id'):
+            return media_groups.add(message, partial(reply_to_guest, session))
+        
+        if not message.get('reply_to_message') and not message.get('is_topic_message'):
+            if chat_id == ADMIN_GROUP_ID:
+                return  # admins talking in the General topic
+            return await reply_admin(
+                session, message,
                 'Usage: Reply to a forwarded message and send your reply, '
-                'or use `/block`, `/unblock`, `/checkblock` commands'
+                'or use `/block`, `/unblock`, `/checkblock` commands.\n'
+                '`/block <uid> ...` or `/block recent 30m` blocks many users at once, '
+                '`/broadcast <text>` messages every verified user'
             )
         
         if text == '/block':
@@ -236,85 +1803,101 @@ async def handle_message(session, message):
             return await check_block(session, message)
         
         # Reply to user
-        guest_chat_id = db.get(f'msg-map-{reply_to.get("message_id")}')
-        if guest_chat_id:
-            return await copy_message(session, guest_chat_id, chat_id, message.get('message_id'))
-        return await send_message(session, ADMIN_UID, 'Cannot find corresponding user')
+        return await reply_to_guest(session, [message])
     
     # Regular user
     return await handle_guest_message(session, message)
 
 
+@metrics.timed('bot_handler_seconds', 'handler')
 async def handle_guest_message(session, message):
     chat_id = str(message.get('chat', {}).get('id', ''))
+    challenged = recent_challenges.get(int(chat_id)) is not MISSING
+    
+    # In a raid, chats with a challenge outstanding are dropped before any DB or API work
+    if challenged and flood_guard.record():
+        flood_guard.drop('raid')
+        return
+    
+    user = await db.get_user(chat_id)
     
     # Check if blocked
-    if db.get(f'isblocked-{chat_id}'):
+    if user['blocked']:
         return await send_message(session, chat_id, 'You are blocked')
     
     # Check verification status
-    verified = db.get(f'verified-{chat_id}')
-    if not verified:
-        expected = db.get(f'verify-{chat_id}')
-        
-        if not expected:
-            # Generate verification problem
-            problem = generate_math_problem()
-            db.put(f'verify-{chat_id}', problem['answer'])
+    if not user['verified']:
+        if not challenged:
+            if flood_guard.record() and not flood_guard.allow_challenge():
+                flood_guard.drop('challenge')
+                return
+            
+            # Take a pre-generated problem and sign its buttons for this chat
+            text, answer, options, markup_template = challenge_pool.take()
+            recent_challenges.put(int(chat_id), True, recent_challenges.version)
             
-            options = generate_options(int(problem['answer']))
-            keyboard = {
-                'inline_keyboard': [
-                    [
-                        {'text': str(options[0]), 'callback_data': f'verify_{options[0]}_{problem["answer"]}'},
-                        {'text': str(options[1]), 'callback_data': f'verify_{options[1]}_{problem["answer"]}'}
-                    ],
-                    [
-                        {'text': str(options[2]), 'callback_data': f'verify_{options[2]}_{problem["answer"]}'},
-                        {'text': str(options[3]), 'callback_data': f'verify_{options[3]}_{problem["answer"]}'}
-                    ]
-                ]
-            }
+            expires = int(time.time()) + CHALLENGE_TTL
+            reply_markup = markup_template % tuple(
+                challenge_callback_data(chat_id, option, answer, expires) for option in options
+            )
             
             return await send_message(
-                session, chat_id,
-                f'Please answer the following question to verify you are not a bot:\n\n{problem["question"]} = ?',
-                reply_markup=keyboard
+                session, chat_id, text,
+                reply_markup=reply_markup,
+                priority=PRIORITY_LOW
             )
+        elif not flood_guard.allow_reminder(int(chat_id)):
+            flood_guard.drop('reminder')
+            return
         else:
-            return await send_message(session, chat_id, 'Please click the button above to select your answer')
+            return await send_message(
+                session, chat_id, 'Please click the button above to select your answer',
+                priority=PRIORITY_LOW
+            )
     
     # Fraud check
-    if await is_fraud(session, chat_id):
-        return await send_message(session, ADMIN_UID, f'Warning: Fraud detected\nUID: {chat_id}')
-    
-    # Forward message to admin
-    forward_result = await forward_message(
-        session, ADMIN_UID,
-        message.get('chat', {}).get('id'),
-        message.get('message_id')
-    )
+    if is_fraud(chat_id):
+        return await send_message(session, admin_chat_for(chat_id), f'Warning: Fraud detected\nUID: {chat_id}')
     
-    if forward_result.get('ok'):
-        db.put(
-            f'msg-map-{forward_result["result"]["message_id"]}',
-            chat_id,
-            ttl=2592000  # 30 days
+    # Album items are collected and forwarded together
+    if message.get('media_group_id'):
+        return media_groups.add(message, partial(forward_to_admin, session, chat_id, user))
+    return await forward_to_admin(session, chat_id, user, [message])
+
+
+async def forward_to_admin(session, chat_id, user, messages):
+    """Forward a guest message, or a whole album in one call, to their admin chat"""
+    admin_chat_id = admin_chat_for(chat_id)
+    topic_id = await admin_topic_for(session, chat_id, messages[0], user) if ADMIN_GROUP_ID else None
+    from_chat_id = messages[0]['chat']['id']
+    if len(messages) == 1:
+        forward_result = await forward_message(
+            session, admin_chat_id, from_chat_id, messages[0]['message_id'], thread_id=topic_id
         )
+        forwarded_ids = [forward_result['result']['message_id']] if forward_result.get('ok') else []
+    else:
+        forward_result = await forward_messages(
+            session, admin_chat_id, from_chat_id, [m['message_id'] for m in messages], thread_id=topic_id
+        )
+        forwarded_ids = [m['message_id'] for m in forward_result['result']] if forward_result.get('ok') else []
+    
+    if forwarded_ids:
+        await db.put_message_maps(admin_chat_id, forwarded_ids, chat_id, ttl=2592000)  # 30 days
         
         # Notification feature
         if ENABLE_NOTIFICATION:
-            last_msg_time = db.get(f'lastmsg-{chat_id}')
+            last_msg_time = user['last_message_at']
             if not last_msg_time or time.time() - last_msg_time > NOTIFY_INTERVAL:
-                db.put(f'lastmsg-{chat_id}', time.time())
+                await db.set_last_message(chat_id, time.time())
                 try:
                     async with session.get(NOTIFICATION_URL) as resp:
                         notification = await resp.text()
-                        await send_message(session, ADMIN_UID, notification)
+                        await send_message(session, admin_chat_id, notification, thread_id=topic_id)
                 except:
                     pass
 
 
+@metrics.timed('bot_handler_seconds', 'handler')
 async def handle_callback_query(session, callback_query):
     user_id = str(callback_query.get('from', {}).get('id', ''))
     data = callback_query.get('data', '')
@@ -324,15 +1907,17 @@ async def handle_callback_query(session, callback_query):
     if not data.startswith('verify_'):
         return
     
-    parts = data.split('_')
-    if len(parts) != 3:
-        return
-    
-    _, user_answer, correct_answer = parts
+    correct = check_challenge(user_id, data)
+    if correct is None:
+        return await answer_callback_query(
+            session, callback_query_id,
+            'This question is no longer valid, send a message to get a new one',
+            show_alert=True
+        )
     
-    if user_answer == correct_answer:
-        db.put(f'verified-{user_id}', True, ttl=259200)  # 3 days
-        db.delete(f'verify-{user_id}')
+    if correct:
+        await db.set_verified(user_id, ttl=VERIFY_TTL)
+        recent_challenges.invalidate(int(user_id))
         
         await edit_message_text(
             session, user_id, message_id,
@@ -347,40 +1932,528 @@ async def handle_callback_query(session, callback_query):
 
 
 async def handle_block(session, message):
-    reply_to = message.get('reply_to_message')
-    guest_chat_id = db.get(f'msg-map-{reply_to.get("message_id")}')
+    guest_chat_id = await resolve_guest(message)
     
     if not guest_chat_id:
-        return await send_message(session, ADMIN_UID, 'Cannot find corresponding user')
+        return await reply_admin(session, message, 'Cannot find corresponding user')
     
-    if guest_chat_id == ADMIN_UID:
-        return await send_message(session, ADMIN_UID, 'Cannot block yourself')
+    if guest_chat_id in ADMIN_CHATS:
+        return await reply_admin(session, message, 'Cannot block yourself')
     
-    db.put(f'isblocked-{guest_chat_id}', True)
-    return await send_message(session, ADMIN_UID, f'UID:{guest_chat_id} blocked successfully')
+    await db.set_blocked(guest_chat_id, True)
+    return await reply_admin(session, message, f'UID:{guest_chat_id} blocked successfully')
 
 
 async def handle_unblock(session, message):
-    reply_to = message.get('reply_to_message')
-    guest_chat_id = db.get(f'msg-map-{reply_to.get("message_id")}')
+    guest_chat_id = await resolve_guest(message)
     
     if not guest_chat_id:
-        return await send_message(session, ADMIN_UID, 'Cannot find corresponding user')
+        return await reply_admin(session, message, 'Cannot find corresponding user')
     
-    db.put(f'isblocked-{guest_chat_id}', False)
-    return await send_message(session, ADMIN_UID, f'UID:{guest_chat_id} unblocked successfully')
+    await db.set_blocked(guest_chat_id, False)
+    return await reply_admin(session, message, f'UID:{guest_chat_id} unblocked successfully')
 
 
 async def check_block(session, message):
-    reply_to = message.get('reply_to_message')
-    guest_chat_id = db.get(f'msg-map-{reply_to.get("message_id")}')
+    guest_chat_id = await resolve_guest(message)
     
     if not guest_chat_id:
-        return await send_message(session, ADMIN_UID, 'Cannot find corresponding user')
+        return await reply_admin(session, message, 'Cannot find corresponding user')
     
-    blocked = db.get(f'isblocked-{guest_chat_id}')
+    blocked = (await db.get_user(guest_chat_id))['blocked']
     status = 'is blocked' if blocked else 'is not blocked'
-    return await send_message(session, ADMIN_UID, f'UID:{guest_chat_id} {status}')
+    return await reply_admin(session, message, f'UID:{guest_chat_id} {status}')
+
+
+# Bulk admin operations
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(text):
+    """'90s', '30m', '2h' or '1d' in seconds, None if malformed"""
+    unit = DURATION_UNITS.get(text[-1:].lower())
+    if unit is None or not text[:-1].isdigit():
+        return None
+    return int(text[:-1]) * unit
+
+
+async def handle_bulk_block(session, message, command, args):
+    """/block or /unblock a list of UIDs, or `recent <age> [<age>]` for everyone
+    verified in that window, in one transaction
+    """
+    usage = f'Usage: {command} <uid> [<uid> ...] or {command} recent <age> [<age>], e.g. {command} recent 30m'
+    if args[0] == 'recent':
+        ages = [parse_duration(arg) for arg in args[1:]]
+        if not 1 <= len(ages) <= 2 or None in ages:
+            return await reply_admin(session, message, usage)
+        now = time.time()
+        chat_ids = await db.verified_between(now - max(ages), now - min(ages) if len(ages) == 2 else now)
+    else:
+        if not all(arg.lstrip('-').isdigit() for arg in args):
+            return await reply_admin(session, message, usage)
+        chat_ids = args
+    
+    chat_ids = [chat_id for chat_id in dict.fromkeys(chat_ids) if chat_id not in ADMIN_CHATS]
+    blocked = command == '/block'
+    await db.set_blocked_many(chat_ids, blocked)
+    return await reply_admin(
+        session, message, f'{len(chat_ids)} UIDs {"blocked" if blocked else "unblocked"} successfully'
+    )
+
+
+BROADCAST_KEY = 'broadcast'
+
+
+def broadcast_progress(job):
+    done = job['sent'] + job['failed']
+    return (f"Broadcast {job['status']}: {done}/{job['total']} processed, "
+            f"{job['sent']} sent, {job['failed']} failed")
+
+
+class Broadcaster:
+    """Fans one admin message out to every verified user.
+
+    The job lives in kv_store under BROADCAST_KEY and its recipient cursor is
+    saved after every chunk, so after a restart worker 0 picks it up again
+    and re-sends at most one chunk. Cancelling flips the stored status, which
+    the sender checks between chunks on whichever worker runs it.
+    """
+    
+    def __init__(self):
+        self.task = None
+    
+    def start(self, session, job):
+        self.task = asyncio.create_task(self._run(session, job))
+    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+    
+    async def _send(self, session, job, chat_id):
+        if job['text']:
+            return await send_message(session, chat_id, job['text'], priority=PRIORITY_LOW)
+        return await copy_message(session, chat_id, job['from_chat_id'], job['message_id'], priority=PRIORITY_LOW)
+    
+    async def report(self, session, job):
+        if job['progress_message_id']:
+            await edit_message_text(session, job['admin_chat_id'], job['progress_message_id'], broadcast_progress(job))
+    
+    async def _run(self, session, job):
+        reported_at = time.monotonic()
+        try:
+            while True:
+                chat_ids = await db.verified_chats(job['cursor'], BROADCAST_PAGE_SIZE)
+                if not chat_ids:
+                    break
+                for i in range(0, len(chat_ids), BROADCAST_CONCURRENCY):
+                    chunk = chat_ids[i:i + BROADCAST_CONCURRENCY]
+                    results = await asyncio.gather(*(self._send(session, job, chat_id) for chat_id in chunk))
+                    sent = sum(1 for result in results if result.get('ok'))
+                    job['sent'] += sent
+                    job['failed'] += len(chunk) - sent
+                    job['cursor'] = chunk[-1]
+                    
+                    stored = await db.get(BROADCAST_KEY)
+                    if not stored or stored['id'] != job['id'] or stored['status'] != 'running':
+                        return  # cancelled
+                    await db.put(BROADCAST_KEY, job)
+                    if time.monotonic() - reported_at >= BROADCAST_PROGRESS_INTERVAL:
+                        reported_at = time.monotonic()
+                        await self.report(session, job)
+            job['status'] = 'finished'
+            await db.put(BROADCAST_KEY, job)
+            await self.report(session, job)
+            logger.info(broadcast_progress(job))
+        except Exception as e:
+            logger.error(f'Broadcast failed, will resume on restart: {e}')
+
+
+broadcaster = Broadcaster()
+
+
+async def handle_broadcast(session, message, args):
+    """/broadcast <text>, or /broadcast in reply to a message to copy it;
+    /broadcast status and /broadcast cancel manage the running one
+    """
+    job = await db.get(BROADCAST_KEY)
+    running = job is not None and job['status'] == 'running'
+    if args in ('status', 'cancel'):
+        if job is None:
+            return await reply_admin(session, message, 'No broadcast has been sent yet')
+        if args == 'cancel' and running:
+            job['status'] = 'cancelled'
+            await db.put(BROADCAST_KEY, job)
+            await broadcaster.report(session, job)
+        return await reply_admin(session, message, broadcast_progress(job))
+    if running:
+        return await reply_admin(session, message, 'A broadcast is already running, see /broadcast status')
+    
+    # In a forum topic every message replies to the topic's creation message
+    source = message.get('reply_to_message')
+    if source and source.get('message_id') == message.get('message_thread_id'):
+        source = None
+    if not args and not source:
+        return await reply_admin(
+            session, message,
+            'Usage: /broadcast <text>, or reply /broadcast to the message to send; '
+            '/broadcast status, /broadcast cancel'
+        )
+    
+    admin_chat_id = message.get('chat', {}).get('id')
+    total = await db.count_verified()
+    progress = await reply_admin(session, message, f'Broadcast starting to {total} verified users')
+    job = {
+        'id': secrets.token_hex(8),
+        'status': 'running',
+        'text': args,
+        'from_chat_id': admin_chat_id,
+        'message_id': source.get('message_id') if source else None,
+        'admin_chat_id': admin_chat_id,
+        'progress_message_id': progress['result']['message_id'] if progress.get('ok') else None,
+        'cursor': 0,  # private chat ids are positive
+        'sent': 0,
+        'failed': 0,
+        'total': total,
+        'started_at': time.time()
+    }
+    await db.put(BROADCAST_KEY, job)
+    broadcaster.start(session, job)
+
+
+# Update processing
+async def process_update(session, update):
+    update_type = next((key for key in update if key != 'update_id'), 'unknown')
+    metrics.inc('bot_updates_total', f'type="{update_type}"')
+    if 'message' in update:
+        await handle_message(session, update['message'])
+    if 'callback_query' in update:
+        await handle_callback_query(session, update['callback_query'])
+
+
+def update_chat_id(update):
+    """Chat an update belongs to, used to keep per-chat ordering"""
+    if 'message' in update:
+        return update['message'].get('chat', {}).get('id', 0)
+    if 'callback_query' in update:
+        return update['callback_query'].get('from', {}).get('id', 0)
+    return update.get('update_id', 0)
+
+
+class UpdateDedup:
+    """Sliding window of recently accepted update_ids.
+
+    The highest `window` ids are kept in a min-heap mirrored by a set, so a
+    lookup is O(1). When the window is full the smallest id is evicted and
+    becomes `floor`; anything at or below it (or below the mark restored at
+    startup) counts as seen, while a late id above it is still accepted.
+    The mark saved for restarts is `handled_through`, so an update that was
+    accepted but is still in flight, or failed and awaits redelivery, is not
+    skipped. After DEDUP_MARK_TTL without updates everything is forgotten.
+    """
+    
+    def __init__(self, window):
+        self.floor = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.window = window
+        self._heap = []
+        self._seen = set()
+        # Accepted but not yet handled; failed ones stay until redelivered
+        self._pending = set()
+        self._accepted_at = time.monotonic()
+    
+    def restore(self, high_water):
+        self.floor = self.high_water = max(self.high_water, high_water or 0)
+        self._accepted_at = time.monotonic()
+    
+    def add(self, update_id):
+        """Remember an update; returns False if it was already seen"""
+        now = time.monotonic()
+        if now - self._accepted_at > DEDUP_MARK_TTL:
+            # The next update_id is random; an old floor could hide every update
+            self.floor = self.high_water = 0
+            self._heap.clear()
+            self._seen.clear()
+            self._pending.clear()
+        if update_id <= self.floor or update_id in self._seen:
+            self.dropped += 1
+            return False
+        if len(self._heap) >= self.window:
+            evicted = heapq.heappop(self._heap)
+            self._seen.discard(evicted)
+            self._pending.discard(evicted)
+            self.floor = max(self.floor, evicted)
+        heapq.heappush(self._heap, update_id)
+        self._seen.add(update_id)
+        self._pending.add(update_id)
+        self.high_water = max(self.high_water, update_id)
+        self._accepted_at = now
+        return True
+    
+    def done(self, update_id):
+        """Mark an accepted update as handled, successfully or not"""
+        self._pending.discard(update_id)
+    
+    def discard(self, update_id):
+        """Forget an update we did not handle, so its redelivery is processed.
+
+        It stays pending, holding `handled_through` back until then.
+        """
+        self._seen.discard(update_id)
+    
+    @property
+    def handled_through(self):
+        """Highest update_id with nothing at or below it left to handle"""
+        if self._pending:
+            return min(self._pending) - 1
+        return self.high_water
+    
+    def stats(self):
+        return {
+            'window': len(self._seen),
+            'high_water': self.high_water,
+            'handled_through': self.handled_through,
+            'pending': len(self._pending),
+            'dropped': self.dropped
+        }
+
+
+update_dedup = UpdateDedup(DEDUP_WINDOW)
+
+
+class UpdateQueue:
+    """Bounded update queue drained by a fixed pool of worker tasks.
+
+    Updates are sharded by chat, so every chat is served by one worker and
+    keeps its order. A full shard rejects new updates instead of growing.
+    """
+    
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self._queues = []
+        self._tasks = []
+    
+    def start(self, session):
+        shard_size = max(1, self.maxsize // self.workers)
+        self._queues = [asyncio.Queue(shard_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(q, session)) for q in self._queues]
+    
+    async def _worker(self, queue, session):
+        while True:
+            update = await queue.get()
+            try:
+                await process_update(session, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f'Error handling update: {e}')
+            finally:
+                # Already acked, so Telegram will not redeliver a failure
+                update_dedup.done(update.get('update_id'))
+                queue.task_done()
+    
+    def submit(self, update):
+        """Enqueue an update; returns False when its shard is full"""
+        queue = self._queues[hash(update_chat_id(update)) % self.workers]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        return True
+    
+    @property
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+    
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'maxsize': self.maxsize,
+            'workers': self.workers,
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'failed': self.failed
+        }
+    
+    async def stop(self, timeout):
+        """Let workers finish what is queued, then cancel them"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'Shutdown drain timed out, {self.depth} queued updates dropped')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# Long polling
+async def dispatch_batch(session, updates):
+    """Handle chats concurrently while keeping each chat's updates in order"""
+    by_chat = {}
+    for update in updates:
+        by_chat.setdefault(update_chat_id(update), []).append(update)
+    
+    async def run_chat(chat_updates):
+        for update in chat_updates:
+            try:
+                # Only worker 0 polls; other workers' chats are handled by their owner
+                owner = update_owner(update)
+                if owner:
+                    status, text = await send_to_worker(session, owner, update, 0)
+                    if status != 200:
+                        logger.error(f'Worker {owner} did not take update {update.get("update_id")}: {status} {text}')
+                else:
+                    await process_update(session, update)
+            except Exception as e:
+                logger.error(f'Error handling update: {e}')
+    
+    await asyncio.gather(*(run_chat(chat_updates) for chat_updates in by_chat.values()))
+
+
+async def handle_batch(session, updates):
+    await dispatch_batch(session, updates)
+    offset = max(update['update_id'] for update in updates) + 1
+    await db.put('update-offset', offset)
+    return offset
+
+
+async def poll_updates(session):
+    """Fetch updates with getUpdates and commit the offset after each batch"""
+    await api_request(session, 'deleteWebhook')
+    offset = await db.get('update-offset')
+    while True:
+        params = {'timeout': POLL_TIMEOUT, 'limit': POLL_LIMIT}
+        if offset:
+            params['offset'] = offset
+        result = await api_request(session, 'getUpdates', params, timeout=POLL_TIMEOUT + 10)
+        if not result.get('ok'):
+            await asyncio.sleep(POLL_RETRY_DELAY)
+            continue
+        if not result['result']:
+            continue
+        
+        # A batch that has started is finished and committed even on shutdown
+        batch = asyncio.create_task(handle_batch(session, result['result']))
+        try:
+            offset = await asyncio.shield(batch)
+        except asyncio.CancelledError:
+            await batch
+            raise
+
+
+# HTTP client session
+SESSION_KEY = web.AppKey('session', ClientSession) if hasattr(web, 'AppKey') else 'session'
+
+
+async def client_session_ctx(app):
+    """One pooled, keep-alive ClientSession for the lifetime of the app"""
+    connector = TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_POOL_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        ttl_dns_cache=300
+    )
+    timeout = ClientTimeout(total=HTTP_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT)
+    async with ClientSession(connector=connector, timeout=timeout, json_serialize=json_dumps) as session:
+        app[SESSION_KEY] = session
+        yield
+
+
+async def fraud_refresh_ctx(app):
+    """Keep fraud_list fresh for the lifetime of the app"""
+    async def run():
+        while True:
+            await fraud_list.refresh(app[SESSION_KEY])
+            await asyncio.sleep(FRAUD_REFRESH_INTERVAL)
+    
+    task = asyncio.create_task(run())
+    yield
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+UPDATE_QUEUE_KEY = web.AppKey('update_queue', UpdateQueue) if hasattr(web, 'AppKey') else 'update_queue'
+WORKER_KEY = web.AppKey('worker', int) if hasattr(web, 'AppKey') else 'worker'
+
+
+async def update_dedup_ctx(app):
+    """Restore this worker's handled-through update_id and keep it saved"""
+    key = f'update-high-water-{app[WORKER_KEY]}'
+    update_dedup.restore(await db.get(key))
+    
+    async def run():
+        saved = update_dedup.handled_through
+        while True:
+            await asyncio.sleep(DEDUP_SAVE_INTERVAL)
+            if update_dedup.handled_through != saved:
+                saved = update_dedup.handled_through
+                await db.put(key, saved, ttl=DEDUP_MARK_TTL)
+    
+    task = asyncio.create_task(run())
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await db.put(key, update_dedup.handled_through, ttl=DEDUP_MARK_TTL)
+
+
+async def update_queue_ctx(app):
+    """Run the update workers and drain them on shutdown"""
+    update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+    update_queue.start(app[SESSION_KEY])
+    app[UPDATE_QUEUE_KEY] = update_queue
+    yield
+    await update_queue.stop(SHUTDOWN_DRAIN_TIMEOUT)
+
+
+async def polling_ctx(app):
+    """Run the getUpdates loop for the lifetime of the app"""
+    task = asyncio.create_task(poll_updates(app[SESSION_KEY]))
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def broadcast_ctx(app):
+    """Resume a broadcast a restart interrupted; stop a running one on shutdown"""
+    if app[WORKER_KEY] == 0:
+        job = await db.get(BROADCAST_KEY)
+        if job is not None and job['status'] == 'running':
+            logger.info(f'Resuming broadcast: {broadcast_progress(job)}')
+            broadcaster.start(app[SESSION_KEY], job)
+    yield
+    await broadcaster.stop()
+
+
+async def media_group_ctx(app):
+    """Send albums still being collected before the session closes"""
+    yield
+    await media_groups.drain()
+
+
+async def sweeper_ctx(app):
+    """Sweep expired rows every SWEEP_INTERVAL seconds"""
+    async def run():
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            try:
+                await sweeper.sweep()
+            except sqlite3.Error as e:
+                logger.error(f'Expiry sweep failed: {e}')
+    
+    task = asyncio.create_task(run())
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
 
 
 # HTTP handlers
@@ -391,14 +2464,31 @@ async def webhook_handler(request):
         return web.Response(status=403, text='Unauthorized')
     
     try:
-        update = await request.json()
-        logger.info(f'Received update: {json.dumps(update, ensure_ascii=False)[:200]}')
+        update = await request.json(loads=json_loads)
+        log_update(update)
+        
+        owner = update_owner(update)
+        if owner != request.app[WORKER_KEY] and 'X-Relayed-By' not in request.headers:
+            return await relay_update(request, owner, update)
+        
+        # Telegram redelivers updates a slow handler has not answered yet
+        update_id = update.get('update_id')
+        if update_id is not None and not update_dedup.add(update_id):
+            return web.Response(text='Ok')
         
-        async with ClientSession() as session:
-            if 'message' in update:
-                await handle_message(session, update['message'])
-            if 'callback_query' in update:
-                await handle_callback_query(session, update['callback_query'])
+        update_queue = request.app.get(UPDATE_QUEUE_KEY)
+        if update_queue is not None:
+            # Ack now; Telegram redelivers if we answer 503
+            if not update_queue.submit(update):
+                update_dedup.discard(update_id)
+                return web.Response(status=503, text='Busy')
+        else:
+            try:
+                await process_update(request.app[SESSION_KEY], update)
+            except Exception:
+                update_dedup.discard(update_id)
+                raise
+            update_dedup.done(update_id)
         
         return web.Response(text='Ok')
     except Exception as e:
@@ -406,22 +2496,42 @@ async def webhook_handler(request):
         return web.Response(status=500, text=str(e))
 
 
+def update_owner(update):
+    """Index of the worker process that owns the update's chat"""
+    return int(update_chat_id(update)) % WORKERS
+
+
+async def send_to_worker(session, owner, update, relayed_by):
+    """POST an update to the worker that owns its chat; returns (status, text)"""
+    url = f'http://127.0.0.1:{WORKER_BASE_PORT + owner}/webhook'
+    headers = {
+        'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET,
+        'X-Relayed-By': str(relayed_by)
+    }
+    async with session.post(url, json=update, headers=headers) as resp:
+        return resp.status, await resp.text()
+
+
+async def relay_update(request, owner, update):
+    """Hand an update to the worker that owns its chat and pass on its answer"""
+    status, text = await send_to_worker(request.app[SESSION_KEY], owner, update, request.app[WORKER_KEY])
+    return web.Response(status=status, text=text)
+
+
 async def register_webhook(request):
     if not DOMAIN:
         return web.Response(text='DOMAIN not set')
     
     webhook_url = f'{DOMAIN}/webhook'
-    async with ClientSession() as session:
-        result = await api_request(session, 'setWebhook', {
-            'url': webhook_url,
-            'secret_token': WEBHOOK_SECRET
-        })
+    result = await api_request(request.app[SESSION_KEY], 'setWebhook', {
+        'url': webhook_url,
+        'secret_token': WEBHOOK_SECRET
+    })
     return web.Response(text=json.dumps(result, indent=2))
 
 
 async def unregister_webhook(request):
-    async with ClientSession() as session:
-        result = await api_request(session, 'setWebhook', {'url': ''})
+    result = await api_request(request.app[SESSION_KEY], 'setWebhook', {'url': ''})
     return web.Response(text=json.dumps(result, indent=2))
 
 
@@ -429,39 +2539,151 @@ async def health_check(request):
     return web.Response(text='Bot is running')
 
 
-def create_app():
-    app = web.Application()
+async def stats_handler(request):
+    update_queue = request.app.get(UPDATE_QUEUE_KEY)
+    stats = {
+        'update_queue': update_queue.stats() if update_queue is not None else None,
+        'update_dedup': update_dedup.stats(),
+        'flood_guard': flood_guard.stats(),
+        'media_groups': media_groups.stats(),
+        'sweeper': sweeper.stats(),
+        'user_cache': db.user_cache.stats(),
+        'write_behind': db.write_behind_stats()
+    }
+    return web.json_response(stats)
+
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'other'
+    with metrics.timer('bot_http_request_seconds', f'route="{route}"', 'bot_http_requests_in_flight'):
+        return await handler(request)
+
+
+async def close_db(app):
+    await db.close()
+
+
+def create_app(worker=0):
+    app = web.Application(middlewares=[metrics_middleware])
+    app[WORKER_KEY] = worker
+    app.cleanup_ctx.append(client_session_ctx)
+    app.cleanup_ctx.append(fraud_refresh_ctx)
+    if worker == 0:
+        # Housekeeping and getUpdates run once, not once per worker
+        app.cleanup_ctx.append(sweeper_ctx)
+    app.cleanup_ctx.append(update_dedup_ctx)
+    app.cleanup_ctx.append(broadcast_ctx)
+    app.cleanup_ctx.append(media_group_ctx)
+    if ASYNC_UPDATES:
+        app.cleanup_ctx.append(update_queue_ctx)
+    if UPDATE_MODE == 'polling' and worker == 0:
+        app.cleanup_ctx.append(polling_ctx)
+    app.on_cleanup.append(close_db)
     app.router.add_get('/', health_check)
+    app.router.add_get('/stats', stats_handler)
+    app.router.add_get('/metrics', metrics_handler)
     app.router.add_post('/webhook', webhook_handler)
     app.router.add_get('/registerWebhook', register_webhook)
     app.router.add_get('/unRegisterWebhook', unregister_webhook)
     return app
 
 
+# Multi-process serving
+async def run_worker(worker):
+    """Serve PORT (shared via SO_REUSEPORT) plus this worker's relay port"""
+    app = create_app(worker)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT, reuse_port=True).start()
+    await web.TCPSite(runner, '127.0.0.1', WORKER_BASE_PORT + worker).start()
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await runner.cleanup()
+
+
+def worker_main(worker):
+    asyncio.run(run_worker(worker))
+
+
+def serve_workers(workers):
+    """Pre-fork master: start one process per worker and wait for them.
+
+    Workers are spawned rather than forked so none of them inherits this
+    process's SQLite connection.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=worker_main, args=(worker,), name=f'bot-worker-{worker}')
+        for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # A service stop sends SIGTERM to the master only; treat it like Ctrl-C
+    # so the workers are stopped too instead of holding PORT as orphans
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # A second signal must not abandon the children mid-shutdown
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
 if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate']:
+        # Opening the database already converted any legacy kv_store keys
+        print(f'Migrated kv_store rows in {DB_PATH}: {db.database.migrated}')
+        exit(0)
     if not BOT_TOKEN:
         print('Error: BOT_TOKEN not set')
         print('Usage: BOT_TOKEN=xxx ADMIN_UID=xxx python3 tg_verify_bot.py')
         exit(1)
-    if not ADMIN_UID:
+    if not ADMIN_UIDS:
         print('Error: ADMIN_UID not set')
         exit(1)
+    if STORAGE_BACKEND == 'memory' and WORKERS > 1:
+        # Each process would keep its own users, so relayed updates see different state
+        print('Error: STORAGE_BACKEND=memory only works with WORKERS=1')
+        exit(1)
     
+    admins = f'forum {ADMIN_GROUP_ID}' if ADMIN_GROUP_ID else ', '.join(ADMIN_UIDS)
     print(f'''
 +--------------------------------------------------------------+
 |           Telegram Verification Bot - VPS Version            |
 +--------------------------------------------------------------+
 |  Port: {PORT:<54}|
-|  Admin: {ADMIN_UID:<53}|
+|  Admin: {admins[:53]:<53}|
 |  Database: {DB_PATH:<50}|
+|  Updates: {UPDATE_MODE:<51}|
+|  Workers: {WORKERS:<51}|
 +--------------------------------------------------------------+
 |  Endpoints:                                                  |
 |    GET  /                    - Health check                  |
+|    GET  /stats               - Runtime statistics            |
+|    GET  /metrics             - Prometheus metrics            |
 |    POST /webhook             - Telegram Webhook              |
 |    GET  /registerWebhook     - Register Webhook              |
 |    GET  /unRegisterWebhook   - Unregister Webhook            |
 +--------------------------------------------------------------+
 ''')
     
-    app = create_app()
-    web.run_app(app, host='0.0.0.0', port=PORT)
+    if WORKERS > 1:
+        serve_workers(WORKERS)
+    else:
+        app = create_app()
+        web.run_app(app, host='0.0.0.0', port=PORT)
@@ -0,0 +1,661 @@
+#!/usr/bin/env python3
+"""
+Load test for bot.py / nore.py
+Features:
+- Fake Bot API, fraud list and notification server on 127.0.0.1, with
+  injectable latency, 429s and 500s, and getUpdates for polling mode
+- Synthetic update streams: new users, verified chatter, admin replies, callback storms, raids, albums
+- Throughput, p50/p99 latency (webhook answer, or getUpdates confirmation when polling),
+  DB ops and Bot API calls per update
+
+Usage: python3 loadtest.py --bot nore.py --updates 2000 --concurrency 16 --json results.json
+       python3 loadtest.py --update-mode polling --api-429-rate 0.01 --api-error-rate 0.01
+       python3 loadtest.py --serve-api 8081  # fake Bot API only, for a bot started by hand
+Only the standard library is needed; the bot under test needs its own dependencies.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import sqlite3
+import argparse
+import itertools
+import tempfile
+import threading
+import subprocess
+import http.client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Configuration
+BOT_TOKEN = '1000:loadtest'
+ADMIN_UID = '1000'
+WEBHOOK_SECRET = 'loadtest'
+FRAUD_IDS = ('666', '667')
+NOTIFICATION_TEXT = 'Load test notification'
+
+VERIFIED_CHATS = 1000  # seeded verified users that send chatter
+VERIFIED_CHAT_BASE = 2000000
+MAPPED_MESSAGES = 1000  # seeded forwarded messages the admin replies to
+MAPPED_MESSAGE_BASE = 3000000
+NEW_CHAT_BASE = 10000000
+RAID_CHAT_BASE = 20000000
+RAID_MESSAGES_PER_CHAT = 5  # messages each raiding account sends
+ALBUM_SIZE = 10  # photos per album
+
+STARTUP_TIMEOUT = 15  # seconds to wait for the bot's health check
+DRAIN_TIMEOUT = 60  # seconds to wait for queued updates (ASYNC_UPDATES=1)
+SETTLE_DELAY = 0.2  # lets write-behind commit before DB ops are read
+
+# The bot's own limiter would dominate the numbers; raise it unless overridden
+BOT_ENV = {
+    'BOT_TOKEN': BOT_TOKEN,
+    'ADMIN_UID': ADMIN_UID,
+    'WEBHOOK_SECRET': WEBHOOK_SECRET,
+    'API_GLOBAL_RATE': '1000000',
+    'API_CHAT_RATE': '1000000',
+    'API_CHAT_BURST': '1000',
+    'FRAUD_REFRESH_INTERVAL': '3600',
+    'MEDIA_GROUP_WINDOW': '0.1',  # albums are sent before SETTLE_DELAY ends
+}
+
+
+# Fake Telegram API
+class FakeTelegram(ThreadingHTTPServer):
+    """Offline stand-in for the Bot API, fraud list and notification server.
+
+    Every method succeeds unless a failure is injected: `rate_limit` and
+    `error_rate` are the fractions of calls answered with a 429 carrying
+    `retry_after`, or a 500. getUpdates long-polls the updates queued with
+    push_updates() and treats its offset as confirmation, as Telegram does;
+    it answers 409 while a webhook is set. Also remembers the callback_data
+    of the last challenge sent to each chat.
+    """
+    
+    daemon_threads = True
+    request_queue_size = 128  # a bot opening its pool at once overflows the default of 5
+    
+    def __init__(self, latency=0, rate_limit=0, error_rate=0, retry_after=1, seed=0, address=('127.0.0.1', 0)):
+        super().__init__(address, FakeTelegramHandler)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = {}
+        self.injected = {429: 0, 500: 0}
+        self.keyboards = {}
+        self.webhook_url = ''
+        self.latencies = []  # seconds from push_updates() to confirmation
+        self._message_id = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._updates = deque()  # (update, pushed at)
+        self._updates_ready = threading.Condition(self._lock)
+        self._released = False
+    
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+    
+    def record(self, method, data):
+        """Count a call; returns the message_id to answer with, or an injected error code"""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            roll = self._random.random()
+            if roll < self.rate_limit:
+                self.injected[429] += 1
+                return 0, 429
+            if roll < self.rate_limit + self.error_rate:
+                self.injected[500] += 1
+                return 0, 500
+            message_id = self._message_id + 1
+            self._message_id += len(data.get('message_ids', ())) or 1  # an album takes one id per item
+        markup = data.get('reply_markup')
+        if markup:
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            buttons = [button['callback_data'] for row in markup.get('inline_keyboard', []) for button in row]
+            self.keyboards[str(data.get('chat_id'))] = buttons
+        return message_id, None
+    
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+    
+    def total_injected(self):
+        with self._lock:
+            return sum(self.injected.values())
+    
+    # getUpdates
+    def push_updates(self, updates):
+        """Queue updates for getUpdates; update_ids must keep ascending"""
+        now = time.perf_counter()
+        with self._updates_ready:
+            self._updates.extend((update, now) for update in updates)
+            self._updates_ready.notify_all()
+    
+    def get_updates(self, offset, limit, timeout):
+        """Confirm updates below `offset`, then wait up to `timeout` for more"""
+        deadline = time.monotonic() + timeout
+        with self._updates_ready:
+            now = time.perf_counter()
+            while self._updates and self._updates[0][0]['update_id'] < offset:
+                self.latencies.append(now - self._updates.popleft()[1])
+            while not self._updates and not self._released:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._updates_ready.wait(remaining)
+            return [update for update, _ in itertools.islice(self._updates, limit)]
+    
+    def pending_updates(self):
+        with self._lock:
+            return len(self._updates)
+    
+    def release(self):
+        """Answer held getUpdates calls now, so a polling bot can shut down"""
+        with self._updates_ready:
+            self._released = True
+            self._updates_ready.notify_all()
+    
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fake-telegram', daemon=True).start()
+    
+    def handle_error(self, request, client_address):
+        # A bot shutting down drops its held getUpdates call
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # headers and body are separate writes
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_result(self, result):
+        self.send_body(json.dumps({'ok': True, 'result': result}).encode(), 'application/json')
+    
+    def send_error_result(self, error_code, description, parameters=None):
+        answer = {'ok': False, 'error_code': error_code, 'description': description}
+        if parameters:
+            answer['parameters'] = parameters
+        self.send_body(json.dumps(answer).encode(), 'application/json', error_code)
+    
+    def do_GET(self):
+        if self.path == '/fraud.db':
+            self.send_body('\n'.join(FRAUD_IDS).encode(), 'text/plain')
+        else:
+            self.send_body(NOTIFICATION_TEXT.encode(), 'text/plain')
+    
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rsplit('/', 1)[-1]
+        data = json.loads(body) if body else {}
+        message_id, error_code = server.record(method, data)
+        if server.latency:
+            time.sleep(server.latency)
+        
+        if error_code == 429:
+            return self.send_error_result(
+                429, f'Too Many Requests: retry after {server.retry_after}',
+                {'retry_after': server.retry_after}
+            )
+        if error_code == 500:
+            return self.send_error_result(500, 'Internal Server Error')
+        
+        if method in ('sendMessage', 'copyMessage', 'forwardMessage', 'editMessageText'):
+            result = {'message_id': message_id, 'chat': {'id': data.get('chat_id')}, 'date': int(time.time())}
+        elif method in ('forwardMessages', 'copyMessages'):
+            result = [{'message_id': message_id + i} for i in range(len(data.get('message_ids', ())))]
+        elif method == 'createForumTopic':
+            result = {'message_thread_id': message_id, 'name': data.get('name')}
+        elif method == 'setWebhook':
+            server.webhook_url = data.get('url', '')
+            result = True
+        elif method == 'deleteWebhook':
+            server.webhook_url = ''
+            result = True
+        elif method == 'getUpdates':
+            if server.webhook_url:
+                return self.send_error_result(409, "Conflict: can't use getUpdates method while webhook is active")
+            result = server.get_updates(data.get('offset', 0), data.get('limit', 100), data.get('timeout', 0))
+        else:
+            result = True
+        self.send_result(result)
+
+
+# Bot under test
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class BotProcess:
+    """One bot.py / nore.py process with its own port, database and log"""
+    
+    def __init__(self, script, api, workdir, extra_env):
+        self.port = free_port()
+        self.db_path = os.path.join(workdir, 'bot.db')
+        self.log_path = os.path.join(workdir, 'bot.log')
+        env = dict(os.environ)
+        env.update(BOT_ENV)
+        env.update(extra_env)
+        env.update({
+            'PORT': str(self.port),
+            'DB_PATH': self.db_path,
+            'FRAUD_CACHE_PATH': os.path.join(workdir, 'fraud_cache.txt'),
+            'TELEGRAM_API_URL': api.url,
+            'FRAUD_DB_URL': f'{api.url}/fraud.db',
+            'NOTIFICATION_URL': f'{api.url}/notification.txt',
+        })
+        self._log = open(self.log_path, 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, script], env=env, cwd=workdir,
+            stdout=self._log, stderr=subprocess.STDOUT,
+            preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL)
+        )
+    
+    def request(self, path):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            conn.request('GET', path)
+            return conn.getresponse().read().decode()
+        finally:
+            conn.close()
+    
+    def wait_ready(self):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                self.request('/')
+                return
+            except OSError:
+                time.sleep(0.1)
+        with open(self.log_path) as f:
+            log_tail = f.read()[-2000:]
+        raise RuntimeError(f'Bot did not start:\n{log_tail}')
+    
+    def stats(self):
+        return json.loads(self.request('/stats'))
+    
+    def db_ops(self):
+        """Total Database operations so far, from /metrics"""
+        total = 0
+        for line in self.request('/metrics').splitlines():
+            if line.startswith('bot_db_seconds_count'):
+                total += float(line.rsplit(' ', 1)[1])
+        return int(total)
+    
+    def handled(self):
+        """Updates the background queue has finished, or None if it is off"""
+        update_queue = self.stats()['update_queue']
+        if update_queue is None:
+            return None
+        return update_queue['processed'] + update_queue['failed']
+    
+    def wait_drained(self, before, accepted):
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline:
+            handled = self.handled()
+            if handled is None or handled - before >= accepted:
+                return
+            time.sleep(0.01)
+        raise RuntimeError(f'Queued updates did not drain within {DRAIN_TIMEOUT}s')
+    
+    def seed(self):
+        """Add verified users and forwarded-message mappings to the bot's database"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        verified_until = int(time.time()) + 86400
+        expires_at = int(time.time()) + 2592000
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO users (chat_id, verified_until, is_blocked) VALUES (?, ?, 0)',
+                [(VERIFIED_CHAT_BASE + i, verified_until) for i in range(VERIFIED_CHATS)]
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO message_map (admin_chat_id, message_id, chat_id, expires_at) '
+                'VALUES (?, ?, ?, ?)',
+                [(int(ADMIN_UID), MAPPED_MESSAGE_BASE + i, VERIFIED_CHAT_BASE + i % VERIFIED_CHATS, expires_at)
+                 for i in range(MAPPED_MESSAGES)]
+            )
+        conn.close()
+    
+    def stop(self):
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self._log.close()
+
+
+# Webhook client
+class WebhookClient:
+    """Posts updates over one keep-alive connection per sending thread"""
+    
+    def __init__(self, port):
+        self.port = port
+        self.update_id = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+    
+    def next_update_id(self):
+        with self._lock:
+            self.update_id += 1
+            return self.update_id
+    
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        return conn
+    
+    def post(self, update):
+        """Send one update; returns (status, seconds)"""
+        body = json.dumps(update).encode()
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET
+        }
+        start = time.perf_counter()
+        for attempt in range(2):
+            conn = self._conn()
+            try:
+                conn.request('POST', '/webhook', body, headers)
+                resp = conn.getresponse()
+                resp.read()
+                break
+            except (OSError, http.client.HTTPException):
+                # The server closed an idle keep-alive connection; reconnect once
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        return resp.status, time.perf_counter() - start
+    
+    def replay(self, updates, concurrency):
+        """Send updates from `concurrency` threads; returns [(status, seconds)]"""
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(self.post, updates))
+
+
+# Synthetic updates
+def message_update(client, chat_id, text, reply_to=None):
+    message = {
+        'message_id': random.randint(1, 2 ** 31),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load'},
+        'text': text
+    }
+    if reply_to is not None:
+        message['reply_to_message'] = {'message_id': reply_to}
+    return {'update_id': client.next_update_id(), 'message': message}
+
+
+def album_updates(client, chat_id, size, reply_to=None):
+    """One update per photo, as Telegram delivers an album"""
+    first_id = random.randint(1, 2 ** 31 - size)
+    media_group_id = str(random.randint(1, 2 ** 62))
+    updates = []
+    for i in range(size):
+        update = message_update(client, chat_id, '', reply_to)
+        message = update['message']
+        del message['text']
+        message['message_id'] = first_id + i
+        message['media_group_id'] = media_group_id
+        message['photo'] = [{'file_id': f'photo-{media_group_id}-{i}', 'width': 90, 'height': 90}]
+        updates.append(update)
+    return updates
+
+
+def callback_update(client, chat_id, data):
+    return {
+        'update_id': client.next_update_id(),
+        'callback_query': {
+            'id': str(random.randint(1, 2 ** 62)),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Load'},
+            'message': {'message_id': random.randint(1, 2 ** 31), 'chat': {'id': chat_id}},
+            'data': data
+        }
+    }
+
+
+def new_users(client, bot, api, n, concurrency):
+    """Unverified chats writing for the first time; each gets a challenge"""
+    return [message_update(client, NEW_CHAT_BASE + i, 'hello') for i in range(n)]
+
+
+def verified_chatter(client, bot, api, n, concurrency):
+    """Verified users whose messages are forwarded to the admin"""
+    return [message_update(client, VERIFIED_CHAT_BASE + i % VERIFIED_CHATS, f'message {i}') for i in range(n)]
+
+
+def admin_replies(client, bot, api, n, concurrency):
+    """The admin replying to forwarded messages"""
+    return [message_update(client, int(ADMIN_UID), f'reply {i}', MAPPED_MESSAGE_BASE + i % MAPPED_MESSAGES)
+            for i in range(n)]
+
+
+def albums(client, bot, api, n, concurrency):
+    """Verified users sending photo albums, and the admin answering with albums"""
+    updates = []
+    for i in range(max(1, n // ALBUM_SIZE)):
+        if i % 2:
+            updates += album_updates(client, int(ADMIN_UID), ALBUM_SIZE, MAPPED_MESSAGE_BASE + i % MAPPED_MESSAGES)
+        else:
+            updates += album_updates(client, VERIFIED_CHAT_BASE + i % VERIFIED_CHATS, ALBUM_SIZE)
+    return updates
+
+
+def callback_storm(client, bot, api, n, concurrency):
+    """Button presses on challenges; the challenges are sent first, unmeasured"""
+    chats = [NEW_CHAT_BASE + n + i for i in range(n)]
+    results = client.replay([message_update(client, chat_id, 'hello') for chat_id in chats], concurrency)
+    bot.wait_drained(0, sum(1 for status, _ in results if status == 200))
+    updates = []
+    for chat_id in chats:
+        buttons = api.keyboards.get(str(chat_id))
+        if buttons:
+            updates.append(callback_update(client, chat_id, random.choice(buttons)))
+    return updates
+
+
+def raid(client, bot, api, n, concurrency):
+    """Fresh accounts flooding in and writing repeatedly; every tenth update
+    still comes from a verified user
+    """
+    raiders = max(1, n * 9 // 10 // RAID_MESSAGES_PER_CHAT)
+    updates = []
+    for i in range(n):
+        if i % 10 == 9:
+            updates.append(message_update(client, VERIFIED_CHAT_BASE + i % VERIFIED_CHATS, f'message {i}'))
+        else:
+            updates.append(message_update(client, RAID_CHAT_BASE + i % raiders, 'spam'))
+    return updates
+
+
+SCENARIOS = {
+    'new-users': new_users,
+    'verified': verified_chatter,
+    'admin-replies': admin_replies,
+    'callbacks': callback_storm,
+    'raid': raid,
+    'albums': albums,
+}
+
+
+# Runner
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def fake_telegram(args, address=('127.0.0.1', 0)):
+    return FakeTelegram(
+        args.api_latency / 1000, args.api_429_rate, args.api_error_rate, args.retry_after, args.seed, address
+    )
+
+
+def deliver_polled(api, updates):
+    """Queue updates for getUpdates; returns the seconds until each was confirmed"""
+    confirmed_before = len(api.latencies)
+    api.push_updates(updates)
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while api.pending_updates() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return api.latencies[confirmed_before:]
+
+
+def run_scenario(name, args, extra_env):
+    """Start a fresh bot, replay one scenario and measure it"""
+    random.seed(args.seed)
+    api = fake_telegram(args)
+    api.start()
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as workdir:
+        bot = BotProcess(os.path.abspath(args.bot), api, workdir, extra_env)
+        try:
+            bot.wait_ready()
+            bot.seed()
+            client = WebhookClient(bot.port)
+            # Any setup traffic a scenario sends is finished before measuring
+            updates = SCENARIOS[name](client, bot, api, args.updates, args.concurrency)
+            time.sleep(SETTLE_DELAY)
+            handled_before = bot.handled()
+            calls_before = api.total_calls()
+            injected_before = api.total_injected()
+            db_ops_before = bot.db_ops()
+            
+            start = time.perf_counter()
+            if args.update_mode == 'polling':
+                # Polled batches bypass the update queue and are confirmed once handled
+                latencies = deliver_polled(api, updates)
+                accepted = len(latencies)
+            else:
+                results = client.replay(updates, args.concurrency)
+                latencies = [seconds for _, seconds in results]
+                accepted = sum(1 for status, _ in results if status == 200)
+                if handled_before is not None:
+                    bot.wait_drained(handled_before, accepted)
+            elapsed = time.perf_counter() - start
+            
+            time.sleep(SETTLE_DELAY)
+            db_ops = bot.db_ops() - db_ops_before
+            calls = api.total_calls() - calls_before
+            injected = api.total_injected() - injected_before
+        finally:
+            api.release()
+            bot.stop()
+            api.shutdown()
+            api.server_close()
+    
+    latencies.sort()
+    count = len(updates) or 1
+    return {
+        'scenario': name,
+        'updates': len(updates),
+        'errors': len(updates) - accepted,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(len(updates) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'db_ops_per_update': round(db_ops / count, 2),
+        'api_calls_per_update': round(calls / count, 2),
+        'api_errors_injected': injected,
+    }
+
+
+def print_table(results):
+    columns = ('scenario', 'updates', 'errors', 'seconds', 'updates_per_second',
+               'p50_ms', 'p99_ms', 'db_ops_per_update', 'api_calls_per_update',
+               'api_errors_injected')
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def parse_env(pairs):
+    env = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        env[key] = value
+    return env
+
+
+def serve_api(args):
+    """Run the fake Bot API in the foreground for a bot started by hand"""
+    host, _, port = args.serve_api.rpartition(':')
+    api = fake_telegram(args, (host or '127.0.0.1', int(port)))
+    print(f'Fake Bot API on {api.url}; start the bot with')
+    print(f'  TELEGRAM_API_URL={api.url} FRAUD_DB_URL={api.url}/fraud.db NOTIFICATION_URL={api.url}/notification.txt')
+    try:
+        api.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.server_close()
+    print(json.dumps({'calls': api.calls, 'injected': api.injected}, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay synthetic updates against bot.py or nore.py')
+    parser.add_argument('--bot', default='bot.py', help='bot script to run (default: bot.py)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma-separated, from: {", ".join(SCENARIOS)}')
+    parser.add_argument('--updates', type=int, default=2000, help='updates per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='parallel webhook connections')
+    parser.add_argument('--update-mode', choices=('webhook', 'polling'), default='webhook',
+                        help='post updates to /webhook, or serve them to the bot through getUpdates')
+    parser.add_argument('--api-latency', type=float, default=0, help='fake Bot API delay in milliseconds')
+    parser.add_argument('--api-429-rate', type=float, default=0, help='fraction of Bot API calls answered with 429')
+    parser.add_argument('--api-error-rate', type=float, default=0, help='fraction of Bot API calls answered with 500')
+    parser.add_argument('--retry-after', type=int, default=1, help='retry_after of injected 429s, in seconds')
+    parser.add_argument('--serve-api', metavar='[HOST:]PORT',
+                        help='only run the fake Bot API, until interrupted; no bot is started')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the bot, e.g. ASYNC_UPDATES=1')
+    parser.add_argument('--json', metavar='PATH', help='also write the results as JSON')
+    args = parser.parse_args()
+    if args.serve_api:
+        return serve_api(args)
+    
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenario: {", ".join(unknown)}')
+    
+    extra_env = parse_env(args.env)
+    if args.update_mode == 'polling':
+        extra_env.setdefault('UPDATE_MODE', 'polling')
+    results = [run_scenario(name, args, extra_env) for name in names]
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'bot': args.bot, 'env': extra_env, 'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
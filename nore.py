@@ -5,15 +5,35 @@ No external dependencies - uses only Python standard library
 """
 
 import os
+import sys
+import hmac
 import json
+import base64
+import hashlib
+import heapq
 import random
+import secrets
+import signal
 import sqlite3
 import time
 import logging
-import urllib.request
-import urllib.error
+import queue
+import threading
+import ssl
+import tempfile
+import http.client
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial, wraps
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit
+
+try:
+    import orjson  # optional, faster JSON on the webhook and Bot API paths
+except ImportError:
+    orjson = None
 
 # Configuration
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '8324596212:ACHznhDgRuW2OcTYKAvFoa0UrDiMnef4Qyh')
@@ -21,12 +41,125 @@ ADMIN_UID = os.environ.get('ADMIN_UID', '1130431721')
 WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', 'W2OcTYKAvFoa0Ur')
 PORT = int(os.environ.get('PORT', '8658'))
 DOMAIN = os.environ.get('DOMAIN', '')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
 DB_PATH = os.environ.get('DB_PATH', 'bot_data.db')
 
+# Admin routing: guests are spread over ADMIN_UIDS by consistent hashing, or
+# with ADMIN_GROUP_ID (a forum supergroup) each guest gets a topic there
+ADMIN_UIDS = [uid.strip() for uid in os.environ.get('ADMIN_UIDS', ADMIN_UID).split(',') if uid.strip()]
+ADMIN_GROUP_ID = os.environ.get('ADMIN_GROUP_ID', '').strip()
+ADMIN_RING_REPLICAS = 512  # points per admin on the hash ring
+
 NOTIFY_INTERVAL = 24 * 3600
-FRAUD_DB_URL = 'https://raw.githubusercontent.com/Squarelan/telegram-verify-bot/main/data/fraud.db'
-NOTIFICATION_URL = 'https://raw.githubusercontent.com/Squarelan/telegram-verify-bot/main/data/notification.txt'
-ENABLE_NOTIFICATION = False
+FRAUD_DB_URL = os.environ.get('FRAUD_DB_URL', 'https://raw.githubusercontent.com/Squarelan/telegram-verify-bot/main/data/fraud.db')
+FRAUD_CACHE_PATH = os.environ.get('FRAUD_CACHE_PATH', 'fraud_cache.txt')
+FRAUD_REFRESH_INTERVAL = int(os.environ.get('FRAUD_REFRESH_INTERVAL', '3600'))
+NOTIFICATION_URL = os.environ.get('NOTIFICATION_URL', 'https://raw.githubusercontent.com/Squarelan/telegram-verify-bot/main/data/notification.txt')
+ENABLE_NOTIFICATION = os.environ.get('ENABLE_NOTIFICATION', '0') == '1'
+
+# Background update processing (ASYNC_UPDATES=1 acks webhooks before handling)
+ASYNC_UPDATES = os.environ.get('ASYNC_UPDATES', '0') == '1'
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '8'))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '1000'))
+SHUTDOWN_DRAIN_TIMEOUT = 10  # seconds to finish queued updates on shutdown
+
+# Update source: 'webhook' or 'polling' (getUpdates long polling)
+UPDATE_MODE = os.environ.get('UPDATE_MODE', 'webhook')
+POLL_TIMEOUT = 30  # seconds Telegram holds a getUpdates request open
+POLL_LIMIT = 100
+POLL_RETRY_DELAY = 5
+
+# Redelivered updates are dropped by update_id; the high-water mark is saved
+# so updates handled before a restart are still recognised
+DEDUP_WINDOW = 10000  # recent update_ids remembered exactly
+DEDUP_SAVE_INTERVAL = 1  # seconds between saves of the high-water mark
+# Telegram picks a new random update_id after a week without updates, so
+# neither the saved mark nor the window may outlive that
+DEDUP_MARK_TTL = 6 * 86400
+
+# Outbound HTTP connection pool
+HTTP_POOL_PER_HOST = int(os.environ.get('HTTP_POOL_PER_HOST', '30'))  # idle connections kept per host
+HTTP_KEEPALIVE = 60  # seconds an idle connection is kept open
+
+# HTTP server concurrency
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '16'))
+KEEPALIVE_TIMEOUT = 15  # seconds an idle keep-alive connection may hold a worker
+# Telegram opens up to 40 webhook connections unless told otherwise; more
+# than there are workers would leave some in the backlog behind idle ones.
+# Two workers stay free for /stats, /metrics and the register endpoints.
+WEBHOOK_MAX_CONNECTIONS = max(1, min(SERVER_WORKERS - 2, 100))
+
+# Expired row sweeping
+SWEEP_INTERVAL = int(os.environ.get('SWEEP_INTERVAL', '600'))
+SWEEP_BATCH_SIZE = 500  # rows deleted per transaction
+SWEEP_MAX_BATCHES = 100  # per sweep, so one run stays bounded
+SWEEP_VACUUM_PAGES = 2000  # free pages returned to the OS per sweep
+
+# In-process cache for per-user state
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = 60  # seconds; writes through Database invalidate sooner
+
+# Write-behind buffering for message_map and last-message writes
+WRITE_BEHIND_INTERVAL = 0.05  # seconds between batched commits
+WRITE_BEHIND_MAX_ROWS = 200  # commit early once this many rows are buffered
+
+# Verification challenges are HMAC-signed into callback_data, not stored
+CHALLENGE_SECRET = os.environ.get('CHALLENGE_SECRET', '')
+CHALLENGE_TTL = 600  # seconds a challenge can be answered
+CHALLENGE_POOL_SIZE = 256  # pre-generated questions kept ready
+VERIFY_TTL = 259200  # 3 days a solved challenge keeps a chat verified
+
+# Flood protection: when unverified chats send more than RAID_THRESHOLD
+# messages per second, raid mode drops their repeats before any DB or API work
+RAID_THRESHOLD = float(os.environ.get('RAID_THRESHOLD', '20'))
+RAID_WINDOW = 10  # seconds the unverified message rate is averaged over
+RAID_COOLDOWN = 60  # seconds under half the threshold before raid mode ends
+RAID_CHALLENGE_RATE = float(os.environ.get('RAID_CHALLENGE_RATE', '5'))  # new challenges per second in a raid
+CHAT_REMINDER_LIMIT = 2  # "click the button" reminders per chat per window
+CHAT_REMINDER_WINDOW = 60
+
+# /broadcast fan-out; sends use the low-priority lane of the rate limiter
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '10'))  # sends in flight
+BROADCAST_PAGE_SIZE = 500  # recipients read per query
+BROADCAST_PROGRESS_INTERVAL = 10  # seconds between progress updates to the admin
+
+# Albums arrive as one update per item; they are collected by media_group_id
+# and sent on with one forwardMessages/copyMessages call
+MEDIA_GROUP_WINDOW = float(os.environ.get('MEDIA_GROUP_WINDOW', '0.5'))  # seconds after the first item
+MEDIA_GROUP_SENDERS = int(os.environ.get('MEDIA_GROUP_SENDERS', '4'))  # threads sending flushed albums
+
+# SQLite tuning: WAL journal, fsync only at checkpoints, 8 MB page cache
+SQLITE_PRAGMAS = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'cache_size=-8000',
+    'temp_store=MEMORY',
+    'busy_timeout=5000',  # wait for other writers instead of failing at once
+)
+SQLITE_LOCK_RETRIES = 5
+SQLITE_LOCK_RETRY_DELAY = 0.05  # seconds, grows linearly per attempt
+
+# Outbound Telegram API scheduling
+API_GLOBAL_RATE = float(os.environ.get('API_GLOBAL_RATE', '30'))  # messages per second, all chats
+API_CHAT_RATE = float(os.environ.get('API_CHAT_RATE', '1'))  # messages per second, per chat
+API_CHAT_BURST = int(os.environ.get('API_CHAT_BURST', '3'))
+API_MAX_RETRIES = 3
+API_RETRY_BASE = 0.5  # seconds, doubled per attempt and jittered
+MAX_CHAT_BUCKETS = 10000
+
+# Priority lanes: a lane may only spend global tokens above its reserve,
+# so admin replies still get through while prompts queue up
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+LANE_RESERVE = (0.0, 0.2, 0.4)  # fraction of the global bucket held back
+
+# /metrics histogram bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOOKUP_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 1e-3)
+
+# Fraction of webhook updates logged at INFO (0 turns update logging off)
+LOG_UPDATE_SAMPLE = float(os.environ.get('LOG_UPDATE_SAMPLE', '1'))
 
 # Logging
 logging.basicConfig(
@@ -35,33 +168,388 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Wire JSON: orjson when installed, otherwise the stdlib with the same compact output
+if orjson is not None:
+    json_loads = orjson.loads
+    
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    json_loads = json.loads
+    json_dumps = partial(json.dumps, ensure_ascii=False, separators=(',', ':'))
+
+
+def log_update(update):
+    """Log a sample of incoming updates; nothing is serialized unless it is logged"""
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if LOG_UPDATE_SAMPLE < 1 and random.random() >= LOG_UPDATE_SAMPLE:
+        return
+    logger.info(f'Received update: {json_dumps(update)[:200]}')
+
+CHALLENGE_KEY = hashlib.sha256((CHALLENGE_SECRET or f'challenge:{BOT_TOKEN}').encode()).digest()
+CHALLENGE_MAC = hmac.new(CHALLENGE_KEY, digestmod=hashlib.sha256)  # pre-keyed, copied per signature
+
+
+# Metrics
+class Metrics:
+    """Counters, gauges and histograms served as Prometheus text.
+
+    Each thread records into its own shard, so an event is a plain dict
+    update with no lock; render() adds the shards up. Labels are passed
+    pre-formatted, e.g. 'method="sendMessage"'; gauges move with
+    inc(name, value=-1).
+    """
+    
+    def __init__(self):
+        self._meta = {}
+        self._shards = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+    
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+    
+    def gauge(self, name, help_text):
+        self._meta[name] = ('gauge', help_text, None)
+    
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, buckets)
+    
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            # First event on this thread; the only time the lock is taken
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append(values)
+            return values
+    
+    def inc(self, name, labels='', value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+    
+    def observe(self, name, seconds, labels=''):
+        buckets = self._meta[name][2]
+        shard = self._shard()
+        values = shard.get((name, labels))
+        if values is None:
+            # One count per bucket, one for +Inf, then the running sum
+            values = shard[(name, labels)] = [0] * (len(buckets) + 2)
+        values[bisect_left(buckets, seconds)] += 1
+        values[-1] += seconds
+    
+    def timer(self, name, labels='', in_flight=None):
+        """Observe the duration of a block, optionally tracking it in a gauge"""
+        return Timer(self, name, labels, in_flight)
+    
+    def timed(self, name, label=None):
+        """Decorator timing a function, labelled with its name if `label` is set"""
+        def decorator(func):
+            labels = f'{label}="{func.__name__}"' if label else ''
+            
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, labels)
+            return wrapper
+        return decorator
+    
+    def _merged(self):
+        with self._lock:
+            shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            for key, value in list(shard.items()):
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value))
+                    for i, part in enumerate(value):
+                        total[i] += part
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+    
+    def render(self):
+        series = {}
+        for (name, labels), value in self._merged().items():
+            series.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(series.get(name, ()), key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                count = 0
+                for bound, bucket_count in zip((*buckets, '+Inf'), value):
+                    count += bucket_count
+                    le = f'le="{bound}"'
+                    lines.append(f'{name}_bucket{format_labels(labels, le)} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class Timer:
+    """Context manager behind Metrics.timer()"""
+    
+    __slots__ = ('metrics', 'name', 'labels', 'in_flight', 'start')
+    
+    def __init__(self, metrics, name, labels, in_flight):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.in_flight = in_flight
+    
+    def __enter__(self):
+        if self.in_flight:
+            self.metrics.inc(self.in_flight)
+        self.start = time.perf_counter()
+    
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.labels)
+        if self.in_flight:
+            self.metrics.inc(self.in_flight, value=-1)
+
+
+def format_labels(*labels):
+    labels = ','.join(label for label in labels if label)
+    return f'{{{labels}}}' if labels else ''
+
+
+metrics = Metrics()
+metrics.counter('bot_updates_total', 'Updates processed, by type')
+metrics.histogram('bot_handler_seconds', 'Time spent in update handlers')
+metrics.histogram('bot_api_request_seconds', 'Bot API call latency per attempt, by method')
+metrics.counter('bot_api_errors_total', 'Failed Bot API attempts, by method')
+metrics.counter('bot_api_rate_limited_total', 'Bot API attempts answered with 429, by method')
+metrics.gauge('bot_api_requests_in_flight', 'Bot API calls waiting for an answer')
+metrics.histogram('bot_db_seconds', 'Database operation latency, by operation')
+metrics.histogram('bot_fraud_check_seconds', 'Fraud list lookup time', LOOKUP_BUCKETS)
+metrics.histogram('bot_http_request_seconds', 'Time to answer HTTP requests, by route')
+metrics.gauge('bot_http_requests_in_flight', 'HTTP requests being handled')
+metrics.gauge('bot_raid_mode', '1 while raid mode is on')
+metrics.counter('bot_flood_dropped_total', 'Unverified messages dropped without a reply, by reason')
+
+
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire.
+
+    `version` moves on every invalidation; a reader that started before a
+    write passes the version it saw to put(), so a stale row it fetched is
+    never cached. Safe to share between request threads.
+    """
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            value, expires_at = entry
+            if time.monotonic() > expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def put(self, key, value, version, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, key):
+        with self._lock:
+            self.version += 1
+            self._entries.pop(key, None)
+    
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+def user_state(row):
+    """Decode a users row (or None) into the flags the handlers use"""
+    verified_until, is_blocked, last_message_at, topic_id = row or (None, 0, None, None)
+    return {
+        'verified': bool(verified_until and verified_until > time.time()),
+        'blocked': bool(is_blocked),
+        'last_message_at': last_message_at,
+        'topic_id': topic_id
+    }
+
+
+def user_cache_ttl(row):
+    """Cache a verified user no longer than their verification lasts"""
+    verified_until = row[0] if row else None
+    if verified_until and verified_until > time.time():
+        return verified_until - time.time()
+    return None
+
+
+def retry_on_locked(func):
+    """Retry a SQLite write that lost a lock race with another writer"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(SQLITE_LOCK_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == SQLITE_LOCK_RETRIES - 1:
+                    raise
+                time.sleep(SQLITE_LOCK_RETRY_DELAY * (attempt + 1))
+    return wrapper
+
+
+def table_columns(conn, table):
+    """Column names of a table, empty if it does not exist yet"""
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def open_connection(db_path):
+    """Open a SQLite connection tuned for many small transactions"""
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(f'PRAGMA {pragma}')
+    return conn
+
 
 class Database:
-    """SQLite key-value store with TTL support"""
+    """SQLite key-value store with TTL support.
+
+    Each thread keeps its own long-lived connection; WAL lets readers and the
+    writer proceed concurrently. After start_write_behind(), message_map and
+    last-message writes are buffered and committed in batches; reads consult
+    the buffer first so they never miss a row.
+    """
     
     def __init__(self, db_path):
         self.db_path = db_path
+        self._local = threading.local()
+        self.user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self.write_behind = False
+        self.flushes = 0
+        self.rows_flushed = 0
+        self._pending_map = {}
+        self._pending_last = {}
+        self._flushing_map = {}
+        self._flushing_last = {}
+        self._buffer_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flush_now = threading.Event()
         self._init_db()
     
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = open_connection(self.db_path)
+            self._local.conn = conn
+        return conn
+    
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+    
     def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS kv_store (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                expires_at INTEGER
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        conn = self._conn()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # Switching an existing file to incremental auto-vacuum needs a VACUUM
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+        with conn:
+            # IMMEDIATE so processes starting together migrate the schema once
+            conn.execute('BEGIN IMMEDIATE')
+            user_columns = table_columns(conn, 'users')
+            if user_columns and 'topic_id' not in user_columns:
+                conn.execute('ALTER TABLE users ADD COLUMN topic_id INTEGER')
+            map_columns = table_columns(conn, 'message_map')
+            legacy_map = map_columns and 'admin_chat_id' not in map_columns
+            if legacy_map:
+                # Message ids are only unique within a chat, so the map is now
+                # keyed by (admin chat, message id)
+                conn.execute('DROP INDEX IF EXISTS message_map_expires_at')
+                conn.execute('ALTER TABLE message_map RENAME TO message_map_v1')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS kv_store (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    expires_at INTEGER
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS kv_store_expires_at
+                ON kv_store (expires_at) WHERE expires_at IS NOT NULL
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    chat_id INTEGER PRIMARY KEY,
+                    verified_until INTEGER,
+                    is_blocked INTEGER NOT NULL DEFAULT 0,
+                    pending_answer TEXT,  -- unused since challenges became stateless
+                    last_message_at REAL,
+                    topic_id INTEGER  -- forum topic in ADMIN_GROUP_ID
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS message_map (
+                    admin_chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    expires_at INTEGER,
+                    PRIMARY KEY (admin_chat_id, message_id)
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS message_map_expires_at
+                ON message_map (expires_at) WHERE expires_at IS NOT NULL
+            ''')
+            if legacy_map:
+                # Everything forwarded before multi-admin routing went to ADMIN_UID
+                conn.execute(
+                    'INSERT OR REPLACE INTO message_map (admin_chat_id, message_id, chat_id, expires_at) '
+                    'SELECT ?, message_id, chat_id, expires_at FROM message_map_v1', (int(ADMIN_UID),)
+                )
+                conn.execute('DROP TABLE message_map_v1')
+        self.migrated = self.migrate_kv_store()
     
+    @metrics.timed('bot_db_seconds', 'op')
     def get(self, key):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT value, expires_at FROM kv_store WHERE key = ?', (key,))
-        row = c.fetchone()
-        conn.close()
+        row = self._conn().execute(
+            'SELECT value, expires_at FROM kv_store WHERE key = ?', (key,)
+        ).fetchone()
         
         if row:
             value, expires_at = row
@@ -74,96 +562,637 @@ class Database:
                 return value
         return None
     
+    @metrics.timed('bot_db_seconds', 'op')
+    @retry_on_locked
     def put(self, key, value, ttl=None):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
         expires_at = int(time.time() + ttl) if ttl else None
         value_str = json.dumps(value) if not isinstance(value, str) else value
-        c.execute(
-            'INSERT OR REPLACE INTO kv_store (key, value, expires_at) VALUES (?, ?, ?)',
-            (key, value_str, expires_at)
-        )
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO kv_store (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value_str, expires_at)
+            )
     
+    @metrics.timed('bot_db_seconds', 'op')
+    @retry_on_locked
     def delete(self, key):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('DELETE FROM kv_store WHERE key = ?', (key,))
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            conn.execute('DELETE FROM kv_store WHERE key = ?', (key,))
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    @retry_on_locked
+    def delete_expired(self, limit):
+        """Delete up to `limit` expired rows per table; returns the number deleted"""
+        now = int(time.time())
+        deleted = 0
+        with self._conn() as conn:
+            for table in ('kv_store', 'message_map'):
+                deleted += conn.execute(f'''
+                    DELETE FROM {table} WHERE rowid IN (
+                        SELECT rowid FROM {table} WHERE expires_at < ? LIMIT ?
+                    )
+                ''', (now, limit)).rowcount
+            # Users whose verification lapsed, who are not blocked and own no topic
+            deleted += conn.execute('''
+                DELETE FROM users WHERE chat_id IN (
+                    SELECT chat_id FROM users
+                    WHERE COALESCE(verified_until, 0) < ? AND is_blocked = 0
+                    AND topic_id IS NULL LIMIT ?
+                )
+            ''', (now, limit)).rowcount
+        return deleted
+    
+    # Per-user state
+    USER_FIELDS = ('verified_until', 'is_blocked', 'last_message_at', 'topic_id')
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    def get_user_row(self, chat_id):
+        """All state for one chat in a single primary-key lookup"""
+        return self._conn().execute(
+            'SELECT verified_until, is_blocked, last_message_at, topic_id '
+            'FROM users WHERE chat_id = ?', (int(chat_id),)
+        ).fetchone()
+    
+    def get_user(self, chat_id):
+        key = int(chat_id)
+        row = self.user_cache.get(key)
+        if row is MISSING:
+            version = self.user_cache.version
+            row = self.get_user_row(key)
+            self.user_cache.put(key, row, version, user_cache_ttl(row))
+        state = user_state(row)
+        with self._buffer_lock:
+            last_message_at = self._pending_last.get(key) or self._flushing_last.get(key)
+        if last_message_at:
+            state['last_message_at'] = last_message_at
+        return state
+    
+    @retry_on_locked
+    def _set_user(self, chat_id, **fields):
+        columns = [name for name in fields if name in self.USER_FIELDS]
+        assignments = ', '.join(f'{name} = excluded.{name}' for name in columns)
+        with self._conn() as conn:
+            conn.execute(
+                f'INSERT INTO users (chat_id, {", ".join(columns)}) '
+                f'VALUES (?, {", ".join("?" * len(columns))}) '
+                f'ON CONFLICT (chat_id) DO UPDATE SET {assignments}',
+                (int(chat_id), *(fields[name] for name in columns))
+            )
+        self.user_cache.invalidate(int(chat_id))
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    def set_verified(self, chat_id, ttl):
+        """Mark a chat verified for ttl seconds"""
+        self._set_user(chat_id, verified_until=int(time.time() + ttl))
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    def set_blocked(self, chat_id, blocked):
+        self._set_user(chat_id, is_blocked=int(bool(blocked)))
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    def set_topic(self, chat_id, topic_id):
+        self._set_user(chat_id, topic_id=int(topic_id))
+    
+    # Bulk operations
+    @metrics.timed('bot_db_seconds', 'op')
+    @retry_on_locked
+    def set_blocked_many(self, chat_ids, blocked):
+        """Block or unblock every chat in one transaction"""
+        with self._conn() as conn:
+            conn.executemany(
+                'INSERT INTO users (chat_id, is_blocked) VALUES (?, ?) '
+                'ON CONFLICT (chat_id) DO UPDATE SET is_blocked = excluded.is_blocked',
+                [(int(chat_id), int(bool(blocked))) for chat_id in chat_ids]
+            )
+        for chat_id in chat_ids:
+            self.user_cache.invalidate(int(chat_id))
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    def verified_between(self, start, end):
+        """Chats whose current verification was granted between start and end"""
+        rows = self._conn().execute(
+            'SELECT chat_id FROM users WHERE verified_until BETWEEN ? AND ?',
+            (int(start + VERIFY_TTL), int(end + VERIFY_TTL))
+        ).fetchall()
+        return [str(row[0]) for row in rows]
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    def verified_chats(self, after, limit):
+        """Up to `limit` verified, unblocked chat ids above `after`, ascending"""
+        # Keyset paging on the primary key; no scan restarts from the top
+        rows = self._conn().execute(
+            'SELECT chat_id FROM users WHERE chat_id > ? AND verified_until > ? AND is_blocked = 0 '
+            'ORDER BY chat_id LIMIT ?', (int(after), int(time.time()), limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    def count_verified(self):
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM users WHERE verified_until > ? AND is_blocked = 0', (int(time.time()),)
+        ).fetchone()[0]
+    
+    def set_last_message(self, chat_id, timestamp):
+        if not self.write_behind:
+            return self._set_user(chat_id, last_message_at=timestamp)
+        with self._buffer_lock:
+            self._pending_last[int(chat_id)] = timestamp
+        self._buffered()
+    
+    # (admin chat, forwarded message) -> guest chat
+    def get_message_map(self, admin_chat_id, message_id):
+        key = (int(admin_chat_id), int(message_id))
+        with self._buffer_lock:
+            entry = self._pending_map.get(key) or self._flushing_map.get(key)
+        if entry is not None:
+            return str(entry[0])
+        with metrics.timer('bot_db_seconds', 'op="get_message_map"'):
+            row = self._conn().execute(
+                'SELECT chat_id, expires_at FROM message_map WHERE admin_chat_id = ? AND message_id = ?', key
+            ).fetchone()
+        if not row or (row[1] and time.time() > row[1]):
+            return None
+        return str(row[0])
+    
+    def put_message_map(self, admin_chat_id, message_id, chat_id, ttl=None):
+        self.put_message_maps(admin_chat_id, [message_id], chat_id, ttl)
+    
+    def put_message_maps(self, admin_chat_id, message_ids, chat_id, ttl=None):
+        """Map several ids to one guest; they are committed in the same transaction"""
+        expires_at = int(time.time() + ttl) if ttl else None
+        rows = [(int(admin_chat_id), int(message_id), int(chat_id), expires_at) for message_id in message_ids]
+        if not self.write_behind:
+            return self.write_batch(rows, [])
+        with self._buffer_lock:
+            for admin_chat_id, message_id, chat_id, expires_at in rows:
+                self._pending_map[(admin_chat_id, message_id)] = (chat_id, expires_at)
+        self._buffered()
+    
+    # Write-behind buffer
+    def start_write_behind(self):
+        """Buffer message_map/last-message writes, flushed by a daemon thread"""
+        def run():
+            while True:
+                self._flush_now.wait(WRITE_BEHIND_INTERVAL)
+                self._flush_now.clear()
+                self.flush()
+        self.write_behind = True
+        threading.Thread(target=run, name='write-behind', daemon=True).start()
+    
+    def _buffered(self):
+        if len(self._pending_map) + len(self._pending_last) >= WRITE_BEHIND_MAX_ROWS:
+            self._flush_now.set()
+    
+    def flush(self):
+        """Commit everything buffered so far in a single transaction"""
+        with self._flush_lock:
+            with self._buffer_lock:
+                if not self._pending_map and not self._pending_last:
+                    return
+                self._flushing_map, self._pending_map = self._pending_map, {}
+                self._flushing_last, self._pending_last = self._pending_last, {}
+            map_rows = [(*key, chat_id, expires_at)
+                        for key, (chat_id, expires_at) in self._flushing_map.items()]
+            last_rows = list(self._flushing_last.items())
+            try:
+                self.write_batch(map_rows, last_rows)
+                self.flushes += 1
+                self.rows_flushed += len(map_rows) + len(last_rows)
+            except sqlite3.Error as e:
+                logger.error(f'Write-behind flush failed, will retry: {e}')
+                with self._buffer_lock:
+                    self._pending_map = {**self._flushing_map, **self._pending_map}
+                    self._pending_last = {**self._flushing_last, **self._pending_last}
+            finally:
+                for chat_id in self._flushing_last:
+                    self.user_cache.invalidate(chat_id)
+                with self._buffer_lock:
+                    self._flushing_map = {}
+                    self._flushing_last = {}
+    
+    def write_behind_stats(self):
+        return {
+            'pending': len(self._pending_map) + len(self._pending_last),
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed
+        }
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    @retry_on_locked
+    def write_batch(self, message_map_rows, last_message_rows):
+        """Commit buffered message_map and last-message writes in one transaction"""
+        with self._conn() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO message_map (admin_chat_id, message_id, chat_id, expires_at) '
+                'VALUES (?, ?, ?, ?)',
+                message_map_rows
+            )
+            conn.executemany(
+                'INSERT INTO users (chat_id, last_message_at) VALUES (?, ?) '
+                'ON CONFLICT (chat_id) DO UPDATE SET last_message_at = excluded.last_message_at',
+                last_message_rows
+            )
+    
+    def migrate_kv_store(self):
+        """Move legacy prefixed kv_store keys into users/message_map.
+
+        Safe to run repeatedly; returns the number of rows migrated per kind.
+        """
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT key, value, expires_at FROM kv_store WHERE key GLOB 'verified-*' "
+            "OR key GLOB 'verify-*' OR key GLOB 'isblocked-*' OR key GLOB 'lastmsg-*' "
+            "OR key GLOB 'msg-map-*'"
+        ).fetchall()
+        counts = {'verified': 0, 'verify': 0, 'isblocked': 0, 'lastmsg': 0, 'msg-map': 0}
+        if not rows:
+            return counts
+        
+        now = time.time()
+        with conn:
+            for key, value, expires_at in rows:
+                conn.execute('DELETE FROM kv_store WHERE key = ?', (key,))
+                kind = next(kind for kind in counts if key.startswith(f'{kind}-'))
+                ident = key[len(kind) + 1:]
+                if (expires_at and now > expires_at) or not ident.lstrip('-').isdigit():
+                    continue
+                try:
+                    value = json.loads(value)
+                except (TypeError, ValueError):
+                    pass
+                if kind == 'msg-map':
+                    conn.execute(
+                        'INSERT OR REPLACE INTO message_map (admin_chat_id, message_id, chat_id, expires_at) '
+                        'VALUES (?, ?, ?, ?)',
+                        (int(ADMIN_UID), int(ident), int(value), expires_at)
+                    )
+                else:
+                    if kind == 'verify' or (kind == 'verified' and not value):
+                        # Pending answers are not kept; challenges are stateless now
+                        continue
+                    column, column_value = {
+                        'verified': ('verified_until', expires_at or int(now + VERIFY_TTL)),
+                        'isblocked': ('is_blocked', int(bool(value))),
+                        'lastmsg': ('last_message_at', value)
+                    }[kind]
+                    conn.execute(
+                        f'INSERT INTO users (chat_id, {column}) VALUES (?, ?) '
+                        f'ON CONFLICT (chat_id) DO UPDATE SET {column} = excluded.{column}',
+                        (int(ident), column_value)
+                    )
+                counts[kind] += 1
+        logger.info(f'Migrated kv_store rows: {counts}')
+        return counts
+    
+    @metrics.timed('bot_db_seconds', 'op')
+    def incremental_vacuum(self, pages):
+        # executescript steps the pragma to completion; execute frees one page
+        self._conn().executescript(f'PRAGMA incremental_vacuum({int(pages)});')
 
 
 db = Database(DB_PATH)
 
 
+class ExpirySweeper:
+    """Deletes expired rows in bounded batches and reclaims pages.
+
+    Each batch is its own short transaction, so request threads can write
+    between batches of a long sweep.
+    """
+    
+    def __init__(self, database):
+        self.database = database
+        self.runs = 0
+        self.rows_reclaimed = 0
+        self.last_reclaimed = 0
+        self.last_run = 0
+    
+    def sweep(self):
+        reclaimed = 0
+        for _ in range(SWEEP_MAX_BATCHES):
+            deleted = self.database.delete_expired(SWEEP_BATCH_SIZE)
+            reclaimed += deleted
+            if deleted < SWEEP_BATCH_SIZE:
+                break
+        if reclaimed:
+            self.database.incremental_vacuum(SWEEP_VACUUM_PAGES)
+        self.runs += 1
+        self.rows_reclaimed += reclaimed
+        self.last_reclaimed = reclaimed
+        self.last_run = time.time()
+        return reclaimed
+    
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'rows_reclaimed': self.rows_reclaimed,
+            'last_reclaimed': self.last_reclaimed,
+            'last_run': self.last_run
+        }
+    
+    def start(self, interval):
+        """Sweep every interval seconds on a daemon thread"""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except sqlite3.Error as e:
+                    logger.error(f'Expiry sweep failed: {e}')
+        threading.Thread(target=run, name='expiry-sweeper', daemon=True).start()
+
+
+sweeper = ExpirySweeper(db)
+
+
 # HTTP client functions
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections shared by all threads, per host.
+
+    A request checks a connection out of its host's idle stack and returns
+    it once the response is read, so no two threads ever use one at the
+    same time. A reused connection the server has already closed is
+    dropped and the request is sent again on a fresh one.
+    """
+    
+    def __init__(self, max_idle_per_host, idle_timeout):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.reused = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+    
+    def _checkout(self, key):
+        """Return (connection, reused) for (scheme, host, port)"""
+        stale = []
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                conn, idle_since = idle.pop()
+                if time.monotonic() - idle_since < self.idle_timeout:
+                    self.reused += 1
+                    break
+                stale.append(conn)
+            else:
+                conn = None
+                self.created += 1
+        for old in stale:
+            old.close()
+        if conn is not None:
+            return conn, True
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, context=self._ssl_context), False
+        return http.client.HTTPConnection(host, port), False
+    
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+    
+    def request(self, method, url, body=None, headers=None, timeout=10):
+        """Send one request; returns (status, headers, body bytes)"""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = f'{parts.path or "/"}?{parts.query}' if parts.query else parts.path or '/'
+        headers = {'User-Agent': 'TelegramBot/1.0', **(headers or {})}
+        while True:
+            conn, reused = self._checkout(key)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (ConnectionError, ssl.SSLEOFError, ssl.SSLZeroReturnError, http.client.BadStatusLine):
+                conn.close()
+                if reused:
+                    # Closed by the server while idle; nothing was processed
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return resp.status, resp.headers, data
+    
+    def stats(self):
+        with self._lock:
+            idle = sum(len(conns) for conns in self._idle.values())
+        return {'created': self.created, 'reused': self.reused, 'idle': idle}
+
+
+http_pool = ConnectionPool(HTTP_POOL_PER_HOST, HTTP_KEEPALIVE)
+
+
 def http_get(url, timeout=10):
-    """Simple HTTP GET request"""
+    """HTTP GET over the shared pool; returns the body text or None"""
     try:
-        req = urllib.request.Request(url, headers={'User-Agent': 'TelegramBot/1.0'})
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            return resp.read().decode('utf-8')
+        status, _, body = http_pool.request('GET', url, timeout=timeout)
     except Exception as e:
         logger.error(f'HTTP GET failed: {e}')
         return None
+    if status != 200:
+        logger.error(f'HTTP GET failed: status {status}')
+        return None
+    return body.decode('utf-8')
 
 
 def http_post_json(url, data, timeout=10):
-    """Simple HTTP POST request with JSON body"""
+    """POST a JSON body over the shared pool and decode the JSON answer"""
     try:
-        json_data = json.dumps(data).encode('utf-8')
-        req = urllib.request.Request(
-            url,
-            data=json_data,
-            headers={
-                'Content-Type': 'application/json',
-                'User-Agent': 'TelegramBot/1.0'
-            }
+        status, _, body = http_pool.request(
+            'POST', url, json_dumps(data).encode('utf-8'),
+            {'Content-Type': 'application/json'}, timeout=timeout
         )
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            return json.loads(resp.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        try:
-            error_body = e.read().decode('utf-8')
-            return json.loads(error_body)
-        except:
-            return {'ok': False, 'error': str(e)}
     except Exception as e:
         logger.error(f'HTTP POST failed: {e}')
         return {'ok': False, 'error': str(e)}
+    try:
+        return json_loads(body)
+    except ValueError:
+        return {'ok': False, 'error': f'HTTP {status}'}
+
+
+# Outbound rate limiting
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+    
+    def try_acquire(self, reserve=0):
+        """Take a token if more than `reserve` remain, else return seconds to wait"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= reserve + 1:
+                self.tokens -= 1
+                return 0
+            return (reserve + 1 - self.tokens) / self.rate
+    
+    def block(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """Global and per-chat token buckets for outbound messages"""
+    
+    def __init__(self, global_rate, chat_rate, chat_burst):
+        # Below one token of capacity a bucket can never hand one out
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = max(chat_burst, 1)
+        self.chat_buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _chat_bucket(self, chat_id):
+        chat_id = str(chat_id)
+        with self._lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                if len(self.chat_buckets) > MAX_CHAT_BUCKETS:
+                    self.chat_buckets.popitem(last=False)
+            else:
+                self.chat_buckets.move_to_end(chat_id)
+            return bucket
+    
+    def acquire(self, chat_id, priority=PRIORITY_NORMAL):
+        bucket = self._chat_bucket(chat_id)
+        while True:
+            wait = bucket.try_acquire()
+            if not wait:
+                break
+            time.sleep(wait)
+        reserve = self.lane_reserve(priority)
+        while True:
+            wait = self.global_bucket.try_acquire(reserve)
+            if not wait:
+                break
+            time.sleep(wait)
+    
+    def lane_reserve(self, priority):
+        """Tokens a lane must leave in the global bucket.
+
+        Capped at capacity - 1, so at low rates every lane can still reach
+        a token; the lower lanes then wait for a full bucket.
+        """
+        capacity = self.global_bucket.capacity
+        return min(capacity * LANE_RESERVE[priority], capacity - 1)
+    
+    def block(self, chat_id, seconds):
+        """Honor a 429 retry_after for one chat, or globally without one"""
+        bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+        bucket.block(seconds)
+
+
+rate_limiter = RateLimiter(API_GLOBAL_RATE, API_CHAT_RATE, API_CHAT_BURST)
+
+
+def retry_delay(attempt):
+    return API_RETRY_BASE * 2 ** attempt * random.uniform(0.5, 1.5)
 
 
 # Telegram API functions
-def api_request(method, data=None):
-    url = f'https://api.telegram.org/bot{BOT_TOKEN}/{method}'
-    result = http_post_json(url, data or {})
-    if not result.get('ok'):
+def api_request(method, data=None, timeout=10, priority=PRIORITY_NORMAL):
+    """Call a Bot API method under the rate limiter.
+
+    429s wait for retry_after, 5xx and network errors are retried with
+    jittered backoff; other errors are returned immediately.
+    """
+    url = f'{TELEGRAM_API_URL}/bot{BOT_TOKEN}/{method}'
+    chat_id = data.get('chat_id') if data else None
+    labels = f'method="{method}"'
+    for attempt in range(API_MAX_RETRIES + 1):
+        if chat_id is not None:
+            rate_limiter.acquire(chat_id, priority)
+        with metrics.timer('bot_api_request_seconds', labels, 'bot_api_requests_in_flight'):
+            result = http_post_json(url, data or {}, timeout=timeout)
+        if result.get('ok'):
+            return result
         logger.error(f'API error: {result}')
+        metrics.inc('bot_api_errors_total', labels)
+        error_code = result.get('error_code')
+        if error_code == 429:
+            metrics.inc('bot_api_rate_limited_total', labels)
+            delay = result.get('parameters', {}).get('retry_after', 1)
+            rate_limiter.block(chat_id, delay)
+        elif error_code is None or error_code >= 500:
+            # No error_code means the request never got a Bot API answer
+            delay = retry_delay(attempt)
+        else:
+            return result
+        if attempt < API_MAX_RETRIES:
+            time.sleep(delay)
     return result
 
 
-def send_message(chat_id, text, reply_markup=None):
+def send_message(chat_id, text, reply_markup=None, priority=PRIORITY_NORMAL, thread_id=None):
     data = {'chat_id': chat_id, 'text': text}
     if reply_markup:
         data['reply_markup'] = reply_markup
-    return api_request('sendMessage', data)
+    if thread_id:
+        data['message_thread_id'] = thread_id
+    return api_request('sendMessage', data, priority=priority)
 
 
-def copy_message(chat_id, from_chat_id, message_id):
+def copy_message(chat_id, from_chat_id, message_id, priority=PRIORITY_HIGH):
     return api_request('copyMessage', {
         'chat_id': chat_id,
         'from_chat_id': from_chat_id,
         'message_id': message_id
-    })
+    }, priority=priority)
 
 
-def forward_message(chat_id, from_chat_id, message_id):
-    return api_request('forwardMessage', {
+def forward_message(chat_id, from_chat_id, message_id, thread_id=None):
+    data = {
         'chat_id': chat_id,
         'from_chat_id': from_chat_id,
         'message_id': message_id
-    })
+    }
+    if thread_id:
+        data['message_thread_id'] = thread_id
+    return api_request('forwardMessage', data)
+
+
+def forward_messages(chat_id, from_chat_id, message_ids, thread_id=None):
+    """Forward an album in one call; message_ids must be ascending"""
+    data = {
+        'chat_id': chat_id,
+        'from_chat_id': from_chat_id,
+        'message_ids': message_ids
+    }
+    if thread_id:
+        data['message_thread_id'] = thread_id
+    return api_request('forwardMessages', data)
+
+
+def copy_messages(chat_id, from_chat_id, message_ids, priority=PRIORITY_HIGH):
+    """Copy an album in one call; message_ids must be ascending"""
+    return api_request('copyMessages', {
+        'chat_id': chat_id,
+        'from_chat_id': from_chat_id,
+        'message_ids': message_ids
+    }, priority=priority)
 
 
 def edit_message_text(chat_id, message_id, text):
@@ -183,26 +1212,29 @@ def answer_callback_query(callback_query_id, text, show_alert=False):
 
 
 # Math verification
+challenge_rng = secrets.SystemRandom()
+
+
 def generate_math_problem():
     """Generate math problem with answer <= 100"""
     operators = ['+', '-', '*', '/']
-    operator = random.choice(operators)
+    operator = challenge_rng.choice(operators)
     
     if operator == '+':
-        a = random.randint(1, 50)
-        b = random.randint(1, 50)
+        a = challenge_rng.randint(1, 50)
+        b = challenge_rng.randint(1, 50)
         answer = a + b
     elif operator == '-':
-        a = random.randint(1, 100)
-        b = random.randint(0, a)
+        a = challenge_rng.randint(1, 100)
+        b = challenge_rng.randint(0, a)
         answer = a - b
     elif operator == '*':
-        a = random.randint(1, 10)
-        b = random.randint(1, 10)
+        a = challenge_rng.randint(1, 10)
+        b = challenge_rng.randint(1, 10)
         answer = a * b
     else:  # division
-        b = random.randint(1, 9)
-        answer = random.randint(1, 10)
+        b = challenge_rng.randint(1, 9)
+        answer = challenge_rng.randint(1, 10)
         a = answer * b
     
     if answer > 100:
@@ -216,27 +1248,500 @@ def generate_options(correct_answer):
     """Generate 4 options including the correct answer"""
     options = [correct_answer]
     while len(options) < 4:
-        wrong = correct_answer + random.randint(-10, 10)
+        wrong = correct_answer + challenge_rng.randint(-10, 10)
         if wrong != correct_answer and wrong not in options and wrong > 0:
             options.append(wrong)
-    random.shuffle(options)
+    challenge_rng.shuffle(options)
     return options
 
 
+class ChallengePool:
+    """Pre-generated verification questions, ready to send.
+
+    Each entry holds the message text, the answer, the options and the
+    inline keyboard already serialized to JSON with %s slots for the
+    per-chat signed callback_data, so the hot path only fills in four
+    tokens. When it runs low a short-lived thread tops it up, so request
+    threads only pay for a question if the pool is completely empty.
+    """
+    
+    def __init__(self, size):
+        self.size = size
+        self._entries = deque()
+        self._refilling = threading.Lock()
+        self.refill()
+    
+    @staticmethod
+    def _build():
+        problem = generate_math_problem()
+        answer = int(problem['answer'])
+        options = generate_options(answer)
+        buttons = [{'text': str(option), 'callback_data': '%s'} for option in options]
+        markup_template = json.dumps({'inline_keyboard': [buttons[:2], buttons[2:]]})
+        text = f'Please answer the following question to verify you are not a bot:\n\n{problem["question"]} = ?'
+        return text, answer, options, markup_template
+    
+    def refill(self):
+        try:
+            while len(self._entries) < self.size:
+                self._entries.append(self._build())
+        finally:
+            if self._refilling.locked():
+                self._refilling.release()
+    
+    def _schedule_refill(self):
+        if self._refilling.acquire(blocking=False):
+            threading.Thread(target=self.refill, name='challenge-refill', daemon=True).start()
+    
+    def take(self):
+        """Return (text, answer, options, markup_template)"""
+        if len(self._entries) < self.size // 4:
+            self._schedule_refill()
+        try:
+            return self._entries.popleft()
+        except IndexError:
+            return self._build()
+
+
+challenge_pool = ChallengePool(CHALLENGE_POOL_SIZE)
+
+
 # Fraud detection
+class FraudList:
+    """Set of fraudulent user IDs kept in memory and refreshed in the background.
+
+    The list is persisted to cache_path so a restart can serve lookups
+    before the network is reachable; refreshes use ETag/If-Modified-Since
+    so an unchanged list costs a 304.
+    """
+    
+    def __init__(self, url, cache_path):
+        self.url = url
+        self.cache_path = cache_path
+        self.ids = frozenset()
+        self.etag = None
+        self.last_modified = None
+        self.updated_at = 0
+        self._load_cache()
+    
+    def __contains__(self, user_id):
+        return str(user_id) in self.ids
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    @staticmethod
+    def _parse(text):
+        return frozenset(line.strip() for line in text.split('\n') if line.strip())
+    
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                self.ids = self._parse(f.read())
+            with open(self.cache_path + '.meta', encoding='utf-8') as f:
+                meta = json.load(f)
+            self.etag = meta.get('etag')
+            self.last_modified = meta.get('last_modified')
+            self.updated_at = meta.get('updated_at', 0)
+        except (OSError, ValueError):
+            pass
+    
+    def _store_cache(self, text):
+        meta = {
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'updated_at': self.updated_at
+        }
+        try:
+            for path, content in ((self.cache_path, text), (self.cache_path + '.meta', json.dumps(meta))):
+                # A temp file of our own: every worker refreshes at startup
+                fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        f.write(content)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+        except OSError as e:
+            logger.error(f'Failed to persist fraud list: {e}')
+    
+    def _request_headers(self):
+        headers = {'User-Agent': 'TelegramBot/1.0'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+    
+    def _apply(self, status, headers, text):
+        """Swap in a freshly downloaded list; returns True if it changed"""
+        self.updated_at = time.time()
+        if status == 304:
+            return False
+        self.ids = self._parse(text)
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+        self._store_cache(text)
+        logger.info(f'Fraud list updated: {len(self.ids)} entries')
+        return True
+    
+    def refresh(self, timeout=10):
+        try:
+            status, headers, body = http_pool.request('GET', self.url, headers=self._request_headers(), timeout=timeout)
+        except Exception as e:
+            logger.error(f'Fraud list refresh failed: {e}')
+            return False
+        if status == 200:
+            return self._apply(status, headers, body.decode('utf-8'))
+        if status == 304:
+            return self._apply(status, headers, None)
+        logger.error(f'Fraud list refresh failed: status {status}')
+        return False
+    
+    def start(self, interval):
+        """Refresh now and then every interval seconds on a daemon thread"""
+        def run():
+            while True:
+                self.refresh()
+                time.sleep(interval)
+        threading.Thread(target=run, name='fraud-refresh', daemon=True).start()
+
+
+fraud_list = FraudList(FRAUD_DB_URL, FRAUD_CACHE_PATH)
+
+
 def is_fraud(user_id):
     """Check if user is in fraud database"""
+    start = time.perf_counter()
+    found = user_id in fraud_list
+    metrics.observe('bot_fraud_check_seconds', time.perf_counter() - start)
+    return found
+
+
+# Signed verification challenges
+def challenge_signature(chat_id, option, expires, correct):
+    mac = CHALLENGE_MAC.copy()
+    mac.update(f'{chat_id}:{option}:{expires}:{int(correct)}'.encode())
+    return base64.urlsafe_b64encode(mac.digest()[:12]).decode()
+
+
+def challenge_callback_data(chat_id, option, answer, expires):
+    """Signed, expiring button payload (~36 bytes; Telegram allows 64).
+
+    Whether the option is correct is only part of the signed message, so the
+    payload does not reveal the answer.
+    """
+    signature = challenge_signature(chat_id, option, expires, option == answer)
+    return f'verify_{option}_{expires:x}_{signature}'
+
+
+def check_challenge(chat_id, data):
+    """True/False for a right/wrong answer, None if forged or expired"""
+    parts = data.split('_', 3)
+    if len(parts) != 4:
+        return None
+    _, option, expires, signature = parts
     try:
-        text = http_get(FRAUD_DB_URL)
-        if text:
-            fraud_list = [line.strip() for line in text.split('\n') if line.strip()]
-            return str(user_id) in fraud_list
-    except:
-        pass
-    return False
+        expires = int(expires, 16)
+    except ValueError:
+        return None
+    if time.time() > expires:
+        return None
+    for correct in (True, False):
+        if hmac.compare_digest(signature, challenge_signature(chat_id, option, expires, correct)):
+            return correct
+    return None
+
+
+# Chats that were sent a challenge recently get a reminder instead of a new one
+recent_challenges = TTLCache(USER_CACHE_SIZE, CHALLENGE_TTL)
+
+
+class FloodGuard:
+    """Sliding-window counters for messages from unverified chats.
+
+    The global rate is counted in one-second slots over RAID_WINDOW. Raid
+    mode starts when it reaches `threshold` per second and ends once it has
+    stayed under half that for RAID_COOLDOWN seconds. Per-chat windows keep
+    the times of each chat's last reminders, bounded like the rate limiter's
+    buckets.
+    """
+    
+    def __init__(self, threshold, challenge_rate):
+        self.threshold = threshold
+        self.raid = False
+        self.raids = 0
+        self.dropped = {'raid': 0, 'challenge': 0, 'reminder': 0}
+        self._slots = [0] * RAID_WINDOW
+        self._slot_seconds = [0] * RAID_WINDOW
+        self._busy_at = 0
+        self._reminders = OrderedDict()
+        self._challenges = TokenBucket(challenge_rate, max(challenge_rate, 1))
+        self._lock = threading.Lock()
+    
+    def rate(self, now=None):
+        """Unverified messages per second over the last RAID_WINDOW seconds"""
+        second = int(time.monotonic() if now is None else now)
+        total = sum(count for count, at in zip(self._slots, self._slot_seconds) if second - at < RAID_WINDOW)
+        return total / RAID_WINDOW
+    
+    def record(self):
+        """Count one unverified message; returns whether raid mode is on"""
+        now = time.monotonic()
+        second = int(now)
+        slot = second % RAID_WINDOW
+        with self._lock:
+            if self._slot_seconds[slot] != second:
+                self._slot_seconds[slot] = second
+                self._slots[slot] = 0
+            self._slots[slot] += 1
+            
+            rate = self.rate(now)
+            if rate >= self.threshold / 2:
+                self._busy_at = now
+                if rate >= self.threshold and not self.raid:
+                    self.raid = True
+                    self.raids += 1
+                    metrics.inc('bot_raid_mode')
+                    logger.warning(f'Raid mode on: {rate:.0f} unverified messages/s')
+            elif self.raid and now - self._busy_at >= RAID_COOLDOWN:
+                self.raid = False
+                metrics.inc('bot_raid_mode', value=-1)
+                logger.warning(f'Raid mode off after dropping {self.dropped}')
+            return self.raid
+    
+    def allow_challenge(self):
+        """New challenges are rationed while a raid is on"""
+        return not self.raid or self._challenges.try_acquire() == 0
+    
+    def allow_reminder(self, chat_id):
+        """At most CHAT_REMINDER_LIMIT reminders per chat per CHAT_REMINDER_WINDOW"""
+        now = time.monotonic()
+        with self._lock:
+            sent = self._reminders.get(chat_id)
+            if sent is None:
+                sent = self._reminders[chat_id] = deque(maxlen=CHAT_REMINDER_LIMIT)
+                if len(self._reminders) > MAX_CHAT_BUCKETS:
+                    self._reminders.popitem(last=False)
+            else:
+                self._reminders.move_to_end(chat_id)
+            if len(sent) == CHAT_REMINDER_LIMIT and now - sent[0] < CHAT_REMINDER_WINDOW:
+                return False
+            sent.append(now)
+            return True
+    
+    def drop(self, reason):
+        with self._lock:
+            self.dropped[reason] += 1
+        metrics.inc('bot_flood_dropped_total', f'reason="{reason}"')
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'raid': self.raid,
+                'unverified_per_second': round(self.rate(), 1),
+                'raids': self.raids,
+                'dropped': dict(self.dropped)
+            }
+
+
+flood_guard = FloodGuard(RAID_THRESHOLD, RAID_CHALLENGE_RATE)
+
+
+# Admin routing
+def ring_hash(key):
+    """Stable 64-bit hash; hash() is salted per process"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hashing of guest chats onto admin chats.
+
+    Each admin owns `replicas` points on the ring, so adding or removing one
+    only moves the guests whose points it takes over or gives up.
+    """
+    
+    def __init__(self, nodes, replicas=ADMIN_RING_REPLICAS):
+        points = sorted((ring_hash(f'{node}#{i}'), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+    
+    def get(self, key):
+        index = bisect_left(self._hashes, ring_hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+admin_ring = HashRing(ADMIN_UIDS)
+ADMIN_CHATS = frozenset([*ADMIN_UIDS, ADMIN_GROUP_ID] if ADMIN_GROUP_ID else ADMIN_UIDS)
+
+
+def admin_chat_for(chat_id):
+    """Admin chat a guest's messages are forwarded to"""
+    return ADMIN_GROUP_ID or admin_ring.get(chat_id)
+
+
+class KeyedLock:
+    """One threading.Lock per key, dropped once nobody holds or waits for it"""
+    
+    def __init__(self):
+        self._locks = {}  # key -> [lock, holders and waiters]
+        self._lock = threading.Lock()
+    
+    @contextmanager
+    def hold(self, key):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+    
+    def __len__(self):
+        return len(self._locks)
+
+
+topic_locks = KeyedLock()
+
+
+def admin_topic_for(chat_id, message, user):
+    """Guest's forum topic in ADMIN_GROUP_ID, created on first contact"""
+    if user['topic_id']:
+        return user['topic_id']
+    # A guest's first messages arrive together; only one of them creates the topic
+    with topic_locks.hold(int(chat_id)):
+        user = db.get_user(chat_id)
+        if user['topic_id']:
+            return user['topic_id']
+        sender = message.get('from', {})
+        name = ' '.join(filter(None, (sender.get('first_name'), sender.get('last_name'))))
+        result = api_request('createForumTopic', {
+            'chat_id': ADMIN_GROUP_ID,
+            'name': f'{name[:100]} ({chat_id})'.lstrip()
+        })
+        if not result.get('ok'):
+            return None  # forward into the General topic instead
+        topic_id = result['result']['message_thread_id']
+        db.set_topic(chat_id, topic_id)
+        # Messages in a topic reply to its creation message, so they map to the guest
+        db.put_message_map(ADMIN_GROUP_ID, topic_id, chat_id)
+        return topic_id
+
+
+def resolve_guest(message):
+    """Guest an admin message is about: the forward it replies to, else its topic"""
+    admin_chat_id = message.get('chat', {}).get('id')
+    reply_to = message.get('reply_to_message')
+    guest_chat_id = None
+    if reply_to:
+        guest_chat_id = db.get_message_map(admin_chat_id, reply_to.get('message_id'))
+    if guest_chat_id is None and message.get('is_topic_message'):
+        guest_chat_id = db.get_message_map(admin_chat_id, message.get('message_thread_id'))
+    return guest_chat_id
+
+
+def reply_admin(message, text):
+    """Answer an admin in the chat, and forum topic, the command came from"""
+    thread_id = message.get('message_thread_id') if message.get('is_topic_message') else None
+    return send_message(message.get('chat', {}).get('id'), text, thread_id=thread_id)
+
+
+class MediaGroupBuffer:
+    """Collects the items of an album so they are sent on with one API call.
+
+    Telegram delivers every album item as its own update carrying the same
+    media_group_id. The first item opens a group that is due `window` seconds
+    later; items arriving before then join it. One flusher thread hands due
+    groups, in message_id order, to a fixed pool of sender threads, so an
+    album never starts a thread of its own. Handlers return as soon as an
+    item is buffered.
+    """
+    
+    def __init__(self, window, senders=MEDIA_GROUP_SENDERS):
+        self.window = window
+        self.groups = {}
+        self.batches = 0
+        self.messages = 0
+        # Groups in the order they fall due: the window is the same for all
+        self._due = deque()
+        self._sending = 0
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=senders, thread_name_prefix='media-group')
+        self._flusher = None
+    
+    def add(self, message, callback):
+        key = (message['chat']['id'], message['media_group_id'])
+        with self._cond:
+            group = self.groups.get(key)
+            if group is not None:
+                group.append(message)
+                return
+            self.groups[key] = [message]
+            self._due.append((time.monotonic() + self.window, key, callback))
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='media-group-flusher', daemon=True)
+                self._flusher.start()
+            self._cond.notify_all()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._cond.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                _, key, callback = self._due.popleft()
+                messages = sorted(self.groups.pop(key), key=lambda m: m['message_id'])
+                self._sending += 1
+                self.batches += 1
+                self.messages += len(messages)
+            self._pool.submit(self._send, key, callback, messages)
+    
+    def _send(self, key, callback, messages):
+        try:
+            callback(messages)
+        except Exception as e:
+            logger.error(f'Error sending media group {key[1]}: {e}')
+        finally:
+            with self._cond:
+                self._sending -= 1
+                self._cond.notify_all()
+    
+    def drain(self):
+        """Wait for open groups to be sent; each is at most `window` away"""
+        with self._cond:
+            while self.groups or self._sending:
+                self._cond.wait()
+    
+    def stats(self):
+        return {'open': len(self.groups), 'batches': self.batches, 'messages': self.messages}
+
+
+media_groups = MediaGroupBuffer(MEDIA_GROUP_WINDOW)
+
+
+def reply_to_guest(messages):
+    """Copy an admin reply, one message or an album, to the guest it answers"""
+    message = messages[0]
+    admin_chat_id = message['chat']['id']
+    for item in messages:
+        guest_chat_id = resolve_guest(item)
+        if guest_chat_id:
+            break
+    else:
+        if str(admin_chat_id) == ADMIN_GROUP_ID and not message.get('is_topic_message'):
+            return  # an album shared in the General topic
+        return reply_admin(message, 'Cannot find corresponding user')
+    if len(messages) == 1:
+        return copy_message(guest_chat_id, admin_chat_id, message['message_id'])
+    return copy_messages(guest_chat_id, admin_chat_id, [item['message_id'] for item in messages])
 
 
 # Message handlers
+@metrics.timed('bot_handler_seconds', 'handler')
 def handle_message(message):
     chat_id = str(message.get('chat', {}).get('id', ''))
     text = message.get('text', '')
@@ -250,13 +1755,26 @@ def handle_message(message):
         )
     
     # Admin commands
-    if chat_id == ADMIN_UID:
-        reply_to = message.get('reply_to_message')
-        if not reply_to:
-            return send_message(
-                ADMIN_UID,
+    if chat_id in ADMIN_CHATS:
+        command, *args = text.split(None, 1) or ['']
+        if command in ('/block', '/unblock') and args:
+            return handle_bulk_block(message, command, args[0].replace(',', ' ').split())
+        if command == '/broadcast':
+            return handle_broadcast(message, args[0].strip() if args else '')
+        
+        # Album items may not all carry the reply, so they are resolved as a group
+        if message.get('media_group_id'):
+            return media_groups.add(message, reply_to_guest)
+        
+        if not message.get('reply_to_message') and not message.get('is_topic_message'):
+            if chat_id == ADMIN_GROUP_ID:
+                return  # admins talking in the General topic
+            return reply_admin(
+                message,
                 'Usage: Reply to a forwarded message and send your reply, '
-                'or use `/block`, `/unblock`, `/checkblock` commands'
+                'or use `/block`, `/unblock`, `/checkblock` commands.\n'
+                '`/block <uid> ...` or `/block recent 30m` blocks many users at once, '
+                '`/broadcast <text>` messages every verified user'
             )
         
         if text == '/block':
@@ -267,85 +1785,99 @@ def handle_message(message):
             return check_block(message)
         
         # Reply to user
-        guest_chat_id = db.get(f'msg-map-{reply_to.get("message_id")}')
-        if guest_chat_id:
-            return copy_message(guest_chat_id, chat_id, message.get('message_id'))
-        return send_message(ADMIN_UID, 'Cannot find corresponding user')
+        return reply_to_guest([message])
     
     # Regular user
     return handle_guest_message(message)
 
 
+@metrics.timed('bot_handler_seconds', 'handler')
 def handle_guest_message(message):
     chat_id = str(message.get('chat', {}).get('id', ''))
+    challenged = recent_challenges.get(int(chat_id)) is not MISSING
+    
+    # In a raid, chats with a challenge outstanding are dropped before any DB or API work
+    if challenged and flood_guard.record():
+        flood_guard.drop('raid')
+        return
+    
+    user = db.get_user(chat_id)
     
     # Check if blocked
-    if db.get(f'isblocked-{chat_id}'):
+    if user['blocked']:
         return send_message(chat_id, 'You are blocked')
     
     # Check verification status
-    verified = db.get(f'verified-{chat_id}')
-    if not verified:
-        expected = db.get(f'verify-{chat_id}')
-        
-        if not expected:
-            # Generate verification problem
-            problem = generate_math_problem()
-            db.put(f'verify-{chat_id}', problem['answer'])
+    if not user['verified']:
+        if not challenged:
+            if flood_guard.record() and not flood_guard.allow_challenge():
+                flood_guard.drop('challenge')
+                return
             
-            options = generate_options(int(problem['answer']))
-            keyboard = {
-                'inline_keyboard': [
-                    [
-                        {'text': str(options[0]), 'callback_data': f'verify_{options[0]}_{problem["answer"]}'},
-                        {'text': str(options[1]), 'callback_data': f'verify_{options[1]}_{problem["answer"]}'}
-                    ],
-                    [
-                        {'text': str(options[2]), 'callback_data': f'verify_{options[2]}_{problem["answer"]}'},
-                        {'text': str(options[3]), 'callback_data': f'verify_{options[3]}_{problem["answer"]}'}
-                    ]
-                ]
-            }
+            # Take a pre-generated problem and sign its buttons for this chat
+            text, answer, options, markup_template = challenge_pool.take()
+            recent_challenges.put(int(chat_id), True, recent_challenges.version)
+            
+            expires = int(time.time()) + CHALLENGE_TTL
+            reply_markup = markup_template % tuple(
+                challenge_callback_data(chat_id, option, answer, expires) for option in options
+            )
             
             return send_message(
-                chat_id,
-                f'Please answer the following question to verify you are not a bot:\n\n{problem["question"]} = ?',
-                reply_markup=keyboard
+                chat_id, text,
+                reply_markup=reply_markup,
+                priority=PRIORITY_LOW
             )
+        elif not flood_guard.allow_reminder(int(chat_id)):
+            flood_guard.drop('reminder')
+            return
         else:
-            return send_message(chat_id, 'Please click the button above to select your answer')
+            return send_message(
+                chat_id, 'Please click the button above to select your answer',
+                priority=PRIORITY_LOW
+            )
     
     # Fraud check
     if is_fraud(chat_id):
-        return send_message(ADMIN_UID, f'Warning: Fraud detected\nUID: {chat_id}')
-    
-    # Forward message to admin
-    forward_result = forward_message(
-        ADMIN_UID,
-        message.get('chat', {}).get('id'),
-        message.get('message_id')
-    )
-    
-    if forward_result.get('ok'):
-        db.put(
-            f'msg-map-{forward_result["result"]["message_id"]}',
-            chat_id,
-            ttl=2592000  # 30 days
+        return send_message(admin_chat_for(chat_id), f'Warning: Fraud detected\nUID: {chat_id}')
+    
+    # Album items are collected and forwarded together
+    if message.get('media_group_id'):
+        return media_groups.add(message, partial(forward_to_admin, chat_id, user))
+    return forward_to_admin(chat_id, user, [message])
+
+
+def forward_to_admin(chat_id, user, messages):
+    """Forward a guest message, or a whole album in one call, to their admin chat"""
+    admin_chat_id = admin_chat_for(chat_id)
+    topic_id = admin_topic_for(chat_id, messages[0], user) if ADMIN_GROUP_ID else None
+    from_chat_id = messages[0]['chat']['id']
+    if len(messages) == 1:
+        forward_result = forward_message(admin_chat_id, from_chat_id, messages[0]['message_id'], thread_id=topic_id)
+        forwarded_ids = [forward_result['result']['message_id']] if forward_result.get('ok') else []
+    else:
+        forward_result = forward_messages(
+            admin_chat_id, from_chat_id, [m['message_id'] for m in messages], thread_id=topic_id
         )
+        forwarded_ids = [m['message_id'] for m in forward_result['result']] if forward_result.get('ok') else []
+    
+    if forwarded_ids:
+        db.put_message_maps(admin_chat_id, forwarded_ids, chat_id, ttl=2592000)  # 30 days
         
         # Notification feature
         if ENABLE_NOTIFICATION:
-            last_msg_time = db.get(f'lastmsg-{chat_id}')
+            last_msg_time = user['last_message_at']
             if not last_msg_time or time.time() - last_msg_time > NOTIFY_INTERVAL:
-                db.put(f'lastmsg-{chat_id}', time.time())
+                db.set_last_message(chat_id, time.time())
                 try:
                     notification = http_get(NOTIFICATION_URL)
                     if notification:
-                        send_message(ADMIN_UID, notification)
+                        send_message(admin_chat_id, notification, thread_id=topic_id)
                 except:
                     pass
 
 
+@metrics.timed('bot_handler_seconds', 'handler')
 def handle_callback_query(callback_query):
     user_id = str(callback_query.get('from', {}).get('id', ''))
     data = callback_query.get('data', '')
@@ -355,15 +1887,17 @@ def handle_callback_query(callback_query):
     if not data.startswith('verify_'):
         return
     
-    parts = data.split('_')
-    if len(parts) != 3:
-        return
-    
-    _, user_answer, correct_answer = parts
+    correct = check_challenge(user_id, data)
+    if correct is None:
+        return answer_callback_query(
+            callback_query_id,
+            'This question is no longer valid, send a message to get a new one',
+            show_alert=True
+        )
     
-    if user_answer == correct_answer:
-        db.put(f'verified-{user_id}', True, ttl=259200)  # 3 days
-        db.delete(f'verify-{user_id}')
+    if correct:
+        db.set_verified(user_id, ttl=VERIFY_TTL)
+        recent_challenges.invalidate(int(user_id))
         
         edit_message_text(
             user_id, message_id,
@@ -378,44 +1912,488 @@ def handle_callback_query(callback_query):
 
 
 def handle_block(message):
-    reply_to = message.get('reply_to_message')
-    guest_chat_id = db.get(f'msg-map-{reply_to.get("message_id")}')
+    guest_chat_id = resolve_guest(message)
     
     if not guest_chat_id:
-        return send_message(ADMIN_UID, 'Cannot find corresponding user')
+        return reply_admin(message, 'Cannot find corresponding user')
     
-    if guest_chat_id == ADMIN_UID:
-        return send_message(ADMIN_UID, 'Cannot block yourself')
+    if guest_chat_id in ADMIN_CHATS:
+        return reply_admin(message, 'Cannot block yourself')
     
-    db.put(f'isblocked-{guest_chat_id}', True)
-    return send_message(ADMIN_UID, f'UID:{guest_chat_id} blocked successfully')
+    db.set_blocked(guest_chat_id, True)
+    return reply_admin(message, f'UID:{guest_chat_id} blocked successfully')
 
 
 def handle_unblock(message):
-    reply_to = message.get('reply_to_message')
-    guest_chat_id = db.get(f'msg-map-{reply_to.get("message_id")}')
+    guest_chat_id = resolve_guest(message)
     
     if not guest_chat_id:
-        return send_message(ADMIN_UID, 'Cannot find corresponding user')
+        return reply_admin(message, 'Cannot find corresponding user')
     
-    db.put(f'isblocked-{guest_chat_id}', False)
-    return send_message(ADMIN_UID, f'UID:{guest_chat_id} unblocked successfully')
+    db.set_blocked(guest_chat_id, False)
+    return reply_admin(message, f'UID:{guest_chat_id} unblocked successfully')
 
 
 def check_block(message):
-    reply_to = message.get('reply_to_message')
-    guest_chat_id = db.get(f'msg-map-{reply_to.get("message_id")}')
+    guest_chat_id = resolve_guest(message)
     
     if not guest_chat_id:
-        return send_message(ADMIN_UID, 'Cannot find corresponding user')
+        return reply_admin(message, 'Cannot find corresponding user')
     
-    blocked = db.get(f'isblocked-{guest_chat_id}')
+    blocked = db.get_user(guest_chat_id)['blocked']
     status = 'is blocked' if blocked else 'is not blocked'
-    return send_message(ADMIN_UID, f'UID:{guest_chat_id} {status}')
+    return reply_admin(message, f'UID:{guest_chat_id} {status}')
+
+
+# Bulk admin operations
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(text):
+    """'90s', '30m', '2h' or '1d' in seconds, None if malformed"""
+    unit = DURATION_UNITS.get(text[-1:].lower())
+    if unit is None or not text[:-1].isdigit():
+        return None
+    return int(text[:-1]) * unit
+
+
+def handle_bulk_block(message, command, args):
+    """/block or /unblock a list of UIDs, or `recent <age> [<age>]` for everyone
+    verified in that window, in one transaction
+    """
+    usage = f'Usage: {command} <uid> [<uid> ...] or {command} recent <age> [<age>], e.g. {command} recent 30m'
+    if args[0] == 'recent':
+        ages = [parse_duration(arg) for arg in args[1:]]
+        if not 1 <= len(ages) <= 2 or None in ages:
+            return reply_admin(message, usage)
+        now = time.time()
+        chat_ids = db.verified_between(now - max(ages), now - min(ages) if len(ages) == 2 else now)
+    else:
+        if not all(arg.lstrip('-').isdigit() for arg in args):
+            return reply_admin(message, usage)
+        chat_ids = args
+    
+    chat_ids = [chat_id for chat_id in dict.fromkeys(chat_ids) if chat_id not in ADMIN_CHATS]
+    blocked = command == '/block'
+    db.set_blocked_many(chat_ids, blocked)
+    return reply_admin(message, f'{len(chat_ids)} UIDs {"blocked" if blocked else "unblocked"} successfully')
+
+
+BROADCAST_KEY = 'broadcast'
+
+
+def broadcast_progress(job):
+    done = job['sent'] + job['failed']
+    return (f"Broadcast {job['status']}: {done}/{job['total']} processed, "
+            f"{job['sent']} sent, {job['failed']} failed")
+
+
+class Broadcaster:
+    """Fans one admin message out to every verified user.
+
+    The job lives in kv_store under BROADCAST_KEY and its recipient cursor is
+    saved after every chunk, so after a restart it is picked up again and
+    re-sends at most one chunk. Cancelling flips the stored status, which the
+    sender checks between chunks.
+    """
+    
+    def __init__(self):
+        self.future = None
+        self._stop = threading.Event()
+        # Long-lived threads, as each thread that sends keeps a metrics shard
+        self._runner = ThreadPoolExecutor(max_workers=1, thread_name_prefix='broadcast')
+        self._pool = ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix='broadcast-send')
+    
+    def start(self, job):
+        self._stop.clear()
+        self.future = self._runner.submit(self._run, job)
+    
+    def resume(self):
+        """Restart a broadcast a restart interrupted"""
+        job = db.get(BROADCAST_KEY)
+        if job is not None and job['status'] == 'running':
+            logger.info(f'Resuming broadcast: {broadcast_progress(job)}')
+            self.start(job)
+    
+    def stop(self, timeout):
+        self._stop.set()
+        if self.future is not None:
+            wait([self.future], timeout)
+    
+    def _send(self, job, chat_id):
+        if job['text']:
+            return send_message(chat_id, job['text'], priority=PRIORITY_LOW)
+        return copy_message(chat_id, job['from_chat_id'], job['message_id'], priority=PRIORITY_LOW)
+    
+    def report(self, job):
+        if job['progress_message_id']:
+            edit_message_text(job['admin_chat_id'], job['progress_message_id'], broadcast_progress(job))
+    
+    def _run(self, job):
+        reported_at = time.monotonic()
+        try:
+            while True:
+                chat_ids = db.verified_chats(job['cursor'], BROADCAST_PAGE_SIZE)
+                if not chat_ids:
+                    break
+                for i in range(0, len(chat_ids), BROADCAST_CONCURRENCY):
+                    chunk = chat_ids[i:i + BROADCAST_CONCURRENCY]
+                    results = list(self._pool.map(partial(self._send, job), chunk))
+                    sent = sum(1 for result in results if result.get('ok'))
+                    job['sent'] += sent
+                    job['failed'] += len(chunk) - sent
+                    job['cursor'] = chunk[-1]
+                    
+                    stored = db.get(BROADCAST_KEY)
+                    if not stored or stored['id'] != job['id'] or stored['status'] != 'running':
+                        return  # cancelled
+                    db.put(BROADCAST_KEY, job)
+                    if self._stop.is_set():
+                        return  # shutting down; resumed on the next start
+                    if time.monotonic() - reported_at >= BROADCAST_PROGRESS_INTERVAL:
+                        reported_at = time.monotonic()
+                        self.report(job)
+            job['status'] = 'finished'
+            db.put(BROADCAST_KEY, job)
+            self.report(job)
+            logger.info(broadcast_progress(job))
+        except Exception as e:
+            logger.error(f'Broadcast failed, will resume on restart: {e}')
+
+
+broadcaster = Broadcaster()
+
+
+def handle_broadcast(message, args):
+    """/broadcast <text>, or /broadcast in reply to a message to copy it;
+    /broadcast status and /broadcast cancel manage the running one
+    """
+    job = db.get(BROADCAST_KEY)
+    running = job is not None and job['status'] == 'running'
+    if args in ('status', 'cancel'):
+        if job is None:
+            return reply_admin(message, 'No broadcast has been sent yet')
+        if args == 'cancel' and running:
+            job['status'] = 'cancelled'
+            db.put(BROADCAST_KEY, job)
+            broadcaster.report(job)
+        return reply_admin(message, broadcast_progress(job))
+    if running:
+        return reply_admin(message, 'A broadcast is already running, see /broadcast status')
+    
+    # In a forum topic every message replies to the topic's creation message
+    source = message.get('reply_to_message')
+    if source and source.get('message_id') == message.get('message_thread_id'):
+        source = None
+    if not args and not source:
+        return reply_admin(
+            message,
+            'Usage: /broadcast <text>, or reply /broadcast to the message to send; '
+            '/broadcast status, /broadcast cancel'
+        )
+    
+    admin_chat_id = message.get('chat', {}).get('id')
+    total = db.count_verified()
+    progress = reply_admin(message, f'Broadcast starting to {total} verified users')
+    job = {
+        'id': secrets.token_hex(8),
+        'status': 'running',
+        'text': args,
+        'from_chat_id': admin_chat_id,
+        'message_id': source.get('message_id') if source else None,
+        'admin_chat_id': admin_chat_id,
+        'progress_message_id': progress['result']['message_id'] if progress.get('ok') else None,
+        'cursor': 0,  # private chat ids are positive
+        'sent': 0,
+        'failed': 0,
+        'total': total,
+        'started_at': time.time()
+    }
+    db.put(BROADCAST_KEY, job)
+    broadcaster.start(job)
+
+
+# Update processing
+def process_update(update):
+    update_type = next((key for key in update if key != 'update_id'), 'unknown')
+    metrics.inc('bot_updates_total', f'type="{update_type}"')
+    if 'message' in update:
+        handle_message(update['message'])
+    if 'callback_query' in update:
+        handle_callback_query(update['callback_query'])
+
+
+def update_chat_id(update):
+    """Chat an update belongs to, used to keep per-chat ordering"""
+    if 'message' in update:
+        return update['message'].get('chat', {}).get('id', 0)
+    if 'callback_query' in update:
+        return update['callback_query'].get('from', {}).get('id', 0)
+    return update.get('update_id', 0)
+
+
+class UpdateDedup:
+    """Sliding window of recently accepted update_ids.
+
+    The highest `window` ids are kept in a min-heap mirrored by a set, so a
+    lookup is O(1). When the window is full the smallest id is evicted and
+    becomes `floor`; anything at or below it (or below the mark restored at
+    startup) counts as seen, while a late id above it is still accepted.
+    The mark saved for restarts is `handled_through`, so an update that was
+    accepted but is still in flight, or failed and awaits redelivery, is not
+    skipped. After DEDUP_MARK_TTL without updates everything is forgotten.
+    Safe to share between request threads.
+    """
+    
+    def __init__(self, window):
+        self.floor = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.window = window
+        self._heap = []
+        self._seen = set()
+        # Accepted but not yet handled; failed ones stay until redelivered
+        self._pending = set()
+        self._accepted_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def restore(self, high_water):
+        with self._lock:
+            self.floor = self.high_water = max(self.high_water, high_water or 0)
+            self._accepted_at = time.monotonic()
+    
+    def add(self, update_id):
+        """Remember an update; returns False if it was already seen"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._accepted_at > DEDUP_MARK_TTL:
+                # The next update_id is random; an old floor could hide every update
+                self.floor = self.high_water = 0
+                self._heap.clear()
+                self._seen.clear()
+                self._pending.clear()
+            if update_id <= self.floor or update_id in self._seen:
+                self.dropped += 1
+                return False
+            if len(self._heap) >= self.window:
+                evicted = heapq.heappop(self._heap)
+                self._seen.discard(evicted)
+                self._pending.discard(evicted)
+                self.floor = max(self.floor, evicted)
+            heapq.heappush(self._heap, update_id)
+            self._seen.add(update_id)
+            self._pending.add(update_id)
+            self.high_water = max(self.high_water, update_id)
+            self._accepted_at = now
+            return True
+    
+    def done(self, update_id):
+        """Mark an accepted update as handled, successfully or not"""
+        with self._lock:
+            self._pending.discard(update_id)
+    
+    def discard(self, update_id):
+        """Forget an update we did not handle, so its redelivery is processed.
+
+        It stays pending, holding `handled_through` back until then.
+        """
+        with self._lock:
+            self._seen.discard(update_id)
+    
+    @property
+    def handled_through(self):
+        """Highest update_id with nothing at or below it left to handle"""
+        with self._lock:
+            if self._pending:
+                return min(self._pending) - 1
+            return self.high_water
+    
+    def stats(self):
+        return {
+            'window': len(self._seen),
+            'high_water': self.high_water,
+            'handled_through': self.handled_through,
+            'pending': len(self._pending),
+            'dropped': self.dropped
+        }
+    
+    def start(self, database, interval):
+        """Restore the saved handled-through mark and save it every interval seconds"""
+        self.restore(database.get('update-high-water'))
+        
+        def run():
+            saved = self.handled_through
+            while True:
+                time.sleep(interval)
+                if self.handled_through != saved:
+                    saved = self.handled_through
+                    database.put('update-high-water', saved, ttl=DEDUP_MARK_TTL)
+        threading.Thread(target=run, name='update-dedup', daemon=True).start()
+
+
+update_dedup = UpdateDedup(DEDUP_WINDOW)
+
+
+class UpdateQueue:
+    """Bounded update queue drained by a fixed pool of worker threads.
+
+    Updates are sharded by chat, so every chat is served by one worker and
+    keeps its order. A full shard rejects new updates instead of growing.
+    """
+    
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        shard_size = max(1, maxsize // workers)
+        self._queues = [queue.Queue(shard_size) for _ in range(workers)]
+        self._threads = []
+    
+    def start(self):
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(target=self._worker, args=(q,), name=f'update-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def _worker(self, q):
+        while True:
+            update = q.get()
+            if update is None:
+                break
+            try:
+                process_update(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f'Error handling update: {e}')
+            finally:
+                # Already acked, so Telegram will not redeliver a failure
+                update_dedup.done(update.get('update_id'))
+    
+    def submit(self, update):
+        """Enqueue an update; returns False when its shard is full"""
+        q = self._queues[hash(update_chat_id(update)) % self.workers]
+        try:
+            q.put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        return True
+    
+    @property
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+    
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'maxsize': self.maxsize,
+            'workers': self.workers,
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'failed': self.failed
+        }
+    
+    def stop(self, timeout):
+        """Let workers finish what is queued, then stop them"""
+        deadline = time.monotonic() + timeout
+        for q in self._queues:
+            try:
+                q.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        if self.depth:
+            logger.warning(f'Shutdown drain timed out, {self.depth} queued updates dropped')
+
+
+update_queue = None
+
+
+# Long polling
+def dispatch_batch(executor, updates):
+    """Handle chats concurrently while keeping each chat's updates in order"""
+    by_chat = {}
+    for update in updates:
+        by_chat.setdefault(update_chat_id(update), []).append(update)
+    
+    def run_chat(chat_updates):
+        for update in chat_updates:
+            try:
+                process_update(update)
+            except Exception as e:
+                logger.error(f'Error handling update: {e}')
+    
+    list(executor.map(run_chat, by_chat.values()))
+
+
+def poll_updates(stop_event):
+    """Fetch updates with getUpdates and commit the offset after each batch"""
+    api_request('deleteWebhook')
+    offset = db.get('update-offset')
+    with ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix='poll') as executor:
+        while not stop_event.is_set():
+            params = {'timeout': POLL_TIMEOUT, 'limit': POLL_LIMIT}
+            if offset:
+                params['offset'] = offset
+            result = api_request('getUpdates', params, timeout=POLL_TIMEOUT + 10)
+            if not result.get('ok'):
+                stop_event.wait(POLL_RETRY_DELAY)
+                continue
+            if not result['result']:
+                continue
+            
+            dispatch_batch(executor, result['result'])
+            offset = max(update['update_id'] for update in result['result']) + 1
+            db.put('update-offset', offset)
 
 
 # HTTP Server
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer that serves connections on a bounded thread pool.
+
+    At most `workers` connections are handled at once; further clients wait
+    in the kernel listen backlog, so memory stays flat under bursts.
+    """
+    
+    request_queue_size = 128
+    
+    def __init__(self, server_address, handler_class, workers):
+        super().__init__(server_address, handler_class)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+        self._slots = threading.BoundedSemaphore(workers)
+    
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        self._pool.submit(self._process_request, request, client_address)
+    
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+    
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=True)
+
+
+GET_ROUTES = {'/', '/stats', '/metrics', '/registerWebhook', '/unRegisterWebhook'}
+
+
 class BotHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body go out as separate writes; with Nagle on, the body
+    # waits for the client's delayed ACK (~40 ms) on a kept-alive connection
+    disable_nagle_algorithm = True
+    
     def log_message(self, format, *args):
         logger.info(f'{self.address_string()} - {format % args}')
     
@@ -437,9 +2415,32 @@ class BotHandler(BaseHTTPRequestHandler):
     
     def do_GET(self):
         path = urlparse(self.path).path
-        
+        route = path if path in GET_ROUTES else 'other'
+        with metrics.timer('bot_http_request_seconds', f'route="{route}"', 'bot_http_requests_in_flight'):
+            self.route_get(path)
+    
+    def do_POST(self):
+        path = urlparse(self.path).path
+        route = path if path == '/webhook' else 'other'
+        with metrics.timer('bot_http_request_seconds', f'route="{route}"', 'bot_http_requests_in_flight'):
+            self.route_post(path)
+    
+    def route_get(self, path):
         if path == '/':
             self.send_text('Bot is running')
+        elif path == '/stats':
+            self.send_json({
+                'update_queue': update_queue.stats() if update_queue is not None else None,
+                'update_dedup': update_dedup.stats(),
+                'flood_guard': flood_guard.stats(),
+                'media_groups': media_groups.stats(),
+                'sweeper': sweeper.stats(),
+                'user_cache': db.user_cache.stats(),
+                'write_behind': db.write_behind_stats(),
+                'http_pool': http_pool.stats()
+            })
+        elif path == '/metrics':
+            self.send_text(metrics.render())
         elif path == '/registerWebhook':
             self.handle_register_webhook()
         elif path == '/unRegisterWebhook':
@@ -447,32 +2448,47 @@ class BotHandler(BaseHTTPRequestHandler):
         else:
             self.send_text('Not Found', 404)
     
-    def do_POST(self):
-        path = urlparse(self.path).path
-        
+    def route_post(self, path):
         if path == '/webhook':
             self.handle_webhook()
         else:
+            # Body is left unread, so the connection cannot be reused
+            self.close_connection = True
             self.send_text('Not Found', 404)
     
     def handle_webhook(self):
         # Verify secret
         secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
         if secret != WEBHOOK_SECRET:
+            self.close_connection = True
             self.send_text('Unauthorized', 403)
             return
         
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             body = self.rfile.read(content_length)
-            update = json.loads(body.decode('utf-8'))
+            update = json_loads(body)
+            log_update(update)
             
-            logger.info(f'Received update: {json.dumps(update, ensure_ascii=False)[:200]}')
+            # Telegram redelivers updates a slow handler has not answered yet
+            update_id = update.get('update_id')
+            if update_id is not None and not update_dedup.add(update_id):
+                self.send_text('Ok')
+                return
             
-            if 'message' in update:
-                handle_message(update['message'])
-            if 'callback_query' in update:
-                handle_callback_query(update['callback_query'])
+            if update_queue is not None:
+                # Ack now; Telegram redelivers if we answer 503
+                if not update_queue.submit(update):
+                    update_dedup.discard(update_id)
+                    self.send_text('Busy', 503)
+                    return
+            else:
+                try:
+                    process_update(update)
+                except Exception:
+                    update_dedup.discard(update_id)
+                    raise
+                update_dedup.done(update_id)
             
             self.send_text('Ok')
         except Exception as e:
@@ -487,7 +2503,8 @@ class BotHandler(BaseHTTPRequestHandler):
         webhook_url = f'{DOMAIN}/webhook'
         result = api_request('setWebhook', {
             'url': webhook_url,
-            'secret_token': WEBHOOK_SECRET
+            'secret_token': WEBHOOK_SECRET,
+            'max_connections': WEBHOOK_MAX_CONNECTIONS
         })
         self.send_text(json.dumps(result, indent=2))
     
@@ -497,24 +2514,32 @@ class BotHandler(BaseHTTPRequestHandler):
 
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate']:
+        # Opening the database already converted any legacy kv_store keys
+        print(f'Migrated kv_store rows in {DB_PATH}: {db.migrated}')
+        exit(0)
     if not BOT_TOKEN:
         print('Error: BOT_TOKEN not set')
         print('Usage: BOT_TOKEN=xxx ADMIN_UID=xxx python3 tg_bot_stdlib.py')
         exit(1)
-    if not ADMIN_UID:
+    if not ADMIN_UIDS:
         print('Error: ADMIN_UID not set')
         exit(1)
     
+    admins = f'forum {ADMIN_GROUP_ID}' if ADMIN_GROUP_ID else ', '.join(ADMIN_UIDS)
     print(f'''
 +--------------------------------------------------------------+
 |    Telegram Verification Bot - Standard Library Version      |
 +--------------------------------------------------------------+
 |  Port: {PORT:<54}|
-|  Admin: {ADMIN_UID:<53}|
+|  Admin: {admins[:53]:<53}|
 |  Database: {DB_PATH:<50}|
+|  Updates: {UPDATE_MODE:<51}|
 +--------------------------------------------------------------+
 |  Endpoints:                                                  |
 |    GET  /                    - Health check                  |
+|    GET  /stats               - Runtime statistics            |
+|    GET  /metrics             - Prometheus metrics            |
 |    POST /webhook             - Telegram Webhook              |
 |    GET  /registerWebhook     - Register Webhook              |
 |    GET  /unRegisterWebhook   - Unregister Webhook            |
@@ -523,9 +2548,37 @@ if __name__ == '__main__':
 +--------------------------------------------------------------+
 ''')
     
-    server = HTTPServer(('0.0.0.0', PORT), BotHandler)
+    db.start_write_behind()
+    update_dedup.start(db, DEDUP_SAVE_INTERVAL)
+    fraud_list.start(FRAUD_REFRESH_INTERVAL)
+    sweeper.start(SWEEP_INTERVAL)
+    broadcaster.resume()
+    if ASYNC_UPDATES:
+        update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+        update_queue.start()
+    poll_stop = threading.Event()
+    if UPDATE_MODE == 'polling':
+        poller = threading.Thread(target=poll_updates, args=(poll_stop,), name='poller', daemon=True)
+        poller.start()
+    server = PooledHTTPServer(('0.0.0.0', PORT), BotHandler, SERVER_WORKERS)
+    # A service stop sends SIGTERM; shut down as on Ctrl-C so buffered writes are kept
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
+        # A second signal must not cut the drain and flush short
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         print('\nShutting down...')
+        poll_stop.set()
         server.shutdown()
+        server.server_close()
+        if UPDATE_MODE == 'polling':
+            # Let an in-flight batch finish and commit its offset
+            poller.join(POLL_TIMEOUT + 10)
+        if update_queue is not None:
+            update_queue.stop(SHUTDOWN_DRAIN_TIMEOUT)
+        broadcaster.stop(SHUTDOWN_DRAIN_TIMEOUT)
+        media_groups.drain()
+        db.put('update-high-water', update_dedup.handled_through, ttl=DEDUP_MARK_TTL)
+        db.flush()
@@ -0,0 +1,15 @@
+"""
+Tests for bot.py / nore.py
+Run with: python3 -m pytest tests  (or python3 -m unittest discover -t . -s tests)
+bot.py needs aiohttp; nore.py only the standard library.
+"""
+
+import os
+import tempfile
+
+# Both bots read their configuration and open their database at import time
+WORK_DIR = tempfile.mkdtemp(prefix='bot-tests-')
+os.environ.setdefault('DB_PATH', os.path.join(WORK_DIR, 'bot_data.db'))
+os.environ.setdefault('FRAUD_CACHE_PATH', os.path.join(WORK_DIR, 'fraud_cache.txt'))
+os.environ.setdefault('FRAUD_DB_URL', 'http://127.0.0.1:9/fraud.db')  # refused at once; no network in tests
+os.environ.setdefault('NOTIFICATION_URL', 'http://127.0.0.1:9/notification.txt')
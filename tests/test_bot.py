@@ -0,0 +1,168 @@
+import os
+import time
+import sqlite3
+import asyncio
+import unittest
+from unittest import mock
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import tests  # noqa: F401  (test environment)
+import bot
+
+SLOW_DISK = 0.2  # seconds each storage call is held up
+CONCURRENT_WEBHOOKS = 10
+
+
+async def fake_api_request(session, method, data=None, timeout=None, priority=bot.PRIORITY_NORMAL):
+    await asyncio.sleep(0.005)
+    return {'ok': True, 'result': {'message_id': 1}}
+
+
+class StorageLatencyTest(unittest.IsolatedAsyncioTestCase):
+    """Slow SQLite calls must stall the storage thread, never the event loop"""
+    
+    async def test_concurrent_webhooks_do_not_block_the_loop(self):
+        get_user_row = bot.db.database.get_user_row
+    
+        def slow_get_user_row(chat_id):
+            time.sleep(SLOW_DISK)
+            return get_user_row(chat_id)
+    
+        with mock.patch.object(bot.db.database, 'get_user_row', slow_get_user_row), \
+                mock.patch.object(bot, 'api_request', fake_api_request):
+            client = TestClient(TestServer(bot.create_app()))
+            await client.start_server()
+            try:
+                stalls = []
+                done = asyncio.Event()
+    
+                async def watch_loop():
+                    while not done.is_set():
+                        start = time.perf_counter()
+                        await asyncio.sleep(0.001)
+                        stalls.append(time.perf_counter() - start - 0.001)
+    
+                async def post(i):
+                    update = {
+                        'update_id': 900000 + i,
+                        'message': {'message_id': i, 'chat': {'id': 9000000 + i}, 'text': 'hello'}
+                    }
+                    resp = await client.post(
+                        '/webhook', json=update, headers={'X-Telegram-Bot-Api-Secret-Token': bot.WEBHOOK_SECRET}
+                    )
+                    await resp.read()
+                    return resp.status
+    
+                await post(-1)  # first-request setup is not what is measured
+                watcher = asyncio.create_task(watch_loop())
+                statuses = await asyncio.gather(*(post(i) for i in range(CONCURRENT_WEBHOOKS)))
+                done.set()
+                await watcher
+            finally:
+                await client.close()
+    
+        self.assertEqual(statuses, [200] * CONCURRENT_WEBHOOKS)
+        # The storage thread was busy for CONCURRENT_WEBHOOKS * SLOW_DISK seconds;
+        # no single loop iteration may have waited on even one of those calls
+        self.assertLess(max(stalls), SLOW_DISK)
+
+
+class RateLimiterTest(unittest.IsolatedAsyncioTestCase):
+    """Every priority lane must get tokens, however low the global rate"""
+    
+    async def test_every_lane_acquires_at_low_rates(self):
+        for rate in (0.5, 1, 1.5, 30 / 19):
+            limiter = bot.RateLimiter(rate, 1000, 1000)
+            for priority in (bot.PRIORITY_HIGH, bot.PRIORITY_NORMAL, bot.PRIORITY_LOW):
+                with self.subTest(rate=rate, priority=priority):
+                    self.assertLessEqual(limiter.lane_reserve(priority) + 1, limiter.global_bucket.capacity)
+        
+        # A full bucket at 1 msg/s: each lane waits at most one refill
+        limiter = bot.RateLimiter(1, 1000, 1000)
+        start = time.monotonic()
+        for chat_id, priority in enumerate((bot.PRIORITY_LOW, bot.PRIORITY_NORMAL, bot.PRIORITY_HIGH)):
+            await asyncio.wait_for(limiter.acquire(chat_id, priority), timeout=2)
+        self.assertLess(time.monotonic() - start, 3)
+
+
+class AdminTopicTest(unittest.IsolatedAsyncioTestCase):
+    """A guest's concurrent first messages must share one forum topic"""
+    
+    async def test_concurrent_first_messages_create_one_topic(self):
+        created = []
+        
+        async def create_topic(session, method, data=None, timeout=None, priority=bot.PRIORITY_NORMAL):
+            await asyncio.sleep(0.05)
+            created.append(data)
+            return {'ok': True, 'result': {'message_thread_id': 4200 + len(created)}}
+        
+        chat_id = '9100001'
+        message = {'message_id': 1, 'chat': {'id': int(chat_id)}, 'from': {'first_name': 'Guest'}}
+        user = await bot.db.get_user(chat_id)
+        with mock.patch.object(bot, 'api_request', create_topic), \
+                mock.patch.object(bot, 'ADMIN_GROUP_ID', '-1001'):
+            topics = await asyncio.gather(*(bot.admin_topic_for(None, chat_id, message, user) for _ in range(5)))
+        
+        self.assertEqual(len(created), 1)
+        self.assertEqual(topics, [4201] * 5)
+        self.assertEqual(len(bot.topic_locks), 0)
+
+
+class MigrationTest(unittest.TestCase):
+    """A baseline kv_store with every legacy key prefix migrates in one go"""
+    
+    def test_migrates_every_legacy_key_prefix(self):
+        path = os.path.join(tests.WORK_DIR, 'legacy-bot.db')
+        now = int(time.time())
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE kv_store (key TEXT PRIMARY KEY, value TEXT, expires_at INTEGER)')
+        conn.executemany('INSERT INTO kv_store VALUES (?, ?, ?)', [
+            ('verified-101', 'true', now + 3600),
+            ('verified-102', 'false', None),
+            ('verify-103', '7', now + 600),
+            ('isblocked-104', 'true', None),
+            ('lastmsg-105', str(now), None),
+            ('lastmsg-106', str(now), now - 1),
+            ('msg-map-555', '107', now + 3600),
+            ('update-offset', '42', None)
+        ])
+        conn.commit()
+        conn.close()
+        
+        database = bot.Database(path)
+        try:
+            self.assertEqual(database.migrated, {'verified': 1, 'verify': 0, 'isblocked': 1, 'lastmsg': 1, 'msg-map': 1})
+            self.assertEqual(database.get_user_row(101)[0], now + 3600)
+            self.assertIsNone(database.get_user_row(102))
+            self.assertIsNone(database.get_user_row(103))
+            self.assertEqual(database.get_user_row(104)[1], 1)
+            self.assertEqual(database.get_user_row(105)[2], now)
+            self.assertIsNone(database.get_user_row(106))
+            self.assertEqual(database.get_message_map(bot.ADMIN_UID, 555), '107')
+            self.assertEqual(database.get('update-offset'), 42)
+            self.assertEqual(database.migrate_kv_store()['verified'], 0)
+        finally:
+            database.close()
+
+
+class ChallengeTest(unittest.TestCase):
+    """Signed callback_data tells right from wrong and rejects anything else"""
+    
+    def test_check_challenge(self):
+        expires = int(time.time()) + 60
+        right = bot.challenge_callback_data('123', 7, 7, expires)
+        wrong = bot.challenge_callback_data('123', 8, 7, expires)
+        self.assertLessEqual(len(right), 64)
+        self.assertIs(bot.check_challenge('123', right), True)
+        self.assertIs(bot.check_challenge('123', wrong), False)
+        
+        self.assertIsNone(bot.check_challenge('456', right))
+        self.assertIsNone(bot.check_challenge('123', right.replace('verify_7_', 'verify_8_')))
+        self.assertIsNone(bot.check_challenge('123', bot.challenge_callback_data('123', 7, 7, expires - 120)))
+        self.assertIsNone(bot.check_challenge('123', 'verify_7'))
+        self.assertIsNone(bot.check_challenge('123', 'verify_7_zz_abc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+import os
+import time
+import sqlite3
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import tests  # noqa: F401  (test environment)
+import nore
+
+
+class RateLimiterTest(unittest.TestCase):
+    """Every priority lane must get tokens, however low the global rate"""
+    
+    def test_every_lane_acquires_at_low_rates(self):
+        for rate in (0.5, 1, 1.5, 30 / 19):
+            limiter = nore.RateLimiter(rate, 1000, 1000)
+            for priority in (nore.PRIORITY_HIGH, nore.PRIORITY_NORMAL, nore.PRIORITY_LOW):
+                with self.subTest(rate=rate, priority=priority):
+                    self.assertLessEqual(limiter.lane_reserve(priority) + 1, limiter.global_bucket.capacity)
+        
+        # A full bucket at 1 msg/s: each lane waits at most one refill
+        limiter = nore.RateLimiter(1, 1000, 1000)
+        
+        def acquire_all():
+            for chat_id, priority in enumerate((nore.PRIORITY_LOW, nore.PRIORITY_NORMAL, nore.PRIORITY_HIGH)):
+                limiter.acquire(chat_id, priority)
+        
+        thread = threading.Thread(target=acquire_all, daemon=True)
+        start = time.monotonic()
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'a lane never got a token')
+        self.assertLess(time.monotonic() - start, 3)
+
+
+class UpdateDedupTest(unittest.TestCase):
+    """The saved mark must never pass an update that was not handled"""
+    
+    def test_handled_through_waits_for_in_flight_and_failed_updates(self):
+        dedup = nore.UpdateDedup(100)
+        for update_id in (1, 2, 3):
+            self.assertTrue(dedup.add(update_id))
+        self.assertEqual(dedup.handled_through, 0)
+        
+        dedup.done(1)
+        dedup.done(3)
+        self.assertEqual(dedup.handled_through, 1)
+        
+        # 2 failed before the ack: the mark holds until its redelivery is handled
+        dedup.discard(2)
+        self.assertEqual(dedup.handled_through, 1)
+        self.assertTrue(dedup.add(2))
+        dedup.done(2)
+        self.assertEqual(dedup.handled_through, 3)
+        
+        restarted = nore.UpdateDedup(100)
+        restarted.restore(1)
+        self.assertTrue(restarted.add(2))
+        self.assertFalse(restarted.add(1))
+    
+    def test_failure_leaving_the_window_releases_the_mark(self):
+        dedup = nore.UpdateDedup(3)
+        dedup.add(1)
+        dedup.discard(1)
+        for update_id in (2, 3, 4):
+            dedup.add(update_id)
+            dedup.done(update_id)
+        self.assertEqual(dedup.handled_through, 4)
+    
+    def test_late_ids_above_the_evicted_minimum_are_accepted(self):
+        dedup = nore.UpdateDedup(3)
+        for update_id in (10, 5, 11, 12):
+            self.assertTrue(dedup.add(update_id))
+        self.assertEqual(dedup.floor, 5)
+        self.assertTrue(dedup.add(7))
+        self.assertFalse(dedup.add(10))
+        self.assertFalse(dedup.add(4))
+    
+    def test_forgets_everything_after_a_week_without_updates(self):
+        dedup = nore.UpdateDedup(100)
+        dedup.restore(5000)
+        self.assertFalse(dedup.add(42))
+        # Telegram restarts from a random update_id after a quiet week
+        dedup._accepted_at -= nore.DEDUP_MARK_TTL + 1
+        self.assertTrue(dedup.add(42))
+        dedup.done(42)
+        self.assertEqual(dedup.handled_through, 42)
+
+
+class AdminTopicTest(unittest.TestCase):
+    """A guest's concurrent first messages must share one forum topic"""
+    
+    def test_concurrent_first_messages_create_one_topic(self):
+        created = []
+        
+        def create_topic(method, data=None, **kwargs):
+            time.sleep(0.05)
+            created.append(data)
+            return {'ok': True, 'result': {'message_thread_id': 4200 + len(created)}}
+        
+        chat_id = '9100002'
+        message = {'message_id': 1, 'chat': {'id': int(chat_id)}, 'from': {'first_name': 'Guest'}}
+        user = nore.db.get_user(chat_id)
+        with mock.patch.object(nore, 'api_request', create_topic), \
+                mock.patch.object(nore, 'ADMIN_GROUP_ID', '-1001'), \
+                ThreadPoolExecutor(5) as pool:
+            topics = list(pool.map(lambda _: nore.admin_topic_for(chat_id, message, user), range(5)))
+        
+        self.assertEqual(len(created), 1)
+        self.assertEqual(topics, [4201] * 5)
+        self.assertEqual(len(nore.topic_locks), 0)
+
+
+class MediaGroupBufferTest(unittest.TestCase):
+    """Albums are sent from long-lived threads, so metrics shards stay bounded"""
+    
+    def test_albums_do_not_start_threads_of_their_own(self):
+        buffer = nore.MediaGroupBuffer(0.01, senders=2)
+        sent = []
+        
+        def send(messages):
+            nore.metrics.inc('test_media_groups_sent')
+            sent.append([m['message_id'] for m in messages])
+        
+        shards = len(nore.metrics._shards)
+        for album in range(20):
+            for message_id in (2, 1, 3):
+                buffer.add({'chat': {'id': 1}, 'media_group_id': str(album), 'message_id': message_id}, send)
+            time.sleep(0.005)
+        buffer.drain()
+        
+        self.assertEqual(sent, [[1, 2, 3]] * 20)
+        self.assertLessEqual(len(nore.metrics._shards) - shards, 2)
+
+
+class MigrationTest(unittest.TestCase):
+    """A baseline kv_store with every legacy key prefix migrates in one go"""
+    
+    def test_migrates_every_legacy_key_prefix(self):
+        path = os.path.join(tests.WORK_DIR, 'legacy-nore.db')
+        now = int(time.time())
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE kv_store (key TEXT PRIMARY KEY, value TEXT, expires_at INTEGER)')
+        conn.executemany('INSERT INTO kv_store VALUES (?, ?, ?)', [
+            ('verified-101', 'true', now + 3600),
+            ('verified-102', 'false', None),
+            ('verify-103', '7', now + 600),
+            ('isblocked-104', 'true', None),
+            ('lastmsg-105', str(now), None),
+            ('lastmsg-106', str(now), now - 1),
+            ('msg-map-555', '107', now + 3600),
+            ('update-offset', '42', None)
+        ])
+        conn.commit()
+        conn.close()
+        
+        database = nore.Database(path)
+        try:
+            self.assertEqual(database.migrated, {'verified': 1, 'verify': 0, 'isblocked': 1, 'lastmsg': 1, 'msg-map': 1})
+            self.assertEqual(database.get_user_row(101)[0], now + 3600)
+            self.assertIsNone(database.get_user_row(102))
+            self.assertIsNone(database.get_user_row(103))
+            self.assertEqual(database.get_user_row(104)[1], 1)
+            self.assertEqual(database.get_user_row(105)[2], now)
+            self.assertIsNone(database.get_user_row(106))
+            self.assertEqual(database.get_message_map(nore.ADMIN_UID, 555), '107')
+            self.assertEqual(database.get('update-offset'), 42)
+            self.assertEqual(database.migrate_kv_store()['verified'], 0)
+        finally:
+            database.close()
+
+
+class ChallengeTest(unittest.TestCase):
+    """Signed callback_data tells right from wrong and rejects anything else"""
+    
+    def test_check_challenge(self):
+        expires = int(time.time()) + 60
+        right = nore.challenge_callback_data('123', 7, 7, expires)
+        wrong = nore.challenge_callback_data('123', 8, 7, expires)
+        self.assertLessEqual(len(right), 64)
+        self.assertIs(nore.check_challenge('123', right), True)
+        self.assertIs(nore.check_challenge('123', wrong), False)
+        
+        self.assertIsNone(nore.check_challenge('456', right))
+        self.assertIsNone(nore.check_challenge('123', right.replace('verify_7_', 'verify_8_')))
+        self.assertIsNone(nore.check_challenge('123', nore.challenge_callback_data('123', 7, 7, expires - 120)))
+        self.assertIsNone(nore.check_challenge('123', 'verify_7'))
+        self.assertIsNone(nore.check_challenge('123', 'verify_7_zz_abc'))
+
+
+class FraudListTest(unittest.TestCase):
+    """Writers persisting the cache at once must not corrupt it"""
+    
+    def test_concurrent_cache_writes(self):
+        directory = os.path.join(tests.WORK_DIR, 'fraud-cache')
+        os.makedirs(directory)
+        path = os.path.join(directory, 'fraud_cache.txt')
+        text = '\n'.join(str(user_id) for user_id in range(100000, 200000))
+        lists = [nore.FraudList('http://127.0.0.1:9/fraud.db', path) for _ in range(8)]
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda fraud_list: fraud_list._store_cache(text), lists))
+        
+        self.assertEqual(len(nore.FraudList('http://127.0.0.1:9/fraud.db', path)), 100000)
+        self.assertEqual(sorted(os.listdir(directory)), ['fraud_cache.txt', 'fraud_cache.txt.meta'])
+
+
+class BroadcasterTest(unittest.TestCase):
+    """Broadcasts reuse one sender pool, so metrics shards stay bounded"""
+    
+    def test_broadcasts_reuse_their_threads(self):
+        for chat_id in range(9200001, 9200031):
+            nore.db.set_verified(chat_id, 3600)
+        
+        def fake_send_message(chat_id, text, **kwargs):
+            nore.metrics.inc('test_broadcast_sends')
+            return {'ok': True, 'result': {'message_id': 1}}
+        
+        broadcaster = nore.Broadcaster()
+        shards = len(nore.metrics._shards)
+        with mock.patch.object(nore, 'send_message', fake_send_message):
+            for run in range(5):
+                job = {
+                    'id': str(run), 'status': 'running', 'text': 'hello', 'progress_message_id': None,
+                    'cursor': 0, 'sent': 0, 'failed': 0, 'total': 0, 'started_at': time.time()
+                }
+                nore.db.put(nore.BROADCAST_KEY, job)
+                broadcaster.start(job)
+                broadcaster.future.result(10)
+                job = nore.db.get(nore.BROADCAST_KEY)
+                self.assertEqual((job['status'], job['sent']), ('finished', nore.db.count_verified()))
+        
+        self.assertLessEqual(len(nore.metrics._shards) - shards, nore.BROADCAST_CONCURRENCY + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()